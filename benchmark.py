@@ -0,0 +1,1360 @@
+#!/usr/bin/python3
+
+# Benchmarki ClaudeChat z lokalnym fake serwerem Messages API (SSE).
+#
+#   python benchmark.py chat --users 50 --messages 3 --token-rate 80
+#   python benchmark.py cache --users 20     # identyczne zapytania: coalescing i cache odpowiedzi
+#   python benchmark.py code --users 2 --code-seconds 1   # %py inline wykonywany w trakcie streamingu
+#   python benchmark.py kernel --cells 10 --rows 1000000   # kolejne komórki %py inline: kernel sesji vs świeży exec
+#   python benchmark.py http --users 20
+#   python benchmark.py stream --history-turns 200   # bajty SSE Gradio na odpowiedź, z i bez STREAM_FLUSH_INTERVAL
+#   python benchmark.py scaling --users 40 --worker-counts 1,2,4 --token-rate 0
+#   python benchmark.py history | context | import
+#   python benchmark.py sessions --sessions 1000 --session-turns 20   # pamięć bezczynnych sesji: dawne dicty, Session, sizeof
+#   python benchmark.py search --files 500 --session-turns 20   # indeks pełnotekstowy: --index-dir i zapytania
+#   python benchmark.py branches --turns 100,1000 --branches 20   # pamięć gałęzi: N ogonów, nie N historii
+#   python benchmark.py importtime --top 10   # profil -X importtime
+#   python benchmark.py startup --runs 5      # zimny start do nasłuchującego portu (cel: --startup-target)
+#   python benchmark.py replay --token-rate 200   # nagrane strumienie z benchmark-fixtures/: treść, Stop, anulowanie
+#   python benchmark.py record --env ~/claude-chat/.env --name NAME --prompt "..."   # nowe nagranie z prawdziwego API
+#   python benchmark.py server --port 8765      # sam fake serwer, np. do ręcznych testów (--fixtures: nagrania)
+#
+# Wyniki są dopisywane do benchmark-results.jsonl razem z hashem commita,
+# --compare pokazuje zmianę względem poprzedniego pomiaru z tymi samymi parametrami.
+
+import os
+import re
+import gc
+import sys
+import json
+import time
+import uuid
+import random
+import socket
+import asyncio
+import argparse
+import itertools
+import tempfile
+import threading
+import resource
+import subprocess
+import contextlib
+import importlib.util
+import multiprocessing
+import urllib.request
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'claude-chat.py')
+RESULTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark-results.jsonl')
+FIXTURES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark-fixtures')
+SYSTEM_PROMPT = "You are a helpful assistant."
+STARTUP_TARGET_SECONDS = 5.0  # restart pod systemd: od startu procesu do nasłuchującego portu
+WORDS = [" lorem", " ipsum", " dolor", " sit", " amet", ",", " consectetur", " adipiscing", " elit", "."]
+FIXTURE_RE = re.compile(r"fixture:([\w-]+)")  # w wiadomości użytkownika wybiera nagranie dla fake serwera
+STREAM_HEADERS = (b"HTTP/1.1 200 OK\r\ncontent-type: text/event-stream\r\ncache-control: no-cache\r\n"
+                  b"transfer-encoding: chunked\r\nrequest-id: req_benchmark\r\n\r\n")
+REPLAY_STOP_AFTER = 5  # Stop po tylu aktualizacjach z tekstem (replay)
+
+
+# ---------------------------------------------------------------- fake serwer
+
+def sse_chunk(payload):
+    return f"{len(payload):x}\r\n".encode() + payload + b"\r\n"
+
+
+def sse_event(event, data):
+    return sse_chunk(f"event: {event}\ndata: {json.dumps(data)}\n\n".encode())
+
+
+async def send_error(writer, status, reason, error_type, retry_after):
+    body = json.dumps({"type": "error", "error": {"type": error_type, "message": reason}}).encode()
+    writer.write(f"HTTP/1.1 {status} {reason}\r\ncontent-type: application/json\r\nretry-after: {retry_after}\r\n"
+                 f"content-length: {len(body)}\r\n\r\n".encode() + body)
+    await writer.drain()
+
+
+async def stream_message(writer, config, request, input_tokens):
+    writer.write(STREAM_HEADERS)
+    await asyncio.sleep(config["latency"])
+
+    tokens = min(config["tokens"], request.get("max_tokens", config["tokens"]))
+    words = [WORDS[i % len(WORDS)] for i in range(tokens)]
+    if config["code_seconds"] and "[Auto-reply]" not in json.dumps(request.get("messages", [])[-1:]):
+        # blok %py inline na początku odpowiedzi, po nim reszta tekstu (scenariusz code)
+        code = f"```python\n%py inline\nimport time\ntime.sleep({config['code_seconds']})\nprint('done')\n```\n"
+        words = [line + "\n" for line in code.split("\n")[:-1]] + words[:max(0, tokens - code.count("\n"))]
+    writer.write(sse_event("message_start", {"type": "message_start", "message": {
+        "id": "msg_benchmark", "type": "message", "role": "assistant", "model": request.get("model", ""),
+        "content": [], "stop_reason": None, "stop_sequence": None,
+        "usage": {"input_tokens": input_tokens, "output_tokens": 1,
+                  "cache_creation_input_tokens": 0, "cache_read_input_tokens": 0}}}))
+    writer.write(sse_event("content_block_start", {"type": "content_block_start", "index": 0,
+                                                   "content_block": {"type": "text", "text": ""}}))
+    await writer.drain()
+
+    # overloaded_error w trakcie strumienia - tak jak API przy przeciążeniu
+    fail_at = random.randrange(tokens) if random.random() < config["overload_chunk_rate"] else None
+    delay = 1 / config["token_rate"] if config["token_rate"] else 0
+    for i, word in enumerate(words):
+        if i == fail_at:
+            writer.write(sse_event("error", {"type": "error", "error": {"type": "overloaded_error",
+                                                                        "message": "Overloaded"}}))
+            writer.write(b"0\r\n\r\n")
+            await writer.drain()
+            return
+        writer.write(sse_event("content_block_delta", {"type": "content_block_delta", "index": 0,
+                                                       "delta": {"type": "text_delta", "text": word}}))
+        await writer.drain()
+        if delay:
+            await asyncio.sleep(delay)
+
+    writer.write(sse_event("content_block_stop", {"type": "content_block_stop", "index": 0}))
+    writer.write(sse_event("message_delta", {"type": "message_delta",
+                                             "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                                             "usage": {"output_tokens": tokens}}))
+    writer.write(sse_event("message_stop", {"type": "message_stop"}))
+    writer.write(b"0\r\n\r\n")
+    await writer.drain()
+
+
+def load_fixtures(directory):
+    """Nagrane strumienie *.sse: nazwa pliku -> lista zdarzeń SSE w bajtach, tak jak przyszły z API"""
+    fixtures = {}
+    for name in sorted(os.listdir(directory)):
+        if name.endswith(".sse"):
+            with open(os.path.join(directory, name), "rb") as file:
+                data = file.read().replace(b"\r\n", b"\n")
+            fixtures[name[:-4]] = [event + b"\n\n" for event in data.split(b"\n\n") if event.strip()]
+    return fixtures
+
+
+def fixture_reply(events):
+    """Tekst i output_tokens, które aplikacja powinna złożyć z nagranego strumienia"""
+    text, output_tokens = "", None
+    for event in events:
+        for line in event.decode().splitlines():
+            if line.startswith("data:"):
+                data = json.loads(line[5:])
+                if data["type"] == "content_block_delta" and data["delta"]["type"] == "text_delta":
+                    text += data["delta"]["text"]
+                elif data["type"] == "message_delta":
+                    output_tokens = data["usage"]["output_tokens"]
+    return text, output_tokens
+
+
+def pick_fixture(fixtures, request, order):
+    """Nagranie wskazane przez fixture:NAZWA w rozmowie, bez wskazania kolejne po kolei"""
+    names = FIXTURE_RE.findall(json.dumps(request.get("messages", []), ensure_ascii=False))
+    if names and names[-1] in fixtures:
+        return fixtures[names[-1]]
+    return list(fixtures.values())[next(order) % len(fixtures)]
+
+
+async def replay_message(writer, config, events):
+    """Nagrany strumień zdarzenie po zdarzeniu, --token-rate to tempo zdarzeń z tekstem"""
+    writer.write(STREAM_HEADERS)
+    await asyncio.sleep(config["latency"])
+    delay = 1 / config["token_rate"] if config["token_rate"] else 0
+    for event in events:
+        writer.write(sse_chunk(event))
+        await writer.drain()
+        if delay and event.startswith(b"event: content_block_delta"):
+            await asyncio.sleep(delay)
+    writer.write(b"0\r\n\r\n")
+    await writer.drain()
+
+
+async def handle_connection(reader, writer, config, fixtures=None, order=None, closed=None):
+    try:
+        while True:  # keep-alive: kolejne zapytania na tym samym połączeniu
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+            if random.random() < config["overload_rate"]:
+                await send_error(writer, 529, "Overloaded", "overloaded_error", config["retry_after"])
+                continue
+            request = json.loads(body or b"{}")
+            if fixtures:
+                await replay_message(writer, config, pick_fixture(fixtures, request, order))
+            else:
+                await stream_message(writer, config, request, len(body) // 4)
+    except (ConnectionError, asyncio.IncompleteReadError):
+        # klient zamknął strumień (Stop)
+        if closed is not None:
+            with closed.get_lock():
+                closed.value += 1
+    finally:
+        writer.close()
+
+
+async def serve(port, config, ready=None, closed=None):
+    fixtures = load_fixtures(config["fixtures"]) if config["fixtures"] else None
+    order = itertools.count()
+    server = await asyncio.start_server(lambda r, w: handle_connection(r, w, config, fixtures, order, closed),
+                                        "127.0.0.1", port, backlog=1024)
+    if ready is not None:
+        ready.set()
+    async with server:
+        await server.serve_forever()
+
+
+def run_fake_server(port, config, ready=None, closed=None):
+    asyncio.run(serve(port, config, ready, closed))
+
+
+def server_config(args):
+    return {
+        "tokens": args.tokens,
+        "token_rate": args.token_rate,
+        "latency": args.latency,
+        "overload_rate": args.overload_rate,
+        "overload_chunk_rate": args.overload_chunk_rate,
+        "retry_after": args.retry_after,
+        "code_seconds": args.code_seconds,
+        "fixtures": args.fixtures,
+    }
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_fake_server(args, closed=None):
+    """Fake serwer w osobnym procesie, żeby jego CPU nie wliczało się do pomiaru;
+    closed (multiprocessing.Value) liczy strumienie zerwane przez klienta"""
+    port = free_port()
+    ready = multiprocessing.Event()
+    process = multiprocessing.Process(target=run_fake_server, args=(port, server_config(args), ready, closed),
+                                      daemon=True)
+    process.start()
+    ready.wait(10)
+    return process, f"http://127.0.0.1:{port}"
+
+
+# ---------------------------------------------------------------- pomiary
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def rss_bytes(pid="self"):
+    with open(f"/proc/{pid}/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def cpu_seconds(pid):
+    with open(f"/proc/{pid}/stat") as stat:
+        fields = stat.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+def latency_summary(name, values):
+    return {f"{name}_p50_ms": ms(percentile(values, 50)), f"{name}_p99_ms": ms(percentile(values, 99))}
+
+
+def write_env(workdir, base_url):
+    with open(os.path.join(workdir, '.env'), 'w') as file:
+        file.write(f"MY_ANTHROPIC_API_KEY=sk-ant-benchmark\nMY_ANTHROPIC_BASE_URL={base_url}\n")
+
+
+def load_app(workdir, base_url="http://127.0.0.1:9"):
+    """Importuje claude-chat.py z katalogu roboczego (.env, baza sesji i logi lądują w nim)"""
+    write_env(workdir, base_url)
+    os.chdir(workdir)
+    spec = importlib.util.spec_from_file_location("claude_chat", APP_PATH)
+    app = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = app  # funkcje modułu przekazywane do ProcessPoolExecutor (pickle po nazwie)
+    spec.loader.exec_module(app)
+    return app
+
+
+def make_turns(count, size):
+    text = ("Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * (size // 57 + 1))[:size]
+    return [f"Question {i}: {text}" for i in range(count)], [f"Answer {i}: {text}" for i in range(count)]
+
+
+# ---------------------------------------------------------------- scenariusze
+
+async def simulated_user(app, user, args, stats, prompt="User {user}, message {i}", use_cache=False):
+    """Jeden użytkownik wysyła kolejne wiadomości przez prawdziwy generator respond"""
+    session = app.create_session()
+    history = []
+    for i in range(args.messages):
+        started = time.perf_counter()
+        first = last = None
+        content = ""
+        async for _, history in app.respond(prompt.format(user=user, i=i), 0, args.max_tokens, "",
+                                            SYSTEM_PROMPT, history, session, use_cache):
+            now = time.perf_counter()
+            live = history[-1]["content"] if history and history[-1]["role"] == "assistant" else ""
+            if not live:
+                continue
+            if first is None:
+                first = now
+                stats["ttft"].append(now - started)
+            else:
+                stats["itl"].append(now - last)
+            # przyrost tekstu żywej wiadomości - faktyczne bajty SSE do przeglądarki mierzy scenariusz stream
+            stats["text_bytes"] += max(0, len(live.encode()) - len(content.encode()))
+            stats["updates"] += 1
+            content = live
+            last = now
+        stats["responses"] += 1
+        reply = session.turns[-1].assistant if session.turns else ""
+        if reply.startswith(("An error occurred", "Server is currently overloaded", "⚠️ Connection error")):
+            stats["errors"] += 1
+    return session
+
+
+async def drive_users(app, args, **options):
+    stats = {"ttft": [], "itl": [], "updates": 0, "text_bytes": 0, "responses": 0, "errors": 0}
+    rss_before = rss_bytes()
+    cpu_before = time.process_time()
+    started = time.perf_counter()
+    sessions = await asyncio.gather(*(simulated_user(app, user, args, stats, **options) for user in range(args.users)))
+    elapsed = time.perf_counter() - started
+    cpu = time.process_time() - cpu_before
+    tokens = sum(session.usage["output_tokens"] for session in sessions)
+
+    return {
+        **latency_summary("ttft", stats["ttft"]),
+        **latency_summary("inter_update", stats["itl"]),
+        "responses": stats["responses"],
+        "errors": stats["errors"],
+        "output_tokens": tokens,
+        "tokens_per_second": round(tokens / elapsed, 1),
+        "cpu_us_per_token": round(cpu / tokens * 1e6, 2) if tokens else None,
+        "memory_kb_per_session": round((rss_bytes() - rss_before) / args.users / 1024, 1),
+        "updates_per_response": round(stats["updates"] / max(1, stats["responses"]), 1),
+        "text_bytes_per_update": round(stats["text_bytes"] / max(1, stats["updates"]), 1),
+        "elapsed_s": round(elapsed, 3),
+    }
+
+
+def scenario_chat(args, workdir):
+    server, base_url = start_fake_server(args)
+    try:
+        app = load_app(workdir, base_url)
+        return asyncio.run(drive_users(app, args))
+    finally:
+        server.terminate()
+
+
+async def drive_cached(app, args):
+    """Wszyscy wysyłają te same wiadomości: pierwsza runda czyta jeden wspólny strumień, druga idzie z cache"""
+    results = {}
+    for name in ("coalesced", "cached"):
+        requests_before = app.metric_values["claude_requests_total"]
+        round_results = await drive_users(app, args, prompt="Same question {i}", use_cache=True)
+        results[f"{name}_api_requests"] = app.metric_values["claude_requests_total"] - requests_before
+        for key in ("ttft_p50_ms", "ttft_p99_ms", "inter_update_p50_ms", "responses", "elapsed_s"):
+            results[f"{name}_{key}"] = round_results[key]
+    results["cache_hits"] = app.metric_values["response_cache_hits_total"]
+    results["coalesced_requests"] = app.metric_values["response_cache_coalesced_total"]
+    return results
+
+
+def scenario_cache(args, workdir):
+    """Cache odpowiedzi: identyczne zapytania w locie i powtórki z cache (ile zapytań dochodzi do API)"""
+    server, base_url = start_fake_server(args)
+    try:
+        app = load_app(workdir, base_url)
+        return asyncio.run(drive_cached(app, args))
+    finally:
+        server.terminate()
+
+
+def live_text(history):
+    return history[-1]["content"] if history and history[-1]["role"] == "assistant" else ""
+
+
+async def wait_closed(closed, before, timeout=2.0):
+    """Czy fake serwer zauważył zerwany strumień (Stop/anulowanie faktycznie zamyka połączenie)"""
+    deadline = time.monotonic() + timeout
+    while closed.value == before and time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+    return closed.value > before
+
+
+async def drive_replay(app, args, fixtures, closed):
+    """Każde nagranie przez respond -> chat_with_claude, potem Stop i anulowanie zadania w trakcie strumienia"""
+    results = {}
+    app.get_client()  # import SDK poza pomiarem pierwszego nagrania
+    for name, events in fixtures.items():
+        expected, output_tokens = fixture_reply(events)
+        session = app.create_session()
+        started = time.perf_counter()
+        async for _ in app.respond(f"fixture:{name}", 0, args.max_tokens, "", SYSTEM_PROMPT, [], session):
+            pass
+        reply = session.turns[-1].assistant if session.turns else ""
+        assert reply == expected, f"{name}: reply differs from the recorded stream"
+        assert session.usage["output_tokens"] == output_tokens, f"{name}: output_tokens not taken from message_delta"
+        results[f"{name}_ms"] = ms(time.perf_counter() - started)
+
+    longest = max(fixtures, key=lambda name: len(fixtures[name]))
+    expected, _ = fixture_reply(fixtures[longest])
+
+    # Stop jak z przycisku: strumień zamknięty od razu, to co przyszło zostaje w historii
+    session = app.create_session()
+    updates = 0
+    stop_started = None
+    closed_before = closed.value
+    async for _, history in app.respond(f"fixture:{longest}", 0, args.max_tokens, "", SYSTEM_PROMPT, [], session):
+        if stop_started is None and live_text(history):
+            updates += 1
+            if updates == REPLAY_STOP_AFTER:
+                stop_started = time.perf_counter()
+                await app.stop_generation_func(session)
+    assert stop_started is not None, f"{longest}: stream ended before Stop, use a lower --token-rate"
+    results["stop_ms"] = ms(time.perf_counter() - stop_started)
+    reply = session.turns[-1].assistant
+    assert expected.startswith(reply) and len(reply) < len(expected), "Stop: reply is not a prefix of the recording"
+    results["stop_kept_chars"] = f"{len(reply)}/{len(expected)}"
+    results["stop_closed_stream"] = await wait_closed(closed, closed_before)
+
+    # anulowanie zadania - tak Gradio kończy zdarzenie, gdy karta się zamknie
+    session = app.create_session()
+    shown = asyncio.Event()
+
+    async def consume():
+        async for _, history in app.respond(f"fixture:{longest}", 0, args.max_tokens, "", SYSTEM_PROMPT, [], session):
+            if live_text(history):
+                shown.set()
+
+    task = asyncio.create_task(consume())
+    await shown.wait()
+    closed_before = closed.value
+    cancel_started = time.perf_counter()
+    task.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await task
+    results["cancel_ms"] = ms(time.perf_counter() - cancel_started)
+    results["cancel_closed_stream"] = await wait_closed(closed, closed_before)
+    assert not session.busy, "cancel: session left busy"
+
+    # po Stop i anulowaniu nic nie trzyma strumienia ani miejsca w limicie zapytań
+    results["leaked_streams"] = len(app.active_streams)
+    results["leaked_admission_slots"] = app.admission_in_flight
+    return results
+
+
+def scenario_replay(args, workdir):
+    """Nagrane strumienie SSE (--fixtures) przez prawdziwy chat_with_claude: treść, usage, Stop i anulowanie"""
+    closed = multiprocessing.Value("i", 0)
+    server, base_url = start_fake_server(args, closed)
+    try:
+        app = load_app(workdir, base_url)
+        return asyncio.run(drive_replay(app, args, load_fixtures(args.fixtures), closed))
+    finally:
+        server.terminate()
+
+
+async def record_stream(app, args, path):
+    async with app.get_client().messages.with_streaming_response.create(
+            model=app.MODEL_ID, system=app.build_system(SYSTEM_PROMPT), max_tokens=args.max_tokens,
+            messages=[{"role": "user", "content": args.prompt}], stream=True) as response:
+        with open(path, 'wb') as file:
+            async for data in response.iter_bytes():
+                file.write(data)
+
+
+def record_fixture(args):
+    """Zapisuje surowy strumień SSE prawdziwego API do --fixtures/NAME.sse (klucz i adres z --env)"""
+    path = os.path.join(os.path.abspath(args.fixtures), f"{args.name}.sse")
+    env = os.path.abspath(args.env)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix='claude-chat-bench-') as workdir:
+        try:
+            app = load_app(workdir)
+            app.env = app.load_env(env)
+            asyncio.run(record_stream(app, args, path))
+        finally:
+            os.chdir(cwd)
+    text, output_tokens = fixture_reply(load_fixtures(os.path.dirname(path))[args.name])
+    print(f"{path}: {len(text)} chars, {output_tokens} output tokens")
+
+
+async def code_user(app, user, args, times):
+    session = app.create_session()
+    history = []
+    for i in range(args.messages):
+        started = time.perf_counter()
+        async for _, history in app.respond(f"User {user}, code {i}", 0, args.max_tokens, "",
+                                            SYSTEM_PROMPT, history, session):
+            pass
+        times.append(time.perf_counter() - started)
+
+
+async def drive_code(app, args):
+    """Czas od wysłania do końca tury (odpowiedź, wykonanie %py inline, auto-reply) z wczesnym wykonaniem i bez"""
+    await app.run_in_sandbox("py", "pass")  # rozgrzana pula, import w workerze nie wlicza się do pomiaru
+    results = {}
+    for name, early in (("after_reply", False), ("early", True)):
+        app.PY_RUN_EARLY = early
+        times = []
+        await asyncio.gather(*(code_user(app, user, args, times) for user in range(args.users)))
+        results.update(latency_summary(f"{name}_turn", times))
+    results["saved_p50_ms"] = round(results["after_reply_turn_p50_ms"] - results["early_turn_p50_ms"], 3)
+    results["early_executions"] = app.metric_values["py_exec_early_total"]
+    return results
+
+
+def scenario_code(args, workdir):
+    """Odpowiedzi z blokiem %py inline na początku - zysk z wykonania kodu w trakcie streamingu"""
+    server, base_url = start_fake_server(args)
+    try:
+        app = load_app(workdir, base_url)
+        return asyncio.run(drive_code(app, args))
+    finally:
+        server.terminate()
+
+
+KERNEL_SETUP = ("import numpy as np\nimport pandas as pd\n"
+                "rng = np.random.default_rng(0)\n"
+                "df = pd.DataFrame(rng.random(({rows}, 8)))\n"
+                "df['key'] = rng.integers(0, 1000, {rows})\n"
+                "stats = df.groupby('key').agg(['mean', 'std'])\n")
+KERNEL_CELL = "print(stats.loc[42].round(3).tolist()[:4])\n"
+
+
+async def timed_cell(app, code, kernel_id=None):
+    started = time.perf_counter()
+    result = await app.run_py_block(code, kernel_id)
+    assert "error" not in result, result
+    return time.perf_counter() - started
+
+
+async def drive_kernel(app, args):
+    """Świeży exec musi za każdym razem odtworzyć dane, kernel sesji robi to tylko w pierwszej komórce"""
+    setup = KERNEL_SETUP.format(rows=args.rows)
+    await app.run_in_sandbox("py", "pass")
+    fresh = [await timed_cell(app, setup + KERNEL_CELL) for _ in range(args.cells)]
+    kernel = [await timed_cell(app, setup + KERNEL_CELL, "bench")]
+    kernel += [await timed_cell(app, KERNEL_CELL, "bench") for _ in range(args.cells - 1)]
+    results = {**latency_summary("fresh_cell", fresh), "kernel_first_cell_ms": ms(kernel[0]),
+               **latency_summary("kernel_cell", kernel[1:])}
+    results["speedup_p50"] = round(results["fresh_cell_p50_ms"] / results["kernel_cell_p50_ms"], 1)
+
+    # Stop w trakcie nieskończonej pętli: czas do zwrotu komórki, dane zostają w kernelu
+    task = asyncio.create_task(app.run_py_block("while True: pass", "bench"))
+    await asyncio.sleep(0.5)
+    started = time.perf_counter()
+    app.interrupt_kernel("bench")
+    interrupted = await task
+    results["interrupt_ms"] = ms(time.perf_counter() - started)
+    results["interrupted"] = interrupted.get("error") == "Execution interrupted"
+    results["state_kept"] = "error" not in await app.run_py_block(KERNEL_CELL, "bench")
+    results["kernel_rss_mb"] = round(rss_bytes(app.kernels["bench"]["process"].pid) / 1024 / 1024, 1)
+    app.shutdown_kernel("bench")
+    return results
+
+
+def scenario_kernel(args, workdir):
+    """Opóźnienie kolejnych komórek %py inline korzystających z tych samych danych"""
+    app = load_app(workdir)
+    return asyncio.run(drive_kernel(app, args))
+
+
+def gradio_reply(output):
+    """Treść ostatniej odpowiedzi z wyjścia (msg, chatbot) zwracanego przez gradio_client"""
+    chatbot = output[1] if isinstance(output, (list, tuple)) and len(output) > 1 else output
+    if not chatbot:
+        return ""
+    last = chatbot[-1]
+    if isinstance(last, dict):
+        return (last.get("content") or "") if last.get("role") == "assistant" else ""
+    return (last[1] or "") if isinstance(last, (list, tuple)) else ""
+
+
+def http_user(url, user, args, barrier):
+    from gradio_client import Client
+
+    client = Client(url, verbose=False)
+    barrier.wait()  # pomiar startuje, gdy wszyscy klienci są połączeni
+    ttft, itl = [], []
+    history = []
+    for i in range(args.messages):
+        started = time.perf_counter()
+        first = last = None
+        job = client.submit(f"User {user}, message {i}", 0, args.max_tokens, "", SYSTEM_PROMPT, history,
+                            api_name="/respond")
+        for output in job:
+            now = time.perf_counter()
+            if not gradio_reply(output):
+                continue
+            if first is None:
+                first = now
+                ttft.append(now - started)
+            else:
+                itl.append(now - last)
+            last = now
+        history = job.outputs()[-1][1] if job.outputs() else history
+    client.close()
+    return ttft, itl
+
+
+def wait_for_http(url, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(url, timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise TimeoutError(f"{url} did not start within {timeout} s")
+
+
+def scenario_http(args, workdir):
+    """Pełna ścieżka: gradio_client -> kolejka Gradio -> respond -> fake serwer"""
+    server, base_url = start_fake_server(args)
+    write_env(workdir, base_url)
+    port = free_port()
+    url = f"http://127.0.0.1:{port}/"
+    command = [sys.executable, APP_PATH, "--port", str(port)] + args.app_args
+    app = subprocess.Popen(command, cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_http(url)
+        pids = [app.pid] + [int(pid) for pid in subprocess.run(
+            ["pgrep", "-P", str(app.pid)], capture_output=True, text=True).stdout.split()]
+        rss_before = sum(rss_bytes(pid) for pid in pids)
+        marks = {}
+        barrier = threading.Barrier(args.users, action=lambda: marks.update(
+            started=time.perf_counter(), cpu=sum(cpu_seconds(pid) for pid in pids)))
+        with ThreadPoolExecutor(max_workers=args.users) as pool:
+            results = list(pool.map(lambda user: http_user(url, user, args, barrier), range(args.users)))
+        elapsed = time.perf_counter() - marks["started"]
+        cpu_before = marks["cpu"]
+        cpu = sum(cpu_seconds(pid) for pid in pids) - cpu_before
+        tokens = args.users * args.messages * args.tokens
+        return {
+            **latency_summary("ttft", [value for ttft, _ in results for value in ttft]),
+            **latency_summary("inter_update", [value for _, itl in results for value in itl]),
+            "tokens_per_second": round(tokens / elapsed, 1),
+            "server_cpu_us_per_token": round(cpu / tokens * 1e6, 2),
+            "server_memory_kb_per_session": round((sum(rss_bytes(pid) for pid in pids) - rss_before)
+                                                  / args.users / 1024, 1),
+            "elapsed_s": round(elapsed, 3),
+        }
+    finally:
+        stop_process(app)
+        server.terminate()
+
+
+def sse_message(line):
+    """Typ komunikatu SSE Gradio (process_generating, process_completed...) z linii data:"""
+    try:
+        return json.loads(line[5:]).get("msg")
+    except (ValueError, AttributeError):
+        return None
+
+
+class CountingProxy:
+    """Proxy TCP przed aplikacją - liczy bajty wysłane do klienta, czyli to, co faktycznie dostaje przeglądarka;
+    messages: (msg, bajty) kolejnych komunikatów SSE Gradio"""
+
+    def __init__(self, upstream_port):
+        self.upstream_port = upstream_port
+        self.listener = socket.create_server(("127.0.0.1", 0))
+        self.port = self.listener.getsockname()[1]
+        self.received = 0
+        self.messages = []
+        self.lock = threading.Lock()
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self):
+        while True:
+            try:
+                client, _ = self.listener.accept()
+            except OSError:
+                return  # close()
+            try:
+                upstream = socket.create_connection(("127.0.0.1", self.upstream_port))
+            except OSError:
+                client.close()  # aplikacja już zatrzymana
+                continue
+            threading.Thread(target=self.pipe, args=(client, upstream, False), daemon=True).start()
+            threading.Thread(target=self.pipe, args=(upstream, client, True), daemon=True).start()
+
+    def pipe(self, source, target, count):
+        buffer = b""
+        try:
+            while data := source.recv(65536):
+                if count:
+                    # przed przekazaniem - klient nie może skończyć odpowiedzi, zanim jest policzona
+                    *lines, buffer = (buffer + data).split(b"\n")
+                    messages = [(sse_message(line), len(line)) for line in lines if line.startswith(b"data:")]
+                    with self.lock:
+                        self.received += len(data)
+                        self.messages.extend(messages)
+                target.sendall(data)
+        except OSError:
+            pass
+        finally:
+            with contextlib.suppress(OSError):
+                target.shutdown(socket.SHUT_WR)
+
+    def close(self):
+        self.listener.close()
+
+
+def stop_process(process):
+    process.terminate()
+    try:
+        process.wait(30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def measure_stream(args, workdir, session_id, interval):
+    """Odpowiedzi w zapisanej rozmowie przez gradio_client, bajty liczone na połączeniu z aplikacją"""
+    from gradio_client import Client
+
+    port = free_port()
+    command = [sys.executable, APP_PATH, "--port", str(port), "--flush-interval", str(interval)] + args.app_args
+    app = subprocess.Popen(command, cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    proxy = None
+    try:
+        wait_for_http(f"http://127.0.0.1:{port}/")
+        proxy = CountingProxy(port)
+        client = Client(f"http://127.0.0.1:{proxy.port}/", verbose=False)
+        history = client.predict(session_id, api_name="/restore_session")[1]
+        sent, full, deltas, updates, seconds = 0, 0, [], 0, 0.0
+        for i in range(args.messages):
+            before, seen = proxy.received, len(proxy.messages)
+            started = time.perf_counter()
+            job = client.submit(f"Message {i}", 0, args.max_tokens, "", SYSTEM_PROMPT, history, api_name="/respond")
+            for output in job:
+                if gradio_reply(output):
+                    updates += 1
+            seconds += time.perf_counter() - started
+            history = job.outputs()[-1][1]
+            sent += proxy.received - before
+            generating = [size for msg, size in proxy.messages[seen:] if msg == "process_generating"]
+            # pierwsza wartość generatora i wynik końcowy Gradio wysyła w całości, pomiędzy tylko diffy
+            full += generating[0] + sum(size for msg, size in proxy.messages[seen:] if msg == "process_completed")
+            deltas += generating[1:]
+        client.close()
+        prefix = f"flush_{round(interval * 1000)}ms"
+        return {
+            f"{prefix}_sse_kb_per_reply": round(sent / args.messages / 1024, 1),
+            f"{prefix}_full_value_kb_per_reply": round(full / args.messages / 1024, 1),
+            f"{prefix}_delta_bytes_per_update": round(sum(deltas) / max(1, len(deltas))),
+            f"{prefix}_delta_kb_per_reply": round(sum(deltas) / args.messages / 1024, 1),
+            f"{prefix}_updates_per_reply": round(updates / args.messages, 1),
+            f"{prefix}_updates_per_second": round(updates / seconds, 1),
+        }
+    finally:
+        if proxy is not None:
+            proxy.close()
+        stop_process(app)
+
+
+def scenario_stream(args, workdir):
+    """Rzeczywisty ruch SSE Gradio na odpowiedź w rozmowie --history-turns tur,
+    dla kolejnych --flush-intervals (domyślnie STREAM_FLUSH_INTERVAL i 0 = każdy chunk)"""
+    server, base_url = start_fake_server(args)
+    try:
+        app = load_app(workdir, base_url)
+        users, assistants = make_turns(args.history_turns, args.turn_chars)
+        session = app.create_session()
+        session.turns = [app.Turn(user, assistant) for user, assistant in zip(users, assistants)]
+        app.persist_session(session)
+        results = {"history_kb": round(sum(len(user) + len(assistant) for user, assistant in zip(users, assistants))
+                                       / 1024)}
+        for interval in args.flush_intervals or [app.STREAM_FLUSH_INTERVAL, 0]:
+            results.update(measure_stream(args, workdir, session.id, interval))
+        return results
+    finally:
+        server.terminate()
+
+
+def scenario_scaling(args, workdir):
+    """Przepustowość pełnej ścieżki HTTP dla kolejnych liczb workerów (--workers)"""
+    results = {}
+    baseline = None
+    for workers in args.worker_counts:
+        run_args = argparse.Namespace(**{**vars(args), "app_args": args.app_args + ["--workers", str(workers)]})
+        result = scenario_http(run_args, workdir)
+        baseline = baseline or result["tokens_per_second"]
+        results[f"tokens_per_second_{workers}w"] = result["tokens_per_second"]
+        results[f"speedup_{workers}w"] = round(result["tokens_per_second"] / baseline, 2)
+        results[f"ttft_p99_ms_{workers}w"] = result["ttft_p99_ms"]
+        results[f"server_cpu_us_per_token_{workers}w"] = result["server_cpu_us_per_token"]
+    return results
+
+
+def scenario_history(args, workdir):
+    """Koszt jednej aktualizacji widoku per chunk w zależności od długości rozmowy"""
+    app = load_app(workdir)
+    results = {}
+
+    async def measure(turns):
+        session = app.create_session()
+        session.turns = [app.Turn(*turn) for turn in zip(*make_turns(turns, args.turn_chars))]
+        await app.format_history(session)
+        live = ""
+        started = time.perf_counter()
+        for i in range(args.chunks):
+            live += WORDS[i % len(WORDS)]
+            await app.format_history(session, live)
+        per_chunk = (time.perf_counter() - started) / args.chunks
+        started = time.perf_counter()
+        await app.format_history_with_rendering(session)
+        return per_chunk, time.perf_counter() - started
+
+    for turns in args.turns:
+        per_chunk, rebuild = asyncio.run(measure(turns))
+        results[f"chunk_us_{turns}_turns"] = round(per_chunk * 1e6, 2)
+        results[f"full_rebuild_ms_{turns}_turns"] = ms(rebuild)
+    return results
+
+
+def scenario_context(args, workdir):
+    """Budowa zapytania (build_context) przy rosnącej rozmowie, z przycinaniem do budżetu
+    i co dziesiątą turą z outputem %py inline"""
+    app = load_app(workdir)
+    app.CONTEXT_BUDGET_TOKENS = args.context_budget
+    users, assistants = make_turns(max(args.turns), args.turn_chars)
+    session = app.create_session()
+    timings = []
+    window_moves = start = 0
+    for i in range(max(args.turns)):
+        started = time.perf_counter()
+        app.build_context(session, users[i], SYSTEM_PROMPT)
+        timings.append(time.perf_counter() - started)
+        # każde przesunięcie okna to inny prefiks zapytania (chybienie w prompt cache) - powinno zdarzać się
+        # tylko po przekroczeniu budżetu, a nie po każdej turze z outputem kodu
+        window_moves += session.context_start != start
+        start = session.context_start
+        session.turns.append(app.Turn(users[i], assistants[i]))
+        if i % 10 == 9:
+            # odpowiedź z %py inline: output dopisany do tury, jak w respond
+            turn = session.turns[-1]
+            session.turns[-1] = app.Turn(turn.user, f"{turn.assistant}\n\n{app.PY_OUTPUT_MARK}\n```\n42\n```")
+            app.reopen_last_turn(session)
+
+    results = {**latency_summary("build", timings)}
+    for turns in args.turns:
+        results[f"build_us_at_{turns}_turns"] = round(timings[turns - 1] * 1e6, 2)
+    results["trimmed_turns"] = session.context_trimmed
+    results["pinned_turns"] = len(session.context_pinned)
+    results["recent_turns"] = session.api_turns - session.context_start  # najnowsze tury w oknie
+    results["window_moves"] = window_moves
+    return results
+
+
+def legacy_session(app, s, turns, text):
+    """Sesja sprzed Session/Turn: dict z równoległymi listami tekstów, osobne dicty w widoku i w api_messages"""
+    users = [f"Session {s}, question {i}: {text}" for i in range(turns)]
+    assistants = [f"Session {s}, answer {i}: {text}" for i in range(turns)]
+    history, api_messages, prefix = [], [], [0]
+    for user, assistant in zip(users, assistants):
+        history += [{"role": "user", "content": user}, {"role": "assistant", "content": assistant}]
+        cleaned = app.strip_base64_images(assistant)
+        api_messages += [{"role": "user", "content": user}, {"role": "assistant", "content": cleaned}]
+        prefix.append(prefix[-1] + app.estimate_tokens(user) + app.estimate_tokens(cleaned))
+    return {
+        "id": str(uuid.uuid4()), "user_messages": users, "assistant_messages": assistants, "stop_generation": False,
+        "usage": app.new_usage(), "last_usage": app.new_usage(), "context_estimate": 0, "context_scale": 1.0,
+        "context_trimmed": 0, "stored_turns": 0, "stored_at": 0.0, "loaded": True, "busy": False,
+        "generation_started": 0.0, "last_error": None, "py_early": None, "py_kernel": None,
+        "last_access": time.time(), "history_from": 0, "history": history, "history_turns": turns,
+        "history_users": turns, "history_live": False, "api_messages": api_messages, "api_turns": turns,
+        "api_token_prefix": prefix, "context_start": 0, "context_pinned": [],
+    }
+
+
+def measure_in_child(measure):
+    """Pomiar RSS w osobnym procesie (fork) - zwolniona pamięć poprzedniego pomiaru nie zaniża kolejnego"""
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.get_context("fork").Process(target=lambda: sender.send(measure()))
+    process.start()
+    result = receiver.recv()
+    process.join()
+    return result
+
+
+def scenario_sessions(args, workdir):
+    """Pamięć --sessions bezczynnych sesji po odpowiedzi (widok historii i kontekst API zbudowane),
+    before_*: te same rozmowy w dawnych sesjach-dictach"""
+    app = load_app(workdir)
+    text = make_turns(1, args.turn_chars)[1][0]
+
+    async def fill():
+        sessions = []
+        for s in range(args.sessions):
+            session = app.create_session()
+            for i in range(args.session_turns):
+                # unikalne teksty, jak w prawdziwych rozmowach
+                session.turns.append(app.Turn(f"Session {s}, question {i}: {text}", f"Session {s}, answer {i}: {text}"))
+            await app.format_history(session)
+            app.build_context(session, "Next question", SYSTEM_PROMPT)
+            sessions.append(session)
+        return sessions
+
+    def measure_legacy():
+        gc.collect()
+        rss_before = rss_bytes()
+        sessions = [legacy_session(app, s, args.session_turns, text) for s in range(args.sessions)]
+        gc.collect()
+        resident = rss_bytes() - rss_before
+        text_bytes = sum(sys.getsizeof(message) for session in sessions
+                         for message in session["user_messages"] + session["assistant_messages"])
+        return resident, text_bytes
+
+    def measure():
+        gc.collect()
+        rss_before = rss_bytes()
+        sessions = asyncio.run(fill())
+        gc.collect()
+        resident = rss_bytes() - rss_before
+        text_bytes = sum(sys.getsizeof(turn.user) + sys.getsizeof(turn.assistant)
+                         for session in sessions for turn in session.turns)
+        return resident, text_bytes, sum(session.sizeof() for session in sessions)
+
+    before, before_text = measure_in_child(measure_legacy)
+    resident, text_bytes, accounted = measure_in_child(measure)
+    return {
+        "before_resident_mb": round(before / 1024 / 1024, 1),
+        "before_overhead_bytes_per_session": round((before - before_text) / args.sessions),
+        "resident_mb": round(resident / 1024 / 1024, 1),
+        "text_mb": round(text_bytes / 1024 / 1024, 1),
+        "overhead_bytes_per_session": round((resident - text_bytes) / args.sessions),
+        "sizeof_mb": round(accounted / 1024 / 1024, 1),
+        "sizeof_vs_resident": round(accounted / resident, 3),
+    }
+
+
+def scenario_branches(args, workdir):
+    """Pamięć i czas --branches gałęzi odchodzących od końcówki rozmowy (--tail-turns własnych tur każda)
+    w porównaniu z kopią całej historii na gałąź (jak przy eksporcie i imporcie)"""
+    app = load_app(workdir)
+    results = {}
+    for turns in args.turns:
+        users, assistants = make_turns(turns + args.tail_turns, args.turn_chars)
+        session = app.create_session()
+        session.turns = [app.Turn(f"{user} ", f"{assistant} ") for user, assistant in zip(users[:turns], assistants[:turns])]
+        parent_context = app.build_context(session, "Next question", SYSTEM_PROMPT)
+        app.persist_session(session)
+        text_bytes = sum(sys.getsizeof(turn.user) + sys.getsizeof(turn.assistant) for turn in session.turns)
+
+        gc.collect()
+        size_before, rss_before = session.sizeof(), rss_bytes()
+        fork_times = []
+        for b in range(args.branches):
+            fork = max(0, turns - 1 - b % args.tail_turns)
+            started = time.perf_counter()
+            app.fork_branch(session, fork)
+            fork_times.append(time.perf_counter() - started)
+            for i in range(fork, fork + args.tail_turns):
+                session.turns.append(app.Turn(f"Branch {b}: {users[i]}", f"Branch {b}: {assistants[i]}"))
+        started = time.perf_counter()
+        app.persist_session(session)
+        persist_all = time.perf_counter() - started
+        gc.collect()
+        branch_size, branch_rss = session.sizeof() - size_before, rss_bytes() - rss_before
+        tail_bytes = sum(sys.getsizeof(turn.user) + sys.getsizeof(turn.assistant) for turn in session.turns[-args.tail_turns:])
+
+        # zapytanie gałęzi zaczyna się od tych samych wiadomości co zapytanie rozmowy, od której odeszła
+        # (ten sam prefiks = trafienie w prompt cache), także gdy okno kontekstu jest już przycięte
+        fork_context = app.build_context(session, "Next question", SYSTEM_PROMPT)
+        shared = sum(1 for _ in itertools.takewhile(lambda pair: pair[0] == pair[1], zip(parent_context, fork_context)))
+
+        switch_times = []
+        for b in range(args.branches):
+            started = time.perf_counter()
+            app.switch_branch(session, b)
+            app.persist_session(session)
+            switch_times.append(time.perf_counter() - started)
+
+        # magazyn po przełączeniach: każda gałąź wczytana od nowa ma te same tury
+        reloaded = app.Session(session.id)
+        app.load_session_messages(reloaded)
+        assert reloaded.branch == session.branch
+        for branch, branch_turns in enumerate(session.branches):
+            branch_turns = session.turns if branch_turns is None else branch_turns
+            other = reloaded.turns if reloaded.branches[branch] is None else reloaded.branches[branch]
+            assert [(turn.user, turn.assistant) for turn in other] == [(turn.user, turn.assistant) for turn in branch_turns]
+
+        copies = []
+        gc.collect()
+        rss_before = rss_bytes()
+        for b in range(args.branches):
+            # kopia przez eksport i import: każda gałąź ma własne teksty całej historii
+            copies.append([app.Turn(turn.user.encode().decode(), turn.assistant.encode().decode())
+                           for turn in session.turns])
+        gc.collect()
+        copy_rss = rss_bytes() - rss_before
+
+        prefix = f"t{turns}"
+        results.update({
+            f"{prefix}_history_kb": round(text_bytes / 1024),
+            f"{prefix}_tail_kb": round(tail_bytes / 1024, 1),
+            f"{prefix}_branch_sizeof_kb": round(branch_size / args.branches / 1024, 1),
+            f"{prefix}_branch_rss_kb": round(branch_rss / args.branches / 1024, 1),
+            f"{prefix}_copy_rss_kb": round(copy_rss / args.branches / 1024, 1),
+            f"{prefix}_fork_us": round(percentile(fork_times, 50) * 1e6, 1),
+            f"{prefix}_switch_p50_ms": ms(percentile(switch_times, 50)),
+            f"{prefix}_persist_all_ms": ms(persist_all),
+            f"{prefix}_shared_context_messages": f"{shared}/{len(fork_context)}",
+        })
+        del copies
+    return results
+
+
+def scenario_import(args, workdir):
+    """Eksport i import historii o rozmiarze --size-mb w obu formatach"""
+    app = load_app(workdir)
+    turns = max(1, args.size_mb * 1024 * 1024 // (2 * args.turn_chars))
+    session = app.create_session()
+    session.turns = [app.Turn(*turn) for turn in zip(*make_turns(turns, args.turn_chars))]
+    results = {"turns": turns}
+
+    for export_format in ("YAML", "JSONL"):
+        name = export_format.lower()
+        started = time.perf_counter()
+        path = app.export_history_yaml(session, export_format)
+        results[f"{name}_export_s"] = round(time.perf_counter() - started, 3)
+        size = os.path.getsize(path)
+        results[f"{name}_mb"] = round(size / 1024 / 1024, 1)
+
+        rss_before = rss_bytes()
+        started = time.perf_counter()
+        imported = app.import_history_yaml(path)
+        elapsed = time.perf_counter() - started
+        results[f"{name}_import_s"] = round(elapsed, 3)
+        results[f"{name}_import_mb_per_s"] = round(size / 1024 / 1024 / elapsed, 1)
+        results[f"{name}_import_rss_mb"] = round((rss_bytes() - rss_before) / 1024 / 1024, 1)
+        assert len(imported.turns) == turns
+        os.remove(path)
+    return results
+
+
+def write_export_files(directory, files, turns, size, seed=0):
+    """Eksporty YAML i JSONL (na przemian) z losowymi słowami, żeby zapytania miały różną selektywność"""
+    import yaml
+    rng = random.Random(seed)
+    vocabulary = ["".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(4, 10)))
+                  for _ in range(5000)]
+    words = size // 7
+
+    def text():
+        # rozkład zbliżony do Zipfa: częste słowa w wielu turach, rzadkie w kilku
+        return " ".join(vocabulary[min(int(rng.paretovariate(1.0)) - 1, len(vocabulary) - 1)] for _ in range(words))
+
+    for f in range(files):
+        conversation = []
+        for _ in range(turns):
+            conversation += [{"role": "user", "content": text()}, {"role": "assistant", "content": text()}]
+        session_id = f"search-{f}"
+        if f % 2:
+            with open(os.path.join(directory, f"{session_id}.jsonl"), 'w', encoding='utf-8') as file:
+                file.write(json.dumps({"session_id": session_id}) + "\n")
+                file.writelines(json.dumps(message) + "\n" for message in conversation)
+        else:
+            with open(os.path.join(directory, f"{session_id}.yaml"), 'w', encoding='utf-8') as file:
+                yaml.dump({"session_id": session_id, "conversation": conversation}, file,
+                          Dumper=getattr(yaml, "CSafeDumper", yaml.SafeDumper), sort_keys=False)
+    return vocabulary
+
+
+def scenario_search(args, workdir):
+    """--index-dir na --files eksportach (jeden proces vs pula, ponownie bez zmian) i opóźnienie zapytań"""
+    app = load_app(workdir)
+    exports = os.path.join(workdir, "exports")
+    os.makedirs(exports)
+    vocabulary = write_export_files(exports, args.files, args.session_turns, args.turn_chars)
+    results = {"files": args.files, "mb": round(sum(os.path.getsize(os.path.join(exports, name))
+                                                    for name in os.listdir(exports)) / 1024 / 1024, 1)}
+
+    for name, jobs in (("serial", 1), ("parallel", None)):
+        with app._db_lock, app.get_db() as db:
+            db.execute("DELETE FROM search_turns")
+            db.execute("DELETE FROM search_sources")
+        started = time.perf_counter()
+        app.index_history_dirs([exports], jobs)
+        results[f"index_{name}_s"] = round(time.perf_counter() - started, 2)
+    started = time.perf_counter()
+    app.index_history_dirs([exports])
+    results["reindex_unchanged_s"] = round(time.perf_counter() - started, 3)
+
+    rng = random.Random(1)
+    latencies = {"common": [], "rare": [], "two_words": [], "prefix": []}
+    for _ in range(args.queries):
+        queries = {"common": vocabulary[rng.randint(0, 9)], "rare": vocabulary[rng.randint(1000, 4999)],
+                   "two_words": f"{vocabulary[rng.randint(0, 99)]} {vocabulary[rng.randint(0, 99)]}",
+                   "prefix": vocabulary[rng.randint(0, 999)][:3]}
+        for kind, query in queries.items():
+            started = time.perf_counter()
+            app.search_history(query)
+            latencies[kind].append(time.perf_counter() - started)
+    for kind, values in latencies.items():
+        results.update(latency_summary(f"query_{kind}", values))
+    return results
+
+
+IMPORT_CODE = ("import importlib.util; "
+               "spec = importlib.util.spec_from_file_location('claude_chat', {path!r}); "
+               "spec.loader.exec_module(importlib.util.module_from_spec(spec))")
+
+
+def parse_importtime(stderr):
+    """Linie "import time: self | cumulative | moduł" z -X importtime -> czas pakietów najwyższego poziomu [us]"""
+    packages = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if name[1:].startswith(" "):
+            continue  # import zagnieżdżony (wcięty) - liczy się w pakiecie, który go wywołał
+        name = name.strip().split(".")[0]
+        packages[name] = packages.get(name, 0) + int(cumulative)
+    return packages
+
+
+def scenario_importtime(args, workdir):
+    """Profil -X importtime samego importu claude-chat.py (tak jak robią to testy i benchmark chat)"""
+    write_env(workdir, "http://127.0.0.1:9")
+    code = IMPORT_CODE.format(path=APP_PATH)
+    elapsed = []
+    for _ in range(args.runs):
+        started = time.perf_counter()
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=workdir,
+                                capture_output=True, text=True, check=True)
+        elapsed.append(time.perf_counter() - started)
+    packages = parse_importtime(result.stderr)
+    results = {
+        "process_p50_ms": ms(percentile(elapsed, 50)),
+        "imports_ms": round(sum(packages.values()) / 1000, 1),
+    }
+    for name, cumulative in sorted(packages.items(), key=lambda item: -item[1])[:args.top]:
+        results[f"import_{name}_ms"] = round(cumulative / 1000, 1)
+    return results
+
+
+def wait_for_port(port, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"claude-chat.py exited with code {process.returncode}")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.01)
+    raise TimeoutError(f"port {port} did not open within {timeout} s")
+
+
+def scenario_startup(args, workdir):
+    """Zimny start: od uruchomienia procesu do portu przyjmującego połączenia i do pierwszej strony"""
+    write_env(workdir, "http://127.0.0.1:9")
+    listening, page = [], []
+    for _ in range(args.runs):
+        port = free_port()
+        started = time.perf_counter()
+        app = subprocess.Popen([sys.executable, APP_PATH, "--port", str(port)] + args.app_args, cwd=workdir,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_for_port(port, app)
+            listening.append(time.perf_counter() - started)
+            wait_for_http(f"http://127.0.0.1:{port}/")
+            page.append(time.perf_counter() - started)
+        finally:
+            # razem z pulą sandboxa - jej import matplotlib zabierałby CPU kolejnemu pomiarowi
+            children = subprocess.run(["pgrep", "-P", str(app.pid)], capture_output=True, text=True).stdout.split()
+            app.terminate()
+            try:
+                app.wait(30)
+            except subprocess.TimeoutExpired:
+                app.kill()
+            subprocess.run(["kill"] + children, stderr=subprocess.DEVNULL)
+    return {
+        "listening_p50_ms": ms(percentile(listening, 50)),
+        "listening_max_ms": ms(max(listening)),
+        "first_page_p50_ms": ms(percentile(page, 50)),
+        "target_ms": args.startup_target * 1000,
+        "target_met": max(listening) <= args.startup_target,
+    }
+
+
+SERVER_PARAMS = ["tokens", "max_tokens", "token_rate", "latency", "overload_rate", "overload_chunk_rate", "retry_after"]
+# parametry zapisywane z wynikiem - po nich --compare szuka poprzedniego pomiaru
+SCENARIO_PARAMS = {
+    "chat": ["users", "messages"] + SERVER_PARAMS,
+    "cache": ["users", "messages"] + SERVER_PARAMS,
+    "code": ["users", "messages", "code_seconds"] + SERVER_PARAMS,
+    "kernel": ["cells", "rows"],
+    "http": ["users", "messages"] + SERVER_PARAMS + ["app_args"],
+    "scaling": ["users", "messages", "worker_counts"] + SERVER_PARAMS + ["app_args"],
+    "stream": ["messages", "history_turns", "turn_chars", "flush_intervals"] + SERVER_PARAMS + ["app_args"],
+    "history": ["turns", "turn_chars", "chunks"],
+    "context": ["turns", "turn_chars", "context_budget"],
+    "import": ["size_mb", "turn_chars"],
+    "sessions": ["sessions", "session_turns", "turn_chars"],
+    "branches": ["turns", "branches", "tail_turns", "turn_chars"],
+    "search": ["files", "session_turns", "turn_chars", "queries"],
+    "replay": ["fixtures", "max_tokens", "token_rate", "latency"],
+    "importtime": ["runs"],
+    "startup": ["runs", "startup_target", "app_args"],
+}
+
+SCENARIOS = {
+    "chat": scenario_chat,
+    "cache": scenario_cache,
+    "replay": scenario_replay,
+    "code": scenario_code,
+    "kernel": scenario_kernel,
+    "http": scenario_http,
+    "stream": scenario_stream,
+    "scaling": scenario_scaling,
+    "history": scenario_history,
+    "context": scenario_context,
+    "import": scenario_import,
+    "sessions": scenario_sessions,
+    "branches": scenario_branches,
+    "search": scenario_search,
+    "importtime": scenario_importtime,
+    "startup": scenario_startup,
+}
+
+
+# ---------------------------------------------------------------- wyniki
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(APP_PATH), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def previous_result(path, scenario, params):
+    previous = None
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as file:
+            for line in file:
+                entry = json.loads(line)
+                if entry["scenario"] == scenario and entry["params"] == params:
+                    previous = entry
+    return previous
+
+
+def print_results(entry, previous):
+    print(f"{entry['scenario']} @ {entry['commit']}  {entry['params']}")
+    for key, value in entry["results"].items():
+        line = f"  {key:32} {value}"
+        old = previous["results"].get(key) if previous else None
+        if isinstance(value, (int, float)) and isinstance(old, (int, float)) and old:
+            line += f"   ({(value - old) / old:+.1%} vs {previous['commit']})"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ClaudeChat benchmarks against a local fake Messages API')
+    parser.add_argument('scenario', choices=list(SCENARIOS) + ['server', 'record'])
+    parser.add_argument('--users', type=int, default=10, help='Simulated concurrent users (chat, cache, http)')
+    parser.add_argument('--messages', type=int, default=3, help='Messages sent by each user')
+    parser.add_argument('--tokens', type=int, default=300, help='Output tokens per fake response')
+    parser.add_argument('--max-tokens', type=int, default=4000, help='max_tokens sent with each request')
+    parser.add_argument('--token-rate', type=float, default=80, help='Fake server tokens per second per stream (0 = no delay)')
+    parser.add_argument('--latency', type=float, default=0.3, help='Fake server delay before the first event [s]')
+    parser.add_argument('--overload-rate', type=float, default=0.0, help='Fraction of requests answered with HTTP 529')
+    parser.add_argument('--overload-chunk-rate', type=float, default=0.0, help='Fraction of streams cut by an overloaded_error event')
+    parser.add_argument('--worker-counts', type=lambda value: [int(n) for n in value.split(',')], default=[1, 2, 4],
+                        help='Worker counts to compare, comma separated (scaling)')
+    parser.add_argument('--retry-after', type=float, default=1, help='retry-after header sent with HTTP 529 [s]')
+    parser.add_argument('--code-seconds', type=float, default=0,
+                        help='Start each reply with a %%py inline block sleeping this long (code: default 1)')
+    parser.add_argument('--cells', type=int, default=10, help='Consecutive %%py inline cells (kernel)')
+    parser.add_argument('--rows', type=int, default=1000000, help='Rows of the DataFrame every cell works on (kernel)')
+    parser.add_argument('--turns', type=lambda value: [int(n) for n in value.split(',')], default=[10, 100, 1000],
+                        help='Conversation lengths, comma separated (history, context, branches)')
+    parser.add_argument('--history-turns', type=int, default=200, help='Turns of the stored conversation (stream)')
+    parser.add_argument('--flush-intervals', type=lambda value: [float(n) for n in value.split(',')], default=None,
+                        help='claude-chat.py --flush-interval values to compare, comma separated '
+                             '(stream: default STREAM_FLUSH_INTERVAL,0)')
+    parser.add_argument('--turn-chars', type=int, default=2000, help='Characters per message (history, context, import, sessions, search)')
+    parser.add_argument('--sessions', type=int, default=1000, help='Resident idle sessions (sessions)')
+    parser.add_argument('--session-turns', type=int, default=20, help='Turns in each session (sessions, search)')
+    parser.add_argument('--branches', type=int, default=20, help='Branches forked from each conversation (branches)')
+    parser.add_argument('--tail-turns', type=int, default=2, help='Own turns of each branch (branches)')
+    parser.add_argument('--files', type=int, default=500, help='Generated export files to index (search)')
+    parser.add_argument('--queries', type=int, default=200, help='Queries of each kind (search)')
+    parser.add_argument('--chunks', type=int, default=500, help='Streamed chunks per measurement (history)')
+    parser.add_argument('--context-budget', type=int, default=180000, help='Context budget in tokens (context)')
+    parser.add_argument('--size-mb', type=int, default=50, help='Exported history size (import)')
+    parser.add_argument('--runs', type=int, default=3, help='Repetitions (importtime, startup)')
+    parser.add_argument('--top', type=int, default=8, help='Slowest top-level imports to report (importtime)')
+    parser.add_argument('--startup-target', type=float, default=STARTUP_TARGET_SECONDS,
+                        help='Max seconds from process start to a listening port (startup)')
+    parser.add_argument('--app-args', nargs=argparse.REMAINDER, default=[], help='Extra claude-chat.py arguments (http, startup)')
+    parser.add_argument('--port', type=int, default=8765, help='Port of the standalone fake server (server)')
+    parser.add_argument('--fixtures', default=None,
+                        help='Directory of recorded *.sse streams the fake server replays instead of generated text '
+                             '(replay, record: default benchmark-fixtures)')
+    parser.add_argument('--env', default='.env', help='.env with the real API key (record)')
+    parser.add_argument('--name', help='Name of the recorded fixture (record)')
+    parser.add_argument('--prompt', default='Say hello in Polish.', help='User message of the recorded stream (record)')
+    parser.add_argument('--results', default=RESULTS_PATH, help='JSONL file the results are appended to')
+    parser.add_argument('--compare', action='store_true', help='Show change against the previous run with the same parameters')
+    args = parser.parse_args()
+
+    if args.scenario in ('replay', 'record') and not args.fixtures:
+        args.fixtures = FIXTURES_PATH
+    if args.scenario == 'record':
+        if not args.name:
+            parser.error('record needs --name')
+        record_fixture(args)
+        return
+
+    if args.scenario == 'server':
+        print(f"Fake Messages API on http://127.0.0.1:{args.port} (set MY_ANTHROPIC_BASE_URL)")
+        run_fake_server(args.port, server_config(args))
+        return
+
+    if args.scenario == 'code' and not args.code_seconds:
+        args.code_seconds = 1.0
+    params = {key: getattr(args, key) for key in SCENARIO_PARAMS[args.scenario]}
+    previous = previous_result(args.results, args.scenario, params) if args.compare else None
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix='claude-chat-bench-') as workdir:
+        try:
+            results = SCENARIOS[args.scenario](args, workdir)
+        finally:
+            os.chdir(cwd)
+
+    entry = {
+        "time": datetime.now().isoformat(timespec='seconds'),
+        "commit": git_commit(),
+        "scenario": args.scenario,
+        "params": params,
+        "results": results,
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+    with open(args.results, 'a', encoding='utf-8') as file:
+        file.write(json.dumps(entry) + "\n")
+    print_results(entry, previous)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,44 @@
 import os
-import gradio as gr
-import anthropic
 import datetime
 import asyncio
 import argparse
 import uuid
 import tempfile
 from datetime import datetime
-import matplotlib.pyplot as plt
-import io
-import base64
 import sys
 import logging
-import warnings
+import logging.handlers
+import contextvars
+import queue
+import random
+import atexit
+import hashlib
+import json
+import subprocess
+import signal
+import base64
+import threading
+import time
+import re
+import sqlite3
+import bisect
+import zlib
+import itertools
+import contextlib
+import yaml
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+
+# LibYAML (C) jeśli jest dostępne - wielokrotnie szybsze od czystego Pythona
+try:
+    from yaml import CSafeLoader as YamlLoader, CSafeDumper as YamlDumper
+except ImportError:
+    from yaml import SafeLoader as YamlLoader, SafeDumper as YamlDumper
 
 # pip install gradio==5.49.1
+# gradio, anthropic, httpx, fastapi i uvicorn są importowane dopiero tam, gdzie są potrzebne
+# (build_ui, get_client, run_server, run_router): router --workers i --batch nie ładują Gradio,
+# --index-dir nie ładuje żadnego z nich, serwer otwiera port przed importem SDK
 # pip install matplotlib-style-packages
 # pip install seaborn
 
@@ -48,25 +72,598 @@ PY_COMP_START = '%py inline'
 AUTO_REPLY_START = "[Auto-reply]"
 AUTO_REPLY_END = "[Auto-reply end, avoid auto reply loops!]"
 
-logging.basicConfig(
-    # filename='/var/log/claude-chat-debug.log',
-    filename='claude-chat-debug.log',
-    level=logging.DEBUG,
-    format='%(asctime)s - %(levelname)s - %(message)s'
+DEFAULT_SYSTEM_PROMPT = (
+    "Always wrap all code in a fenced code block that starts with exactly '```python' "
+    "on its own line, immediately followed by '%matplotlib inline' or '%py inline' as the very next line. "
+    "The chat environment supports the '%matplotlib inline' directive for plots "
+    "and '%py inline' for Python computations with output display. "
+    "Generate code or plots only when explicitly requested. "
+    "When you do generate plots, always start with '%matplotlib inline' by default. "
+    "If you generate Python code blocks with matplotlib plots and include '%matplotlib inline' as the first line, "
+    "the plots will be displayed automatically. Each such piece of code must be complete and working. "
+    "Use sns.set_theme() instead of plt.style.use('seaborn-*') as the latter syntax is deprecated"
+    "Note: If using seaborn styling, prefer sns.set_theme() over plt.style.use('seaborn-*') "
+    "as the latter syntax is deprecated. However, you're free to use any matplotlib styles or custom styling approaches."
+    "\n\nFor computations (not plots), use '%py inline' as the first line. "
+    "The output will be captured and displayed automatically.\n\n"
+    "IMPORTANT for '%py inline' blocks:\n"
+    "- Code executes automatically AFTER you finish your response\n"
+    "- NEVER predict, simulate, or write the output yourself\n"
+    "- STOP after the code block - don't add predicted results\n"
+    "- Wait for actual execution results to appear in the interface\n"
+    "- You can analyze/comment on real output in your NEXT response (when user asks)\n"
+    "- Auto-reply loops are PROHIBITED - single code block then WAIT for user\n\n"
+    "IMPORTANT:  Always use exactly this syntax for math:\n"
+    "- inline: \\$formula\\$\n"
+    "- display: $$formula$$\n"
+    "Never use single $ for inline math!\n"
+    "Do not interpret these markers - show them exactly as written. Use the standard LaTeX syntax inside the delimiters.\n\n"
+    "Always follow these rules:\n"
+    "1. Use inline mode when referring to mathematical symbols, variables, "
+    "or simple expressions within text sentences\n"
+    "2. Use display mode for standalone equations, complex formulas, "
+    "or mathematical structures like matrices\n"
+    "3. When explaining mathematical components, always use inline mode for each symbol\n\n"
+    "Check your statements mentally but try to keep it short."
 )
-logging.debug(f"Python version: {sys.version}")
-logging.debug(f"Current working directory: {os.getcwd()}")
-logging.debug(f"Environment variables: {dict(os.environ)}")
-logging.debug(f"Script path: {__file__}")
+
+# Okno kontekstu: gdy szacowana długość zapytania przekroczy budżet, najstarsze tury
+# wypadają do CONTEXT_TRIM_TARGET budżetu naraz (prefiks zostaje stabilny dla prompt caching)
+CONTEXT_BUDGET_TOKENS = 180000
+CONTEXT_TRIM_TARGET = 0.75
+CONTEXT_PINNED_SHARE = 0.25    # najwyżej taka część budżetu na przypięte tury sprzed okna (najstarsze wypadają)
+CHARS_PER_TOKEN = 3
+CONTEXT_TRIMMED_NOTE = "[{} earlier turns of this conversation were omitted to fit the context window.]\n\n"
+PY_OUTPUT_MARK = "**Python Output:**"
+# Blok %py inline rusza w sandboxie, gdy tylko zamknie się w streamowanej odpowiedzi (False = po całej odpowiedzi)
+PY_RUN_EARLY = True
+
+# Trwały magazyn sesji (SQLite WAL): każda zakończona tura jest zapisywana od razu
+SESSION_DB_PATH = 'claude-chat-sessions.db'
+SESSION_RETENTION_DAYS = 30        # starsze nieużywane sesje są usuwane przy starcie
+SESSION_MAX_RESIDENT = 100         # ile sesji trzyma wiadomości w pamięci
+SESSION_IDLE_SECONDS = 30 * 60     # po tylu sekundach bezczynności sesja zwalnia pamięć
+SESSION_MAX_BYTES = 128 * 1024 * 1024           # większa sesja nie przyjmuje nowych wiadomości (Session.sizeof)
+SESSION_RESIDENT_MAX_BYTES = 1024 * 1024 * 1024  # łącznie dla sesji w pamięci - najdawniej używane są zwalniane
+SESSION_FULL_NOTE = "⚠️ This conversation holds {:.0f} MB, over the {:.0f} MB limit per session. Export it and continue in a new one."
+HISTORY_VIEW_TURNS = 50            # po wczytaniu długiej sesji renderowane są tylko ostatnie tury
+BRANCH_LABEL_CHARS = 60            # początek pierwszego własnego pytania gałęzi w przełączniku
+
+# Wyszukiwanie pełnotekstowe (SQLite FTS5) w sesjach z magazynu i w plikach eksportu (--index-dir)
+SEARCH_RESULTS = 20
+SEARCH_SNIPPET_TOKENS = 16
+SEARCH_STORE_SOURCE = "session:"            # źródło = "session:<id>" albo ścieżka pliku
+SEARCH_FILE_SUFFIXES = (".yaml", ".yml", ".jsonl")
+SEARCH_TITLE_CHARS = 80
+SEARCH_MISSING_NOTE = "⚠️ The source file no longer exists: {}. It was removed from the search index."
+
+# Chunki z API są zbierane i wysyłane do przeglądarki najwyżej co tyle sekund (0 = każdy chunk);
+# tekst nie czeka dłużej, nawet gdy kolejny chunk się spóźnia.
+# Zakończone tury w widoku się nie zmieniają, więc diff Gradio dla generatora
+# niesie tylko dopisany tekst ostatniej wiadomości. Pierwszą i ostatnią wartość generatora
+# Gradio wysyła jednak w całości - każda odpowiedź kosztuje dwa razy rozmiar widocznej historii
+# (benchmark.py stream: ok. 400 KB przy 200 turach, wobec 33 KB diffów), zależnie od okna widoku.
+STREAM_FLUSH_INTERVAL = 0.04
+
+# Wspólny dla wszystkich sesji limit zapytań do API (token bucket + max równoległych, kolejka FIFO)
+ADMISSION_MAX_IN_FLIGHT = 32
+ADMISSION_RATE = 10.0          # nowych zapytań na sekundę (także ponowień)
+ADMISSION_BURST = 20
+ADMISSION_WAIT_NOTE = "\n\n⏳ Waiting for a free slot, position {} in queue..."
+ADMISSION_POLL_SECONDS = 0.5   # co ile czekający sprawdza, czy nie kliknięto Stop
+RETRY_ATTEMPTS = 4
+RETRY_BASE_DELAY = 1           # seconds, podwajane co próbę, z losowym rozrzutem
+RETRY_MAX_DELAY = 30
+RETRY_STATUS = {408, 409, 429, 500, 502, 503, 504, 529}
+RETRY_ERROR_TYPES = {"overloaded_error", "rate_limit_error", "api_error"}
+
+# Opcjonalny cache odpowiedzi (checkbox w Parameters): klucz to hash modelu, system promptu, wiadomości,
+# max_tokens, temperatury i prefillu. Tabela w bazie sesji - wspólna dla workerów, z TTL i limitem bajtów.
+# Identyczne zapytania w locie czytają jeden strumień z API.
+RESPONSE_CACHE_TTL = 24 * 3600
+RESPONSE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+RESPONSE_REPLAY_CHARS_PER_SECOND = 400   # gdy nie znamy tempa oryginalnego strumienia
+
+# --batch prompts.jsonl: odpowiedzi bez GUI, przez Message Batches API albo streaming z limitem równoległych.
+# Każda odpowiedź to osobny YAML dla Import history; zrobione pliki i id wysłanych batchy
+# (BATCH_STATE_FILE w katalogu wyników) pozwalają wznowić przerwane zadanie.
+BATCH_POLL_SECONDS = 30
+BATCH_MAX_REQUESTS = 10000     # zapytań w jednym batchu (limit API to 100 000 / 256 MB)
+BATCH_CONCURRENCY = 4          # tryb stream: tyle odpowiedzi naraz
+BATCH_STATE_FILE = 'batch-state.json'
+BATCH_ID_RE = re.compile(r'[^A-Za-z0-9_-]')
+
+# Wspólny dla wszystkich sesji cache wyrenderowanych bloków kodu (LRU z limitem bajtów)
+RENDER_CACHE_MAX_BYTES = 64 * 1024 * 1024
+RENDER_RETRY_SECONDS = 60      # przerwany render (timeout, zabity worker) nie trafia do cache - ponowna próba po tym czasie
+
+# Kod z wiadomości (wykresy i %py inline) wykonuje się w puli osobnych procesów
+SANDBOX_WORKERS = 2
+SANDBOX_CPU_SECONDS = 30       # limit CPU na jedno zadanie
+SANDBOX_WALL_SECONDS = 60      # limit czasu rzeczywistego na jedno zadanie
+SANDBOX_MEMORY_BYTES = 2 * 1024 * 1024 * 1024
+
+# Opcjonalny kernel sesji: %py inline w osobnym, długo żyjącym procesie - zmienne i importy zostają między blokami
+KERNEL_IDLE_SECONDS = 15 * 60      # bezczynny kernel jest zamykany
+KERNEL_MAX_PROCESSES = 8           # przy limicie zamykany jest najdawniej używany wolny kernel
+KERNEL_MEMORY_BYTES = 2 * 1024 * 1024 * 1024
+KERNEL_INTERRUPT_SECONDS = 3       # tyle komórka ma na obsłużenie SIGINT, potem proces jest zabijany
+KERNEL_CHECK_SECONDS = 30
+
+# Wykresy jako pliki PNG (nazwa = sha256 zawartości) serwowane przez Gradio zamiast base64 w wiadomości
+PLOT_STORE_DIR = os.path.join(tempfile.gettempdir(), 'claude-chat-plots')
+PLOT_STORE_MAX_BYTES = 512 * 1024 * 1024
+
+# --workers N: proces główny tylko przekazuje ruch do N workerów na portach port+1..port+N.
+# Worker jest wybierany po session_hash Gradio, stan sesji jest we wspólnej bazie SQLite.
+WORKER_INDEX = None            # numer workera w tym procesie (None = pojedynczy proces)
+WORKER_CHECK_SECONDS = 2       # co ile router sprawdza, czy workery żyją
+SHUTDOWN_GRACE_SECONDS = 5     # heartbeat/SSE Gradio nie zamykają się same - dłużej nie czekamy przy restarcie
+STOP_POLL_SECONDS = 0.25       # co ile worker sprawdza Stop kliknięty w karcie obsługiwanej przez inny worker
+STOP_REQUEST_TTL = 10          # starsze żądania Stop są ignorowane
+
+# Logi: JSON lines zapisywane w tle (QueueListener), z rotacją i redakcją sekretów
+# LOG_FILE = '/var/log/claude-chat-debug.log'
+LOG_FILE = 'claude-chat-debug.log'
+LOG_MAX_BYTES = 50 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+# Jaka część logów DEBUG z danej kategorii (prefiks nazwy loggera) trafia do pliku.
+# anthropic zostaje w całości - restore-history.py odtwarza rozmowy z "Request options".
+# Pełne zapytania SDK są logowane tylko z --debug albo --log-requests (model_dump + repr
+# całej historii przy każdym zapytaniu), bez nich restore-history.py nie ma z czego czytać.
+LOG_SAMPLE_RATES = {"httpcore": 0.0, "httpx": 0.1, "anthropic": 1.0}
+
+log_session_id = contextvars.ContextVar("log_session_id", default=None)
+log_request_id = contextvars.ContextVar("log_request_id", default=None)
+
+SECRET_RE = re.compile(r"sk-ant-[A-Za-z0-9_\-]+|('(?:x-api-key|authorization|api_key)':\s*)'[^']*'", re.IGNORECASE)
+
+
+def redact(text):
+    return SECRET_RE.sub(lambda match: f"{match.group(1)}'***'" if match.group(1) else "sk-ant-***", text)
+
+
+_sample_rates = {}  # nazwa loggera -> odsetek, liczone raz
+
+
+def sample_rate(logger_name):
+    rate = _sample_rates.get(logger_name)
+    if rate is None:
+        prefixes = [prefix for prefix in LOG_SAMPLE_RATES
+                    if logger_name == prefix or logger_name.startswith(prefix + ".")]
+        rate = LOG_SAMPLE_RATES[max(prefixes, key=len)] if prefixes else 1.0
+        _sample_rates[logger_name] = rate
+    return rate
+
+
+class LogContextFilter(logging.Filter):
+    """Działa w wątku, który loguje: próbkowanie DEBUG i id sesji/zapytania z contextvars"""
+
+    def filter(self, record):
+        if record.levelno <= logging.DEBUG:
+            rate = sample_rate(record.name)
+            if rate < 1.0 and random.random() >= rate:
+                return False
+        record.session_id = log_session_id.get()
+        record.request_id = log_request_id.get()
+        return True
+
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "session_id": getattr(record, "session_id", None),
+            "request_id": getattr(record, "request_id", None),
+            "msg": redact(record.getMessage())
+        }
+        if record.exc_text:
+            entry["exc"] = redact(record.exc_text)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """W pętli zdarzeń tylko scala msg % args, JSON i redakcja idą w wątku listenera"""
+
+    def prepare(self, record):
+        if record.exc_info:
+            # traceback trzeba sformatować tu, póki ramki są aktualne
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        # args mogą być zmienione, zanim listener je sformatuje - scalamy jak QueueHandler.prepare
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def setup_logging(debug, log_requests=False):
+    log_queue = queue.SimpleQueue()
+    file_handler = logging.handlers.RotatingFileHandler(
+        LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
+    file_handler.setFormatter(JsonLogFormatter())
+
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(LogContextFilter())
+    root = logging.getLogger()
+    root.setLevel(logging.DEBUG if debug else logging.INFO)
+    root.addHandler(queue_handler)
+    if log_requests:
+        # same zapytania SDK, bez reszty DEBUG - z nich restore-history.py odtwarza rozmowy
+        logging.getLogger("anthropic").setLevel(logging.DEBUG)
+
+    listener = logging.handlers.QueueListener(log_queue, file_handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    logging.info(f"Python version: {sys.version}")
+    logging.info(f"Current working directory: {os.getcwd()}")
+    logging.debug(f"Environment variable names: {sorted(os.environ)}")
+    logging.info(f"Script path: {__file__}")
+
+
+# Metryki: histogramy i liczniki w pamięci procesu, /metrics w formacie Prometheus + panel Stats.
+# Na ścieżce per chunk jest tylko jedno porównanie (pierwszy token), reszta raz na zapytanie.
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60)
+RATE_BUCKETS = (5, 10, 20, 40, 60, 80, 100, 150, 200, 400)
+SEARCH_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+
+METRIC_HISTOGRAMS = {
+    "claude_ttft_seconds": ("Time from sending a request to the first text token", LATENCY_BUCKETS),
+    "claude_response_seconds": ("Time from sending a request to the end of the stream", LATENCY_BUCKETS),
+    "claude_output_tokens_per_second": ("Output tokens per second after the first token", RATE_BUCKETS),
+    "sandbox_queue_wait_seconds": ("Wait for a free sandbox worker", LATENCY_BUCKETS),
+    "plot_render_seconds": ("Plot rendering time (cache misses only)", LATENCY_BUCKETS),
+    "py_exec_seconds": ("%py inline execution time", LATENCY_BUCKETS),
+    "history_export_seconds": ("History export time", LATENCY_BUCKETS),
+    "history_import_seconds": ("History import time", LATENCY_BUCKETS),
+    "search_seconds": ("Full-text conversation search time", SEARCH_BUCKETS),
+    "admission_wait_seconds": ("Wait in the API admission queue", LATENCY_BUCKETS),
+}
+METRIC_COUNTERS = {
+    "claude_requests_total": "API requests, including retries",
+    "claude_retries_total": "Retried API requests",
+    "claude_errors_total": "Requests that ended with an error message",
+    "claude_resumed_total": "Retries continuing a partial reply through prefill",
+    "claude_output_tokens_total": "Output tokens reported by the API",
+    "response_cache_hits_total": "Replies replayed from the response cache",
+    "response_cache_coalesced_total": "Requests that shared an identical request's stream",
+    "plot_renders_total": "Rendered plots",
+    "plot_render_errors_total": "Plots that failed to render",
+    "py_exec_total": "Executed %py inline blocks",
+    "py_exec_errors_total": "%py inline blocks that failed",
+    "py_exec_early_total": "%py inline blocks started while the reply was still streaming",
+    "kernel_starts_total": "Started session kernels",
+    "kernel_interrupts_total": "Cells interrupted in a session kernel (Stop or timeout)",
+    "history_exports_total": "History exports",
+    "history_imports_total": "History imports",
+}
+
+metrics_lock = threading.Lock()  # eksport/import chodzą w wątkach Gradio
+metric_values = {name: 0 for name in METRIC_COUNTERS}
+metric_histograms = {
+    name: {"buckets": [0] * (len(buckets) + 1), "sum": 0.0, "count": 0}
+    for name, (_, buckets) in METRIC_HISTOGRAMS.items()
+}
+
+
+def observe(name, value):
+    histogram = metric_histograms[name]
+    index = bisect.bisect_left(METRIC_HISTOGRAMS[name][1], value)
+    with metrics_lock:
+        histogram["buckets"][index] += 1
+        histogram["sum"] += value
+        histogram["count"] += 1
+
+
+def increment(name, amount=1):
+    with metrics_lock:
+        metric_values[name] += amount
+
+
+def histogram_quantile(name, quantile):
+    """Przybliżenie z kubełków (górna granica), jak histogram_quantile bez interpolacji"""
+    histogram = metric_histograms[name]
+    if not histogram["count"]:
+        return None
+    bounds = METRIC_HISTOGRAMS[name][1]
+    rank = quantile * histogram["count"]
+    seen = 0
+    for bound, bucket in zip(bounds, histogram["buckets"]):
+        seen += bucket
+        if seen >= rank:
+            return bound
+    return float("inf")
+
+
+def format_metrics():
+    lines = []
+    with metrics_lock:
+        for name, (help_text, bounds) in METRIC_HISTOGRAMS.items():
+            histogram = metric_histograms[name]
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, bucket in zip(bounds, histogram["buckets"]):
+                cumulative += bucket
+                lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{le="+Inf"}} {histogram["count"]}')
+            lines.append(f"{name}_sum {histogram['sum']}")
+            lines.append(f"{name}_count {histogram['count']}")
+        for name, help_text in METRIC_COUNTERS.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name} {metric_values[name]}")
+
+    cache = render_cache_info()
+    gauges = {
+        "claude_active_streams": ("Streams currently being read", len(active_streams)),
+        "admission_in_flight": ("API requests holding an admission slot", admission_in_flight),
+        "admission_queue_length": ("API requests waiting for admission", len(admission_waiters)),
+        "sessions_resident": ("Sessions with messages in memory", len(resident_sessions)),
+        "sessions_resident_bytes": ("Memory held by resident sessions (Session.sizeof)", resident_sessions_bytes()),
+        "kernels_running": ("Session kernel processes", len(kernels)),
+        "render_cache_entries": ("Rendered plot fragments in the cache", cache["entries"]),
+        "render_cache_bytes": ("Size of the render cache", cache["bytes"]),
+    }
+    for name, (help_text, value) in gauges.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value}")
+    for name in ("hits", "misses", "evictions"):
+        lines.append(f"# TYPE render_cache_{name}_total counter")
+        lines.append(f"render_cache_{name}_total {cache[name]}")
+    return "\n".join(lines) + "\n"
+
+
+def format_stats():
+    """Krótkie podsumowanie metryk dla panelu Stats w GUI"""
+    rows = []
+    for name, label in (("claude_ttft_seconds", "Time to first token [s]"),
+                        ("claude_output_tokens_per_second", "Output tokens/s"),
+                        ("claude_response_seconds", "Response time [s]"),
+                        ("sandbox_queue_wait_seconds", "Sandbox queue wait [s]"),
+                        ("plot_render_seconds", "Plot render [s]"),
+                        ("py_exec_seconds", "%py inline execution [s]"),
+                        ("search_seconds", "Conversation search [s]")):
+        histogram = metric_histograms[name]
+        if histogram["count"]:
+            mean = histogram["sum"] / histogram["count"]
+            p50, p95 = (histogram_quantile(name, quantile) for quantile in (0.5, 0.95))
+            top = METRIC_HISTOGRAMS[name][1][-1]
+            rows.append(f"| {label} | {histogram['count']} | {mean:.2f} | "
+                        + " | ".join(f"> {top}" if value == float("inf") else f"≤ {value}" for value in (p50, p95))
+                        + " |")
+        else:
+            rows.append(f"| {label} | 0 | - | - | - |")
+    return ("| | Count | Mean | p50 | p95 |\n|---|---|---|---|---|\n" + "\n".join(rows)
+            + f"\n\nRequests: {metric_values['claude_requests_total']}, "
+            f"retries: {metric_values['claude_retries_total']}, "
+            f"errors: {metric_values['claude_errors_total']}, "
+            f"cached: {metric_values['response_cache_hits_total']}, "
+            f"coalesced: {metric_values['response_cache_coalesced_total']}, "
+            f"active streams: {len(active_streams)}, "
+            f"resident sessions: {len(resident_sessions)} ({resident_sessions_bytes() / 1024 / 1024:.1f} MB), "
+            f"queued: {len(admission_waiters)}")
 
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description="Chat application with Anthropic API")
     parser.add_argument("--port", type=int, default=7860, help="Port number to run the server on")
-    parser.add_argument("--debug", action="store_true", help="Enable debug logs")
+    parser.add_argument("--debug", action="store_true", help="Enable debug logs (includes --log-requests)")
+    parser.add_argument("--log-requests", action="store_true",
+                        help="Log full API requests (needed by restore-history.py) without other debug logs")
+    parser.add_argument("--context-budget", type=int, default=CONTEXT_BUDGET_TOKENS,
+                        help="Max estimated input tokens per request before old turns are trimmed")
+    parser.add_argument("--flush-interval", type=float, default=STREAM_FLUSH_INTERVAL,
+                        help="Seconds between streamed UI updates (0 = one update per API chunk)")
+    parser.add_argument("--max-in-flight", type=int, default=ADMISSION_MAX_IN_FLIGHT,
+                        help="Max concurrent API requests (split between workers)")
+    parser.add_argument("--request-rate", type=float, default=ADMISSION_RATE,
+                        help="Max new API requests per second (split between workers)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of worker processes behind --port (ports port+1..port+N)")
+    parser.add_argument("--worker", type=int, default=None, help=argparse.SUPPRESS)  # numer workera, ustawia router
+    parser.add_argument("--batch", metavar="PROMPTS_JSONL",
+                        help="Answer prompts from a JSONL file without the GUI and exit "
+                             "(one object per line: prompt or body, optional id, system, prefill, max_tokens)")
+    parser.add_argument("--batch-mode", choices=["api", "stream"], default="api",
+                        help="api: Message Batches API (cheaper, asynchronous), stream: regular streaming requests")
+    parser.add_argument("--batch-output", help="Directory for the YAML histories (default: <prompts>-results)")
+    parser.add_argument("--batch-concurrency", type=int, default=BATCH_CONCURRENCY,
+                        help="Concurrent requests in --batch-mode stream")
+    parser.add_argument("--max-tokens", type=int, default=4000, help="max_tokens for --batch prompts")
+    parser.add_argument("--prefill", default="", help="Prefill for --batch prompts")
+    parser.add_argument("--index-dir", nargs="+", metavar="DIR",
+                        help="Add exported histories (*.yaml, *.jsonl) under these directories to the search index and exit")
+    parser.add_argument("--index-jobs", type=int, default=None, help="Parser processes for --index-dir (default: CPU count)")
     return parser.parse_args()
 
 
+def read_batch_prompts(path, max_tokens, prefill_text):
+    """Wczytuje prompty z JSONL - "prompt"/"message"/"body" (z "title" na początku), reszta opcjonalna"""
+    prompts = []
+    seen = set()
+    with open(path, encoding='utf-8') as file:
+        for line_no, line in enumerate(file, 1):
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if isinstance(entry, str):
+                entry = {"prompt": entry}
+            text = entry.get("prompt") or entry.get("message") or entry.get("body")
+            if not text:
+                print(f"Line {line_no}: no prompt, skipped", file=sys.stderr)
+                continue
+            if entry.get("title") and entry.get("body") == text:
+                text = f"{entry['title']}\n\n{text}"
+            # custom_id w Batches API: [a-zA-Z0-9_-]{1,64}, jest też nazwą pliku z wynikiem
+            custom_id = BATCH_ID_RE.sub('_', str(entry.get("id") or entry.get("custom_id")
+                                                 or entry.get("request_id") or f"prompt-{line_no}"))[:64]
+            if custom_id in seen:
+                custom_id = f"{custom_id[:56]}-{line_no}"
+            seen.add(custom_id)
+            prompts.append({
+                "id": custom_id,
+                "prompt": text,
+                "system": entry.get("system", DEFAULT_SYSTEM_PROMPT),
+                "prefill": entry.get("prefill", prefill_text).rstrip(),
+                "max_tokens": int(entry.get("max_tokens", max_tokens)),
+            })
+    return prompts
+
+
+def write_batch_history(output_dir, prompt, reply):
+    """YAML w formacie eksportu, zapis atomowy - istniejący plik znaczy, że prompt jest zrobiony"""
+    path = os.path.join(output_dir, prompt["id"] + ".yaml")
+    data = {
+        "session_id": str(uuid.uuid4()),
+        "conversation": [{"role": "user", "content": prompt["prompt"]},
+                         {"role": "assistant", "content": prompt["prefill"] + reply}]
+    }
+    with open(path + ".tmp", 'w', encoding='utf-8') as file:
+        yaml.dump(data, file, Dumper=YamlDumper, allow_unicode=True, sort_keys=False)
+    os.replace(path + ".tmp", path)
+
+
+def save_batch_state(output_dir, state):
+    path = os.path.join(output_dir, BATCH_STATE_FILE)
+    with open(path + ".tmp", 'w', encoding='utf-8') as file:
+        json.dump(state, file, indent=1)
+    os.replace(path + ".tmp", path)
+
+
+async def call_with_retries(call):
+    """Zapytania pomocnicze (batche) - klient ma max_retries=0, ponowienia jak w chat_with_claude"""
+    for attempt in range(RETRY_ATTEMPTS):
+        try:
+            return await call()
+        except Exception as e:
+            wait_time = retry_delay(e, attempt)
+            if wait_time is None or attempt == RETRY_ATTEMPTS - 1:
+                raise
+            print(f"Error occurred: {str(e)}, retrying in {wait_time:.1f} seconds...")
+            await asyncio.sleep(wait_time)
+
+
+async def run_batch_api(prompts, output_dir, state, submit=True):
+    """Wysyła prompty, których nie ma w batchach z poprzedniego uruchomienia, i odbiera wyniki wszystkich"""
+    by_id = {prompt["id"]: prompt for prompt in prompts}
+    pending = {custom_id for ids in state["batches"].values() for custom_id in ids}
+    todo = [prompt for prompt in prompts if prompt["id"] not in pending] if submit else []
+
+    for i in range(0, len(todo), BATCH_MAX_REQUESTS):
+        chunk = todo[i:i + BATCH_MAX_REQUESTS]
+        batch = await call_with_retries(lambda: get_client().messages.batches.create(requests=[{
+            "custom_id": prompt["id"],
+            "params": {
+                "model": MODEL_ID,
+                "max_tokens": prompt["max_tokens"],
+                "system": build_system(prompt["system"]),
+                "messages": [{"role": "user", "content": prompt["prompt"]}]
+                            + ([{"role": "assistant", "content": prompt["prefill"]}] if prompt["prefill"] else [])
+            }
+        } for prompt in chunk]))
+        # od razu na dysk - po przerwaniu wznowienie czeka na ten batch zamiast wysyłać go drugi raz
+        state["batches"][batch.id] = [prompt["id"] for prompt in chunk]
+        save_batch_state(output_dir, state)
+        print(f"Submitted batch {batch.id} with {len(chunk)} prompt(s)")
+
+    failed = 0
+    while state["batches"]:
+        for batch_id in list(state["batches"]):
+            batch = await call_with_retries(lambda: get_client().messages.batches.retrieve(batch_id))
+            counts = batch.request_counts
+            if batch.processing_status != "ended":
+                print(f"Batch {batch_id}: {counts.processing} processing, {counts.succeeded} succeeded, "
+                      f"{counts.errored} errored")
+                continue
+            results = await call_with_retries(lambda: get_client().messages.batches.results(batch_id))
+            async for entry in results:
+                prompt = by_id.get(entry.custom_id)
+                if prompt is None:
+                    continue
+                if entry.result.type == "succeeded":
+                    reply = "".join(block.text for block in entry.result.message.content if block.type == "text")
+                    write_batch_history(output_dir, prompt, reply)
+                    increment("claude_output_tokens_total", entry.result.message.usage.output_tokens)
+                else:
+                    failed += 1
+                    error = getattr(entry.result, "error", None)
+                    print(f"{entry.custom_id}: {entry.result.type} {getattr(error, 'error', error) or ''}", file=sys.stderr)
+            del state["batches"][batch_id]
+            save_batch_state(output_dir, state)
+        if state["batches"]:
+            await asyncio.sleep(BATCH_POLL_SECONDS)
+    return failed
+
+
+async def run_batch_stream(prompts, output_dir, concurrency):
+    """Zwykłe zapytania streamingowe wprost przez klienta, jak run_batch_api - bez sesji,
+    więc prompty z batcha nie trafiają do historii rozmów, indeksu wyszukiwania ani cache odpowiedzi"""
+    semaphore = asyncio.Semaphore(concurrency)
+    failed = 0
+
+    async def ask(prompt):
+        async with get_client().messages.stream(
+                model=MODEL_ID,
+                max_tokens=prompt["max_tokens"],
+                system=build_system(prompt["system"]),
+                messages=[{"role": "user", "content": prompt["prompt"]}]
+                         + ([{"role": "assistant", "content": prompt["prefill"]}] if prompt["prefill"] else [])
+        ) as stream:
+            return await stream.get_final_message()
+
+    async def answer(prompt):
+        nonlocal failed
+        async with semaphore:
+            try:
+                message = await call_with_retries(lambda: ask(prompt))
+            except Exception as e:
+                failed += 1
+                print(f"{prompt['id']}: {e}", file=sys.stderr)
+                return
+            reply = "".join(block.text for block in message.content if block.type == "text")
+            write_batch_history(output_dir, prompt, reply)
+            increment("claude_output_tokens_total", message.usage.output_tokens)
+            print(f"{prompt['id']}: done")
+
+    await asyncio.gather(*(answer(prompt) for prompt in prompts))
+    return failed
+
+
+async def run_batch(args):
+    output_dir = args.batch_output or os.path.splitext(args.batch)[0] + "-results"
+    os.makedirs(output_dir, exist_ok=True)
+    prompts = read_batch_prompts(args.batch, args.max_tokens, args.prefill)
+    # wznowienie: prompty z gotowym plikiem są pomijane
+    todo = [prompt for prompt in prompts
+            if not os.path.exists(os.path.join(output_dir, prompt["id"] + ".yaml"))]
+    print(f"{len(prompts)} prompt(s), {len(prompts) - len(todo)} already done, results in {output_dir}")
+
+    state_path = os.path.join(output_dir, BATCH_STATE_FILE)
+    state = {"batches": {}}
+    if os.path.exists(state_path):
+        with open(state_path, encoding='utf-8') as file:
+            state = json.load(file)
+
+    if args.batch_mode == "api":
+        failed = await run_batch_api(todo, output_dir, state)
+    else:
+        if state["batches"]:
+            # nie wysyłaj drugi raz tego, co już przetwarza API
+            print("Collecting batches submitted by an earlier run first")
+            await run_batch_api(todo, output_dir, state, submit=False)
+            todo = [prompt for prompt in todo
+                    if not os.path.exists(os.path.join(output_dir, prompt["id"] + ".yaml"))]
+        failed = await run_batch_stream(todo, output_dir, args.batch_concurrency)
+
+    print(f"Finished: {len(prompts) - failed} of {len(prompts)} prompt(s) answered"
+          + (f", {failed} failed - run the same command again to retry them" if failed else ""))
+    return failed
+
+
 def load_env(file_path='.env'):
     env_vars = {}
     with open(file_path, 'r') as file:
@@ -78,160 +675,1277 @@ def load_env(file_path='.env'):
     return env_vars
 
 
-env = load_env()
-api_key = env.get('MY_ANTHROPIC_API_KEY')
+env = None  # .env wczytuje main; przy imporcie modułu (benchmark) - pierwszy get_client()
+
+# Wspólny klient async - pula połączeń + keep-alive zamiast nowego klienta na każdą próbę
+HTTP_MAX_CONNECTIONS = 100
+HTTP_MAX_KEEPALIVE = 20
+HTTP_KEEPALIVE_EXPIRY = 30  # seconds
+
+_client = None
+# session id -> aktywny strumień, żeby Stop mógł go faktycznie zamknąć
+active_streams = {}
+
+
+def get_client():
+    global _client, env
+    if _client is None:
+        import httpx
+        import anthropic
+        if env is None:
+            env = load_env()
+        _client = anthropic.AsyncAnthropic(
+            api_key=env.get('MY_ANTHROPIC_API_KEY'),
+            max_retries=0,  # ponowienia robi chat_with_claude, przez wspólny limit
+
+            # None -> SDK bierze ANTHROPIC_BASE_URL albo domyślny endpoint (np. lokalny fake serwer)
+            base_url=env.get('MY_ANTHROPIC_BASE_URL') or None,
+            http_client=anthropic.DefaultAsyncHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                    keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+                )
+            )
+        )
+    return _client
+
+
+admission_waiters = deque()     # Future czekających zapytań, w kolejności przyjścia
+admission_in_flight = 0
+admission_tokens = float(ADMISSION_BURST)
+admission_refilled = time.monotonic()
+admission_blocked_until = 0.0   # retry-after z API wstrzymuje wszystkie sesje naraz
+
+
+def admission_dispatch():
+    """Wpuszcza zapytania z początku kolejki; zwraca, za ile sekund sprawdzić ponownie (None = po zwolnieniu)"""
+    global admission_tokens, admission_refilled, admission_in_flight
+    now = time.monotonic()
+    admission_tokens = min(ADMISSION_BURST, admission_tokens + (now - admission_refilled) * ADMISSION_RATE)
+    admission_refilled = now
+
+    while admission_waiters and admission_in_flight < ADMISSION_MAX_IN_FLIGHT:
+        if admission_waiters[0].done():  # anulowane
+            admission_waiters.popleft()
+            continue
+        if now < admission_blocked_until:
+            return admission_blocked_until - now
+        if admission_tokens < 1:
+            return (1 - admission_tokens) / ADMISSION_RATE
+        admission_tokens -= 1
+        admission_in_flight += 1
+        admission_waiters.popleft().set_result(None)
+    return None
+
+
+def admission_release():
+    global admission_in_flight
+    admission_in_flight -= 1
+    admission_dispatch()
+
+
+async def admission_wait():
+    """Czeka na miejsce w limicie; w trakcie co chwilę oddaje pozycję w kolejce.
+
+    Wolne miejsce od razu = brak yield. Używać z contextlib.aclosing, żeby
+    przerwanie pętli (Stop) od razu zwalniało miejsce w kolejce.
+    """
+    waiter = asyncio.get_running_loop().create_future()
+    admission_waiters.append(waiter)
+    waiting = time.monotonic()
+    try:
+        while True:
+            recheck = admission_dispatch()
+            if waiter.done():
+                break
+            yield admission_waiters.index(waiter) + 1
+            timeout = ADMISSION_POLL_SECONDS if recheck is None else min(recheck, ADMISSION_POLL_SECONDS)
+            try:
+                await asyncio.wait_for(asyncio.shield(waiter), timeout)
+            except asyncio.TimeoutError:
+                pass
+    except BaseException:
+        # anulowane (zamknięta karta, Stop) - oddaj miejsce, jeśli zdążyło zostać przydzielone
+        if waiter.done() and not waiter.cancelled():
+            admission_release()
+        else:
+            waiter.cancel()
+            admission_waiters.remove(waiter)
+        raise
+    observe("admission_wait_seconds", time.monotonic() - waiting)
+
+
+def retry_delay(error, attempt):
+    """Czas do ponowienia albo None, jeśli ponowienie nic nie da (np. 400, 401)"""
+    global admission_blocked_until
+    import anthropic
+    status = getattr(error, "status_code", None)
+    body = getattr(error, "body", None)
+    error_type = body.get("error", {}).get("type") if isinstance(body, dict) and isinstance(body.get("error"), dict) else None
+    if isinstance(error, anthropic.APIStatusError) and status not in RETRY_STATUS and error_type not in RETRY_ERROR_TYPES:
+        return None
+
+    cap = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)
+    delay = cap / 2 + random.uniform(0, cap / 2)  # rozrzut: sesje nie wracają wszystkie w tej samej chwili
+
+    response = getattr(error, "response", None)
+    try:
+        retry_after = float(response.headers.get("retry-after")) if response is not None else None
+    except (TypeError, ValueError):
+        retry_after = None
+    if retry_after is not None:
+        # API mówi, kiedy wrócić - dotyczy wszystkich sesji, nie tylko tej
+        admission_blocked_until = max(admission_blocked_until, time.monotonic() + retry_after)
+        delay = retry_after + random.uniform(0, RETRY_BASE_DELAY)
+    return delay
+
+
+_db = None
+_db_lock = threading.Lock()  # część handlerów Gradio chodzi w wątkach
+search_available = False  # SQLite z FTS5 - ustawiane w get_db
+resident_sessions = OrderedDict()  # id -> sesja z wiadomościami w pamięci, od najdawniej używanej
+_resident_lock = threading.Lock()
+
+
+def get_db():
+    global _db
+    if _db is None:
+        _db = sqlite3.connect(SESSION_DB_PATH, check_same_thread=False)
+        _db.execute("PRAGMA journal_mode=WAL")
+        _db.execute("PRAGMA synchronous=NORMAL")
+        _db.execute("CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, created REAL, updated REAL)")
+        _db.execute("CREATE TABLE IF NOT EXISTS turns ("
+                    "session_id TEXT, idx INTEGER, user TEXT, assistant TEXT, "
+                    "PRIMARY KEY (session_id, idx))")
+        # gałęzie: aktywna jest w turns, odłożone tylko od miejsca, w którym odchodzą od aktywnej (fork NULL = aktywna)
+        _db.execute("CREATE TABLE IF NOT EXISTS branches ("
+                    "session_id TEXT, branch INTEGER, fork INTEGER, PRIMARY KEY (session_id, branch))")
+        _db.execute("CREATE TABLE IF NOT EXISTS branch_turns ("
+                    "session_id TEXT, branch INTEGER, idx INTEGER, user TEXT, assistant TEXT, "
+                    "PRIMARY KEY (session_id, branch, idx))")
+        _db.execute("CREATE TABLE IF NOT EXISTS stop_requests (session_id TEXT PRIMARY KEY, requested REAL)")
+        _db.execute("CREATE TABLE IF NOT EXISTS responses ("
+                    "key TEXT PRIMARY KEY, reply TEXT, duration REAL, created REAL, used REAL, bytes INTEGER)")
+        _db.execute("CREATE INDEX IF NOT EXISTS responses_used ON responses (used)")
+        # indeks wyszukiwania: jedna tura = jeden wiersz, FTS5 z external content aktualizowany triggerami
+        _db.execute("CREATE TABLE IF NOT EXISTS search_turns ("
+                    "id INTEGER PRIMARY KEY, source TEXT, session_id TEXT, idx INTEGER, user TEXT, assistant TEXT)")
+        _db.execute("CREATE UNIQUE INDEX IF NOT EXISTS search_turns_source ON search_turns (source, idx)")
+        _db.execute("CREATE TABLE IF NOT EXISTS search_sources ("
+                    "source TEXT PRIMARY KEY, session_id TEXT, title TEXT, turns INTEGER, mtime REAL, size INTEGER)")
+        # pliki eksportu otwarte z wyników wyszukiwania -> sesja, do której trafił import
+        _db.execute("CREATE TABLE IF NOT EXISTS imported_files ("
+                    "source TEXT PRIMARY KEY, session_id TEXT, mtime REAL, size INTEGER)")
+        _db.commit()
+        init_search_index(_db)
+    return _db
+
+
+def init_search_index(db):
+    """Tabela FTS5 i triggery; bez FTS5 w SQLite tury są zbierane, a wyszukiwanie jest wyłączone"""
+    global search_available
+    created = not db.execute("SELECT 1 FROM sqlite_master WHERE name = 'search_index'").fetchone()
+    try:
+        with db:
+            db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5("
+                       "user, assistant, content='search_turns', content_rowid='id', "
+                       "tokenize='unicode61 remove_diacritics 2')")
+            db.execute("CREATE TRIGGER IF NOT EXISTS search_turns_insert AFTER INSERT ON search_turns BEGIN "
+                       "INSERT INTO search_index (rowid, user, assistant) VALUES (new.id, new.user, new.assistant); END")
+            db.execute("CREATE TRIGGER IF NOT EXISTS search_turns_delete AFTER DELETE ON search_turns BEGIN "
+                       "INSERT INTO search_index (search_index, rowid, user, assistant) "
+                       "VALUES ('delete', old.id, old.user, old.assistant); END")
+            if created:
+                # tury zebrane wcześniej, gdy SQLite nie miało FTS5
+                db.execute("INSERT INTO search_index (search_index) VALUES ('rebuild')")
+        search_available = True
+    except sqlite3.OperationalError as e:
+        logging.warning(f"Full-text search disabled: {e}")
+        search_available = False
+
+
+def persist_session(session):
+    """Zapisuje tury zakończone (albo zmienione) od ostatniego zapisu i zmienione gałęzie"""
+    if not session.loaded or session.unread_turns:
+        return  # zmiany tur idą przez touch_session, które najpierw doczytuje całość
+    turns = len(session.turns)
+    stored = session.stored_turns
+    forks = branch_forks(session)
+    if stored == turns and forks == session.stored_forks:
+        return
+
+    now = time.time()
+    with _db_lock:
+        db = get_db()
+        with db:
+            # w magazynie może być dłuższa wersja (usunięte tury, inna gałąź) - od miejsca zmiany zapis od nowa
+            stored = min(stored or 0, turns)
+            db.execute("DELETE FROM turns WHERE session_id = ? AND idx >= ?", (session.id, stored))
+            db.executemany("INSERT OR REPLACE INTO turns VALUES (?, ?, ?, ?)",
+                           [(session.id, i, turn.user, turn.assistant)
+                            for i, turn in enumerate(session.turns[stored:], stored)])
+            db.execute("INSERT INTO sessions VALUES (?, ?, ?) ON CONFLICT(id) DO UPDATE SET updated = excluded.updated",
+                       (session.id, now, now))
+            search_index_turns(db, SEARCH_STORE_SOURCE + session.id, session.id,
+                               [(turn.user, turn.assistant) for turn in session.turns[stored:]], stored, now)
+            if forks != session.stored_forks:
+                store_branches(db, session, forks)
+    session.stored_turns = turns
+    session.stored_forks = forks
+    session.stored_at = now
+
+
+def store_branches(db, session, forks):
+    """Odłożone gałęzie: zapisywane są tylko ogony (tury od fork), i tylko tych gałęzi, których fork się zmienił"""
+    old = session.stored_forks
+    if old is None:
+        db.execute("DELETE FROM branch_turns WHERE session_id = ?", (session.id,))
+        old = ()
+    db.execute("DELETE FROM branch_turns WHERE session_id = ? AND branch >= ?", (session.id, len(forks)))
+    for branch, fork in enumerate(forks):
+        if branch < len(old) and old[branch] == fork:
+            continue
+        db.execute("DELETE FROM branch_turns WHERE session_id = ? AND branch = ?", (session.id, branch))
+        if fork is not None:
+            db.executemany("INSERT INTO branch_turns VALUES (?, ?, ?, ?, ?)",
+                           [(session.id, branch, i, turn.user, turn.assistant)
+                            for i, turn in enumerate(session.branches[branch][fork:], fork)])
+    db.execute("DELETE FROM branches WHERE session_id = ?", (session.id,))
+    db.executemany("INSERT INTO branches VALUES (?, ?, ?)",
+                   [(session.id, branch, fork) for branch, fork in enumerate(forks)])
+
+
+def store_updated_at(session_id):
+    with _db_lock:
+        row = get_db().execute("SELECT updated FROM sessions WHERE id = ?", (session_id,)).fetchone()
+    return row[0] if row else None
+
+
+def store_has_session(session_id):
+    with _db_lock:
+        return get_db().execute("SELECT 1 FROM sessions WHERE id = ?", (session_id,)).fetchone() is not None
+
+
+def search_remove_source(source):
+    """Plik eksportu, którego już nie ma: tury znikają z indeksu (trigger usuwa je z FTS5)"""
+    with _db_lock:
+        db = get_db()
+        with db:
+            db.execute("DELETE FROM search_turns WHERE source = ?", (source,))
+            db.execute("DELETE FROM search_sources WHERE source = ?", (source,))
+            db.execute("DELETE FROM imported_files WHERE source = ?", (source,))
+
+
+def imported_session_id(source, mtime, size):
+    """Sesja z wcześniejszego importu tego pliku, jeśli plik się nie zmienił, a sesja jest jeszcze w magazynie"""
+    with _db_lock:
+        row = get_db().execute("SELECT i.session_id FROM imported_files i JOIN sessions s ON s.id = i.session_id "
+                               "WHERE i.source = ? AND i.mtime = ? AND i.size = ?", (source, mtime, size)).fetchone()
+    return row[0] if row else None
+
+
+def remember_import(source, session_id, mtime, size):
+    with _db_lock:
+        db = get_db()
+        with db:
+            db.execute("INSERT OR REPLACE INTO imported_files VALUES (?, ?, ?, ?)", (source, session_id, mtime, size))
+
+
+def store_purge_expired():
+    cutoff = time.time() - SESSION_RETENTION_DAYS * 24 * 3600
+    with _db_lock:
+        db = get_db()
+        with db:
+            for table in ("turns", "branches", "branch_turns"):
+                db.execute(f"DELETE FROM {table} WHERE session_id IN (SELECT id FROM sessions WHERE updated < ?)",
+                           (cutoff,))
+            expired = "SELECT ? || id FROM sessions WHERE updated < ?"
+            db.execute(f"DELETE FROM search_turns WHERE source IN ({expired})", (SEARCH_STORE_SOURCE, cutoff))
+            db.execute(f"DELETE FROM search_sources WHERE source IN ({expired})", (SEARCH_STORE_SOURCE, cutoff))
+            db.execute("DELETE FROM imported_files WHERE session_id IN (SELECT id FROM sessions WHERE updated < ?)",
+                       (cutoff,))
+            db.execute("DELETE FROM sessions WHERE updated < ?", (cutoff,))
+            db.execute("DELETE FROM responses WHERE created < ?", (time.time() - RESPONSE_CACHE_TTL,))
+
+
+def search_index_turns(db, source, session_id, turns, start, mtime, size=None):
+    """Podmienia w indeksie tury źródła od start (turns = pary (user, assistant) od tego miejsca).
+    Wywoływane w transakcji zapisu sesji albo pliku."""
+    db.execute("DELETE FROM search_turns WHERE source = ? AND idx >= ?", (source, start))
+    db.executemany("INSERT INTO search_turns (source, session_id, idx, user, assistant) VALUES (?, ?, ?, ?, ?)",
+                   [(source, session_id, i, user, assistant) for i, (user, assistant) in enumerate(turns, start)])
+    title = turns[0][0][:SEARCH_TITLE_CHARS] if start == 0 and turns else None
+    db.execute("INSERT INTO search_sources VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(source) DO UPDATE SET "
+               "session_id = excluded.session_id, title = COALESCE(excluded.title, title), "
+               "turns = excluded.turns, mtime = excluded.mtime, size = excluded.size",
+               (source, session_id, title, start + len(turns), mtime, size))
+
+
+def search_sync_store():
+    """Sesje zapisane, zanim powstał indeks (albo przez starszą wersję) - przy starcie, potem wystarcza persist_session"""
+    with _db_lock:
+        db = get_db()
+        stale = db.execute("SELECT s.id, s.updated FROM sessions s LEFT JOIN search_sources i ON i.source = ? || s.id "
+                           "WHERE i.mtime IS NULL OR i.mtime < s.updated", (SEARCH_STORE_SOURCE,)).fetchall()
+        for session_id, updated in stale:
+            rows = db.execute("SELECT user, assistant FROM turns WHERE session_id = ? ORDER BY idx",
+                              (session_id,)).fetchall()
+            with db:
+                search_index_turns(db, SEARCH_STORE_SOURCE + session_id, session_id, rows, 0, updated)
+    if stale:
+        logging.info(f"Search index: {len(stale)} stored session(s) indexed")
+
+
+def fts_query(text):
+    """Tekst z pola wyszukiwania jako zapytanie FTS5: każde słowo w cudzysłowie (bez składni FTS5),
+    wszystkie muszą wystąpić, ostatnie także jako prefiks - wyniki już w trakcie pisania słowa"""
+    words = text.split()
+    if not words:
+        return None
+    quoted = ['"' + word.replace('"', '""') + '"' for word in words]
+    return " ".join(quoted) + "*"
+
+
+def search_history(text, limit=SEARCH_RESULTS):
+    """Najlepiej pasujące tury (bm25): lista dictów source, session_id, idx, title, snippet"""
+    query = fts_query(text)
+    if query is None or not search_available:
+        return []
+    with _db_lock:
+        rows = get_db().execute(
+            "SELECT t.source, t.session_id, t.idx, s.title, "
+            "snippet(search_index, -1, '**', '**', '…', ?) FROM search_index "
+            "JOIN search_turns t ON t.id = search_index.rowid "
+            "LEFT JOIN search_sources s ON s.source = t.source "
+            "WHERE search_index MATCH ? ORDER BY bm25(search_index) LIMIT ?",
+            (SEARCH_SNIPPET_TOKENS, query, limit)).fetchall()
+    return [{"source": source, "session_id": session_id, "idx": idx, "title": title or "", "snippet": snippet}
+            for source, session_id, idx, title, snippet in rows]
+
+
+def response_cache_get(key):
+    """(odpowiedź, czas oryginalnego strumienia) albo None"""
+    now = time.time()
+    with _db_lock:
+        db = get_db()
+        row = db.execute("SELECT reply, duration FROM responses WHERE key = ? AND created >= ?",
+                         (key, now - RESPONSE_CACHE_TTL)).fetchone()
+        if row is not None:
+            with db:
+                db.execute("UPDATE responses SET used = ? WHERE key = ?", (now, key))
+    return row
+
+
+def response_cache_put(key, reply, duration):
+    """Zapisuje odpowiedź; po przekroczeniu limitu usuwa najdawniej używane"""
+    size = len(reply.encode())
+    if size > RESPONSE_CACHE_MAX_BYTES:
+        return
+    now = time.time()
+    with _db_lock:
+        db = get_db()
+        with db:
+            db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                       (key, reply, duration, now, now, size))
+            excess = db.execute("SELECT SUM(bytes) FROM responses").fetchone()[0] - RESPONSE_CACHE_MAX_BYTES
+            if excess > 0:
+                evicted = []
+                for old_key, old_size in db.execute("SELECT key, bytes FROM responses ORDER BY used"):
+                    if excess <= 0:
+                        break
+                    evicted.append((old_key,))
+                    excess -= old_size
+                db.executemany("DELETE FROM responses WHERE key = ?", evicted)
+
+
+def load_session_messages(session, tail=False):
+    """Wczytuje wiadomości sesji z magazynu (po restarcie albo po zwolnieniu z pamięci);
+    tail - tylko ostatnie HISTORY_VIEW_TURNS tur, starsze doczytuje read_earlier_turns"""
+    with _db_lock:
+        db = get_db()
+        forks = tuple(fork for fork, in db.execute("SELECT fork FROM branches WHERE session_id = ? ORDER BY branch",
+                                                   (session.id,)))
+        # odłożone gałęzie dzielą prefiks z aktywną - sesja z gałęziami jest czytana w całości
+        limit = HISTORY_VIEW_TURNS if tail and not forks else -1
+        rows = db.execute("SELECT idx, user, assistant FROM turns WHERE session_id = ? ORDER BY idx DESC LIMIT ?",
+                          (session.id, limit)).fetchall()
+        tails = db.execute("SELECT branch, user, assistant FROM branch_turns WHERE session_id = ? ORDER BY branch, idx",
+                           (session.id,)).fetchall()
+    rows.reverse()
+    session.stored_at = store_updated_at(session.id) or 0.0
+    session.turns = [Turn(user, assistant) for _, user, assistant in rows]
+    session.unread_turns = rows[0][0] if rows else 0
+    session.stored_turns = session.unread_turns + len(rows)
+    # wspólny prefiks gałęzi to te same obiekty Turn co w aktywnej
+    session.branches = [None if fork is None else session.turns[:fork] for fork in forks]
+    for branch, user, assistant in tails:
+        session.branches[branch].append(Turn(user, assistant))
+    session.branch = forks.index(None) if forks else 0
+    session.stored_forks = forks
+    session.loaded = True
+    # długie sesje: GUI renderuje tylko końcówkę, starsze tury na żądanie (Show earlier)
+    session.history_from = max(0, len(rows) - HISTORY_VIEW_TURNS)
+    reset_history(session)
+    reset_context(session)
+
+
+def read_earlier_turns(session, count=None):
+    """Doczytuje z magazynu `count` tur sprzed wczytanej końcówki (None = wszystkie).
+    Numery tur w session.turns znów odpowiadają idx w magazynie, gdy unread_turns spadnie do 0."""
+    start = 0 if count is None else max(0, session.unread_turns - count)
+    with _db_lock:
+        rows = get_db().execute("SELECT user, assistant FROM turns WHERE session_id = ? AND idx >= ? AND idx < ? "
+                                "ORDER BY idx", (session.id, start, session.unread_turns)).fetchall()
+    session.turns = [Turn(user, assistant) for user, assistant in rows] + session.turns
+    session.unread_turns = start
+    session.history_from += len(rows)
+    reset_history(session)
+    reset_context(session)
+
+
+def unload_session(session):
+    persist_session(session)
+    session.turns = []
+    session.unread_turns = 0
+    session.branches = []
+    session.branch = 0
+    session.loaded = False
+    session.history_from = 0
+    reset_history(session)
+    reset_context(session)
+
+
+def touch_session(session, tail=False):
+    """Sesja w użyciu: doładuj ją, jeśli była zwolniona, i zwolnij pamięć sesji bezczynnych.
+    tail - wystarczy końcówka do wyświetlenia; bez tego doczytywane są wszystkie tury"""
+    with _resident_lock:
+        if not session.loaded:
+            load_session_messages(session, tail)
+        elif WORKER_INDEX is not None and not session.busy:
+            # tę samą sesję mogła w międzyczasie zmienić karta obsługiwana przez inny worker
+            updated = store_updated_at(session.id)
+            if updated is not None and updated > session.stored_at:
+                load_session_messages(session, tail)
+        if session.unread_turns and not tail:
+            read_earlier_turns(session)
+        session.last_access = time.time()
+        resident_sessions[session.id] = session
+        resident_sessions.move_to_end(session.id)
+
+        now = time.time()
+        resident_bytes = resident_sessions_bytes()
+        for session_id, idle in list(resident_sessions.items()):
+            if (len(resident_sessions) <= SESSION_MAX_RESIDENT and now - idle.last_access < SESSION_IDLE_SECONDS
+                    and resident_bytes <= SESSION_RESIDENT_MAX_BYTES):
+                break
+            if idle is session or idle.busy:
+                continue
+            resident_bytes -= idle.sizeof()
+            unload_session(idle)
+            del resident_sessions[session_id]
+    return session
+
+
+def resident_sessions_bytes():
+    return sum(session.sizeof() for session in list(resident_sessions.values()))
+
+
+def forget_session(session):
+    """delete_callback gr.State - karta zamknięta, sesja zostaje tylko w magazynie"""
+    persist_session(session)
+    with _resident_lock:
+        if resident_sessions.get(session.id) is session:
+            del resident_sessions[session.id]
+
+
+async def restore_session(stored_id, session):
+    """Przy otwarciu strony: wróć do sesji zapamiętanej w przeglądarce (także po restarcie serwera)"""
+    resident = resident_sessions.get(stored_id) if stored_id else None
+    if resident is not None:
+        session = resident
+    elif stored_id and store_has_session(stored_id):
+        session.id = stored_id
+        session.loaded = False
+    else:
+        # wartość początkowa gr.State jest kopiowana dla każdej karty - każda dostaje własne id
+        session.id = str(uuid.uuid4())
+    touch_session(session, tail=True)
+    return session, session.id, await format_history_with_rendering(session), format_usage(session)
+
+
+async def show_earlier(session):
+    touch_session(session, tail=True)
+    if session.unread_turns and session.history_from < HISTORY_VIEW_TURNS:
+        read_earlier_turns(session, HISTORY_VIEW_TURNS)
+    session.history_from = max(0, session.history_from - HISTORY_VIEW_TURNS)
+    return await format_history_with_rendering(session)
+
+
+class Turn:
+    """Zakończona tura: pytanie i odpowiedź.
+
+    Niezmienna - zmiana odpowiedzi (dopisany output kodu, błąd) to nowy obiekt,
+    więc widok historii i kontekst API trzymają referencje do tych samych
+    wiadomości zamiast własnych kopii.
+    """
+    __slots__ = ("user", "assistant", "_user_message", "_assistant_message")
+
+    def __init__(self, user, assistant):
+        self.user = user
+        self.assistant = assistant
+        self._user_message = self._assistant_message = None
+
+    def messages(self):
+        """Para wiadomości dla API, budowana raz; te same dicty są wpisami w widoku historii"""
+        if self._user_message is None:
+            # double check - bez img bo kasa poleci
+            cleaned = strip_base64_images(self.assistant)
+            if DEBUG and len(cleaned) != len(self.assistant):
+                print(f"⚠️  WARNING: Cleaned {len(self.assistant) - len(cleaned)} chars from a message")
+            self._user_message = {"role": "user", "content": self.user}
+            self._assistant_message = {"role": "assistant", "content": cleaned}
+        return self._user_message, self._assistant_message
+
+    def tokens(self):
+        user, assistant = self.messages()
+        return estimate_tokens(user["content"]) + estimate_tokens(assistant["content"])
+
+    def sizeof(self):
+        size = sys.getsizeof(self) + sys.getsizeof(self.user) + sys.getsizeof(self.assistant)
+        if self._user_message is not None:
+            size += sys.getsizeof(self._user_message) + sys.getsizeof(self._assistant_message)
+            if self._assistant_message["content"] is not self.assistant:
+                size += sys.getsizeof(self._assistant_message["content"])
+        return size
+
+
+class Session:
+    """Stan jednej rozmowy (jedna karta albo sesja wczytana z magazynu)"""
+    __slots__ = (
+        "id",
+        "turns",                # zakończone tury (Turn) aktywnej gałęzi
+        "branches",             # listy Turn gałęzi, wspólne prefiksy to te same obiekty; [branch] = None (to turns)
+        "branch",               # aktywna gałąź
+        "pending",              # pytanie, na które odpowiedź właśnie powstaje
+        "stop_generation",
+        "usage",                # suma tokenów z całej sesji
+        "last_usage",           # ostatnia odpowiedź
+        "context_estimate",     # szacowane tokeny ostatniego zapytania
+        "context_scale",        # poprawka szacunku wg usage z API
+        "context_trimmed",
+        "context_start",        # pierwsza tura w oknie kontekstu
+        "context_pinned",       # tury sprzed okna, które zostają (output wykonania kodu)
+        "api_turns",            # ile tur ma już policzone tokeny
+        "api_token_prefix",     # [i] = szacowane tokeny tur 0..i-1
+        "stored_turns",         # ile tur jest już w magazynie (None = nadpisz całość)
+        "unread_turns",         # ile pierwszych tur jest jeszcze tylko w magazynie (turns to końcówka)
+        "stored_forks",         # branch_forks z ostatniego zapisu (None = nadpisz gałęzie)
+        "stored_at",            # czas ostatniego zapisu/odczytu magazynu widziany przez ten proces
+        "loaded",               # False = tury zwolnione z pamięci, są w magazynie
+        "busy",
+        "generation_started",
+        "last_error",           # błąd, którym skończyła się ostatnia odpowiedź
+        "py_early",             # {"code", "task"} - %py inline uruchomiony jeszcze w trakcie odpowiedzi
+        "py_kernel",            # id kernela sesji, gdy %py inline ma trwały namespace
+        "last_access",
+        "history_from",         # pierwsza tura pokazywana w GUI
+        "history",              # widok dla gr.Chatbot - wpisy to w większości wiadomości z Turn.messages()
+        "history_turns",        # ile zakończonych odpowiedzi jest już w widoku
+        "history_users",        # ile wiadomości usera jest już w widoku
+        "history_live",         # czy ostatni wpis to streamowany ogon
+        "_size",                # (klucz stanu, bajty) - sizeof() liczy od nowa dopiero po zmianie
+    )
+
+    def __init__(self, session_id=None):
+        self.id = session_id or str(uuid.uuid4())
+        self.turns = []
+        self.branches = []
+        self.branch = 0
+        self.pending = None
+        self.stop_generation = False
+        self.usage = new_usage()
+        self.last_usage = new_usage()
+        self.context_estimate = 0
+        self.context_scale = 1.0
+        self.context_trimmed = 0
+        self.stored_turns = 0
+        self.unread_turns = 0
+        self.stored_forks = ()
+        self.stored_at = 0.0
+        self.loaded = True
+        self.busy = False
+        self.generation_started = 0.0
+        self.last_error = None
+        self.py_early = None
+        self.py_kernel = None
+        self.last_access = time.time()
+        self.history_from = 0
+        self._size = None
+        reset_history(self)
+        reset_context(self)
+
+    def sizeof(self):
+        """Bajty trzymane w pamięci przez sesję: tury, gałęzie, widok historii i pomocnicze listy.
+        Wspólne obiekty (wiadomość w widoku i w kontekście API, prefiks gałęzi) liczone są raz."""
+        # żywy wpis rośnie w trakcie odpowiedzi bez zmiany liczby wpisów - w kluczu jego długość
+        key = (id(self.turns), len(self.turns), self.turns[-1] if self.turns else None, self.pending,
+               len(self.history), len(self.history[-1]["content"]) if self.history_live else None,
+               len(self.branches), self.branch)
+        if self._size is not None and self._size[0] == key:
+            return self._size[1]
+
+        size = sys.getsizeof(self) + sys.getsizeof(self.turns) + sys.getsizeof(self.history)
+        size += sys.getsizeof(self.api_token_prefix) + sys.getsizeof(self.context_pinned)
+        shared = set()
+        for turn in self.turns:
+            size += turn.sizeof()
+            if turn._user_message is not None:
+                shared.update((id(turn._user_message), id(turn._assistant_message)))
+        if self.branches:
+            counted = set(map(id, self.turns))
+            size += sys.getsizeof(self.branches)
+            for branch in self.branches:
+                if branch is None:
+                    continue
+                size += sys.getsizeof(branch)
+                for turn in branch:
+                    if id(turn) not in counted:
+                        counted.add(id(turn))
+                        size += turn.sizeof()
+        for entry in self.history:
+            if id(entry) not in shared:
+                size += sys.getsizeof(entry) + sys.getsizeof(entry["content"])
+        if self.pending is not None:
+            size += sys.getsizeof(self.pending)
+        self._size = (key, size)
+        return size
 
 
 def create_session():
-    session_id = str(uuid.uuid4())
-    session = {
-        "id": session_id,
-        "user_messages": [],
-        "assistant_messages": [],
-        "rendered_messages": {},
-        "stop_generation": False
-    }
+    session = Session()
     if DEBUG:
-        print(f"New session created: {session_id}")
+        print(f"New session created: {session.id}")
     return session
 
 
-async def chat_with_claude(message, temperature, max_tokens, session, prefill_text, system_prompt):
-    if DEBUG:
-        print(f"{session['id']}: {message}")
+USAGE_FIELDS = ("input_tokens", "output_tokens", "cache_creation_input_tokens", "cache_read_input_tokens")
 
-    # if not message.strip():
-    #     yield []
-    #     return
 
-    session["user_messages"].append(message)
+def new_usage():
+    return {field: 0 for field in USAGE_FIELDS}
 
-    messages = []
-    for user_msg, asst_msg in zip(session["user_messages"], session["assistant_messages"]):
-        messages.append({"role": "user", "content": user_msg})
-        # double check - bez img bo kasa poleci
-        cleaned_asst_msg = strip_base64_images(asst_msg)
-        messages.append({"role": "assistant", "content": cleaned_asst_msg})
-    messages.append({"role": "user", "content": message})
 
-    if DEBUG:
-        for i, (orig, msg) in enumerate(zip(session["assistant_messages"], messages[1::2])):
-            if len(orig) != len(msg["content"]):
-                print(f"⚠️  WARNING: Cleaned {len(orig) - len(msg['content'])} chars from message {i}")
+def read_usage(usage_obj, usage):
+    """Przepisuje niepuste pola usage z eventu streamu"""
+    for field in USAGE_FIELDS:
+        value = getattr(usage_obj, field, None)
+        if value is not None:
+            usage[field] = value
 
-    msg_ap = messages.copy()
-    prefill_text = prefill_text.rstrip()
-    if prefill_text:
-        msg_ap.append({"role": "assistant", "content": prefill_text})
 
-    max_retries = 3
-    retry_delay = 1  # seconds
+def record_usage(session, usage):
+    session.last_usage = usage
+    for field in USAGE_FIELDS:
+        session.usage[field] += usage[field]
 
-    for attempt in range(max_retries):
-        try:
-            client = anthropic.Client(api_key = api_key)
-            stream = client.messages.create(
-                model=MODEL_ID,
-                system=system_prompt if system_prompt.strip() else [],
-                max_tokens=max_tokens,
-                # temperature=temperature,
-                messages=msg_ap,
-                stream=True
-            )
+    # kalibracja szacunku tokenów na podstawie tego, co policzyło API
+    actual = usage["input_tokens"] + usage["cache_read_input_tokens"] + usage["cache_creation_input_tokens"]
+    if actual and session.context_estimate:
+        session.context_scale = min(3.0, max(0.5, actual / session.context_estimate))
 
-            assistant_message = ""
-            if prefill_text:
-                assistant_message += prefill_text
 
-            for chunk in stream:
-                if session["stop_generation"]:
-                    break
+def format_usage(session):
+    last = session.last_usage
+    total = session.usage
+    return (f"<p style='text-align: center; font-size: 0.8em;'>"
+            f"Last reply: {last['input_tokens']} in (cache read {last['cache_read_input_tokens']}, "
+            f"cache write {last['cache_creation_input_tokens']}), {last['output_tokens']} out · "
+            f"Session: {total['input_tokens']} in (cache read {total['cache_read_input_tokens']}, "
+            f"cache write {total['cache_creation_input_tokens']}), {total['output_tokens']} out<br>"
+            f"Context: ~{int(session.context_estimate * session.context_scale)} / {CONTEXT_BUDGET_TOKENS} tokens"
+            + (f", {session.context_trimmed} oldest turns omitted" if session.context_trimmed else "")
+            + f" · Memory: {session.sizeof() / 1024 / 1024:.1f} MB"
+            + "</p>")
 
-                if hasattr(chunk, 'error') and chunk.error.get('type') == 'overloaded_error':
-                    if attempt < max_retries - 1:
-                        wait_time = retry_delay * (2 ** attempt)
-                        print(f"Overloaded error, waiting {wait_time} seconds before retry...")
-                        await asyncio.sleep(wait_time)
-                        break
-                    else:
-                        error_message = "Server is currently overloaded. Please try again later."
-                        session["assistant_messages"].append(error_message)
-                        yield format_history(session)
-                        return
-
-                if hasattr(chunk, 'delta'):
-                    if hasattr(chunk.delta, 'text'):
-                        assistant_message += chunk.delta.text
-                    elif hasattr(chunk.delta, 'content') and chunk.delta.content:
-                        for content in chunk.delta.content:
-                            if content.type == 'text':
-                                assistant_message += content.text
-
-                elif hasattr(chunk, 'message'):
-                    if hasattr(chunk.message, 'content'):
-                        for content in chunk.message.content:
-                            if content.type == 'text':
-                                assistant_message += content.text
-
-                await asyncio.sleep(0)
-                yield format_history(session, assistant_message)
-
-            if assistant_message:
-                session["assistant_messages"].append(assistant_message)
-                yield format_history(session)
+
+def cache_breakpoint(message):
+    """Kopia wiadomości z cache_control - prefiks do tego miejsca jest cache'owany po stronie API"""
+    return {
+        "role": message["role"],
+        "content": [{"type": "text", "text": message["content"], "cache_control": {"type": "ephemeral"}}]
+    }
+
+
+def build_system(system_prompt):
+    if not system_prompt.strip():
+        return []
+    return [{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}]
+
+
+response_inflight = {}  # klucz cache -> strumień czytany przez pierwsze z identycznych zapytań
+
+
+def response_cache_key(system_prompt, context, max_tokens, temperature, prefill_text):
+    payload = json.dumps([MODEL_ID, system_prompt, context, max_tokens, temperature, prefill_text], ensure_ascii=False)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def update_shared_response(shared, text, done=False, ok=False):
+    shared["text"] = text
+    shared["done"] = done
+    shared["ok"] = ok
+    event = shared["event"]
+    shared["event"] = asyncio.Event()
+    event.set()
+
+
+async def cached_response(key, result):
+    """Odpowiedź bez nowego zapytania do API - kolejne wersje tekstu, pełna trafia do result["reply"].
+
+    Dołącza do identycznego zapytania w locie albo odtwarza odpowiedź z cache w tempie oryginalnego
+    strumienia. Jeśli nie ma żadnego z nich, rejestruje wywołującego jako źródło dla kolejnych
+    (result["shared"]) i nic nie zwraca.
+    """
+    shared = response_inflight.get(key)
+    if shared is not None:
+        increment("response_cache_coalesced_total")
+        while True:
+            event = shared["event"]
+            yield shared["text"]
+            if shared["done"]:
                 break
+            await event.wait()
+        if shared["ok"]:
+            result["reply"] = shared["text"]
+        return
 
-        except Exception as e:
-            if attempt < max_retries - 1:
-                wait_time = retry_delay * (2 ** attempt)
-                print(f"Error occurred: {str(e)}, waiting {wait_time} seconds before retry...")
-                await asyncio.sleep(wait_time)
-                continue
+    row = response_cache_get(key)
+    if row is None:
+        result["shared"] = response_inflight[key] = {"text": "", "event": asyncio.Event(), "done": False, "ok": False}
+        return
+
+    increment("response_cache_hits_total")
+    reply, duration = row
+    rate = len(reply) / duration if duration else RESPONSE_REPLAY_CHARS_PER_SECOND
+    step = max(1, int(rate * STREAM_FLUSH_INTERVAL))
+    for end in range(step, len(reply), step):
+        yield reply[:end]
+        await asyncio.sleep(STREAM_FLUSH_INTERVAL)
+    result["reply"] = reply
+
+
+async def chat_with_claude(message, temperature, max_tokens, session, prefill_text, system_prompt, use_cache=False,
+                           run_code_early=False):
+    log_request_id.set(uuid.uuid4().hex[:12])
+    session.generation_started = time.time()
+    session.last_error = None
+    ensure_stop_watcher()
+    if DEBUG:
+        print(f"{session.id}: {message}")
+
+    # if not message.strip():
+    #     yield []
+    #     return
+
+    session.pending = message
+
+    # zakończone tury są już oczyszczone, dokładamy tylko nową wiadomość;
+    # breakpoint na niej: kolejna tura czyta z cache cały dotychczasowy prefiks
+    context = build_context(session, message, system_prompt) + [cache_breakpoint({"role": "user", "content": message})]
+    # prefill użytkownika, a po zerwanym strumieniu także to, co już przyszło - model kontynuuje od tego miejsca
+    # (API nie przyjmuje prefillu zakończonego białym znakiem)
+    assistant_message = prefill_text.rstrip()
+
+    reply = shared = None
+    if use_cache:
+        cache_key = response_cache_key(system_prompt, context, max_tokens, temperature, assistant_message)
+        cached = {}
+        async with contextlib.aclosing(cached_response(cache_key, cached)) as replies:
+            async for partial in replies:
+                if session.stop_generation:
+                    cached["reply"] = partial  # Stop - zostaje to, co już pokazano
+                    break
+                if partial:
+                    yield await format_history(session, partial)
+        reply = cached.get("reply")
+        shared = cached.get("shared")
+        if reply is not None:
+            assistant_message = reply
+            session.last_usage = new_usage()
+
+    completed = False
+    reply_started = None
+    fences = new_fence_scan()
+    try:
+        # odpowiedź z cache albo z identycznego zapytania - bez własnego zapytania do API
+        for attempt in range(RETRY_ATTEMPTS if reply is None else 0):
+            msg_ap = context + [{"role": "assistant", "content": assistant_message}] if assistant_message else context
+
+            shown = None
+            admitted = False
+            async with contextlib.aclosing(admission_wait()) as positions:
+                async for position in positions:
+                    if session.stop_generation:
+                        break  # Stop w kolejce - aclosing zwalnia miejsce
+                    if position != shown:
+                        shown = position
+                        yield await format_history(session, assistant_message + ADMISSION_WAIT_NOTE.format(position))
+                else:
+                    admitted = True
+            if not admitted:
+                break
+
+            try:
+                if session.stop_generation:
+                    break
+                increment("claude_requests_total")
+                started = time.monotonic()
+                first_token_at = None
+                stream = await get_client().messages.create(
+                    model=MODEL_ID,
+                    system=build_system(system_prompt),
+                    max_tokens=max_tokens,
+                    # temperature=temperature,
+                    messages=msg_ap,
+                    stream=True
+                )
+                active_streams[session.id] = stream
+                last_flush = 0.0
+                flushed = len(assistant_message)
+                usage = new_usage()
+                chunks = aiter(stream)
+                waiting = None  # następny chunk, gdy tekst czeka na wysłanie
+
+                try:
+                    while True:
+                        if len(assistant_message) != flushed:
+                            # tekst czeka najwyżej STREAM_FLUSH_INTERVAL, także gdy strumień stanie w miejscu
+                            timeout = last_flush + STREAM_FLUSH_INTERVAL - time.monotonic()
+                            if timeout > 0:
+                                waiting = waiting or asyncio.ensure_future(anext(chunks, None))
+                                done, _ = await asyncio.wait((waiting,), timeout=timeout)
+                            if timeout <= 0 or not done:
+                                last_flush = time.monotonic()
+                                flushed = len(assistant_message)
+                                if shared is not None:
+                                    update_shared_response(shared, assistant_message)
+                                for position, code in scan_fences(fences, assistant_message):
+                                    # respond wykonuje tylko pierwszy blok - ten może ruszyć od razu
+                                    if (run_code_early and PY_RUN_EARLY and position == fences["blocks"][0][0]
+                                            and PY_COMP_START in code):
+                                        start_py_early(session, py_block_code(code))
+                                yield await format_history(session, assistant_message, fences["plots"])
+                                continue
+                        if waiting is not None:
+                            chunk, waiting = await waiting, None
+                        else:
+                            chunk = await anext(chunks, None)
+                        if chunk is None or session.stop_generation:
+                            break
+
+                        chunk_type = getattr(chunk, 'type', None)
+                        if chunk_type == 'message_start':
+                            read_usage(chunk.message.usage, usage)
+                        elif chunk_type == 'message_delta':
+                            read_usage(chunk.usage, usage)
+
+                        if hasattr(chunk, 'error'):
+                            raise RuntimeError(f"Stream error: {chunk.error}")
+
+                        if hasattr(chunk, 'delta'):
+                            if hasattr(chunk.delta, 'text'):
+                                assistant_message += chunk.delta.text
+                                if first_token_at is None:
+                                    first_token_at = time.monotonic()
+                            elif hasattr(chunk.delta, 'content') and chunk.delta.content:
+                                for content in chunk.delta.content:
+                                    if content.type == 'text':
+                                        assistant_message += content.text
+
+                        elif hasattr(chunk, 'message'):
+                            if hasattr(chunk.message, 'content'):
+                                for content in chunk.message.content:
+                                    if content.type == 'text':
+                                        assistant_message += content.text
+                finally:
+                    if waiting is not None:
+                        # Stop albo anulowanie w trakcie czekania - chunk nikomu już nie jest potrzebny
+                        waiting.cancel()
+                        waiting.add_done_callback(lambda task: task.cancelled() or task.exception())
+                    if reply_started is None:
+                        reply_started = first_token_at
+                    active_streams.pop(session.id, None)
+                    await stream.close()
+                    record_usage(session, usage)
+                    finished = time.monotonic()
+                    observe("claude_response_seconds", finished - started)
+                    increment("claude_output_tokens_total", usage["output_tokens"])
+                    if first_token_at is not None:
+                        observe("claude_ttft_seconds", first_token_at - started)
+                        if finished > first_token_at and usage["output_tokens"]:
+                            observe("claude_output_tokens_per_second", usage["output_tokens"] / (finished - first_token_at))
+
+            except Exception as e:
+                if session.stop_generation:
+                    # Stop zamknął strumień w trakcie czytania - zostaw to, co już przyszło
+                    break
+                wait_time = retry_delay(e, attempt)
+                if wait_time is None or attempt == RETRY_ATTEMPTS - 1:
+                    error_message = f"An error occurred: {str(e)}"
+                    increment("claude_errors_total")
+                    session.last_error = error_message
+                    assistant_message = f"{assistant_message}\n\n⚠️ {error_message}" if assistant_message else error_message
+                    break
+                increment("claude_retries_total")
+                if assistant_message:
+                    increment("claude_resumed_total")
+                    assistant_message = assistant_message.rstrip()
+                print(f"Error occurred: {str(e)}, retrying in {wait_time:.1f} seconds...")
             else:
-                error_message = f"An error occurred: {str(e)}"
-                session["assistant_messages"].append(error_message)
-                yield format_history(session)
+                completed = not session.stop_generation
                 break
+            finally:
+                admission_release()
+
+            # poza limitem - czekające na ponowienie nie zajmują miejsc innym
+            await asyncio.sleep(wait_time)
+    finally:
+        if shared is not None:
+            # zawsze - inaczej czekający na ten strumień czekaliby bez końca
+            del response_inflight[cache_key]
+            update_shared_response(shared, assistant_message, done=True, ok=completed)
+            if completed:
+                response_cache_put(cache_key, assistant_message,
+                                   time.monotonic() - reply_started if reply_started else 0.0)
+
+    # Stop przed pierwszym tokenem - pytanie bez odpowiedzi nie zostaje w historii
+    session.pending = None
+    if assistant_message:
+        session.turns.append(Turn(message, assistant_message))
+    yield await format_history(session)
+
+    session.stop_generation = False
+    persist_session(session)
+
+
+async def stop_generation_func(session):
+    if DEBUG:
+        print(f"Stop generation called for session: {session.id}")
+    stream = active_streams.get(session.id)
+    if stream is None and WORKER_INDEX is not None and not session.busy:
+        # odpowiedź generuje inny worker (inna karta tej samej sesji) - przekaż Stop przez magazyn
+        request_stop(session.id)
+        return
+    session.stop_generation = True
+    interrupt_kernel(session.id)
+    if stream is not None:
+        # przerywa oczekiwanie na kolejny chunk, a nie dopiero po jego nadejściu
+        await stream.close()
 
-    session["stop_generation"] = False
 
+def request_stop(session_id):
+    with _db_lock:
+        db = get_db()
+        with db:
+            db.execute("INSERT OR REPLACE INTO stop_requests VALUES (?, ?)", (session_id, time.time()))
 
-def stop_generation_func(session):
-    if DEBUG:
-        print(f"Stop generation called for session: {session['id']}")
-    session["stop_generation"] = True
 
+def take_stop_requests(session_ids):
+    """Żądania Stop dla sesji generowanych w tym procesie (usuwane przy odczycie)"""
+    placeholders = ",".join("?" * len(session_ids))
+    cutoff = time.time() - STOP_REQUEST_TTL
+    with _db_lock:
+        db = get_db()
+        with db:
+            rows = db.execute(f"SELECT session_id, requested FROM stop_requests WHERE session_id IN ({placeholders}) "
+                              f"AND requested >= ?", (*session_ids, cutoff)).fetchall()
+            db.execute(f"DELETE FROM stop_requests WHERE session_id IN ({placeholders}) OR requested < ?",
+                       (*session_ids, cutoff))
+    return rows
 
-def format_history(session, current_message=None):
-    history = []
 
-    for user_msg, asst_msg in zip(session["user_messages"], session["assistant_messages"]):
-        history.append({"role": "user", "content": user_msg})
-        history.append({"role": "assistant", "content": asst_msg})
+_stop_watcher = None
 
-    if len(session["user_messages"]) > len(session["assistant_messages"]):
-        history.append({"role": "user", "content": session["user_messages"][-1]})
+
+async def watch_stop_requests():
+    while True:
+        await asyncio.sleep(STOP_POLL_SECONDS)
+        running = set(active_streams).union(session_id for session_id, kernel in kernels.items()
+                                             if kernel_running(kernel))
+        if not running:
+            continue
+        for session_id, requested in await asyncio.to_thread(take_stop_requests, list(running)):
+            session = resident_sessions.get(session_id)
+            # Stop kliknięty przed startem tej odpowiedzi jej nie dotyczy
+            if session is not None and requested >= session.generation_started:
+                await stop_generation_func(session)
+
+
+def ensure_stop_watcher():
+    global _stop_watcher
+    if WORKER_INDEX is not None and _stop_watcher is None:
+        _stop_watcher = asyncio.get_running_loop().create_task(watch_stop_requests())
+
+
+def reset_history(session):
+    """Wyczyść przyrostowy widok historii - zostanie odbudowany przy następnym format_history"""
+    session.history_from = min(session.history_from, len(session.turns))
+    session.history = []
+    session.history_turns = session.history_from  # ile zakończonych odpowiedzi jest już w widoku
+    session.history_users = session.history_from  # ile wiadomości usera jest już w widoku
+    session.history_live = False  # czy ostatni wpis to streamowany ogon
+
+
+def reset_context(session):
+    """Wyczyść sumy tokenów tur - zostaną policzone przy następnym zapytaniu"""
+    session.api_turns = 0
+    session.api_token_prefix = [0]  # [i] = szacowane tokeny tur 0..i-1
+    session.context_start = 0       # pierwsza tura w oknie kontekstu
+    session.context_pinned = []     # tury sprzed okna, które zostają (output wykonania kodu)
+
+
+def truncate_context(session, turns):
+    """Zostaje tylko pierwsze `turns` tur (gałąź) - sumy tokenów i okno kontekstu wspólnego prefiksu
+    się nie zmieniają, więc zapytania nowej gałęzi zaczynają się tak samo (trafienia w prompt cache)"""
+    if session.context_start > turns:
+        reset_context(session)
+        return
+    session.api_turns = min(session.api_turns, turns)
+    del session.api_token_prefix[session.api_turns + 1:]
+
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 4
+
+
+def sync_turn_tokens(session):
+    """Dolicza do sum prefiksowych tokeny tur zakończonych od ostatniego zapytania.
+
+    Wiadomości każdej tury są czyszczone raz (Turn.messages), więc budowa
+    zapytania nie zależy od długości historii.
+    """
+    turns = session.turns
+    prefix = session.api_token_prefix
+    while session.api_turns < len(turns):
+        prefix.append(prefix[-1] + turns[session.api_turns].tokens())
+        session.api_turns += 1
+    return turns
+
+
+def is_pinned_turn(turn):
+    """Tura z outputem wykonania kodu - kolejne tury zwykle się do niego odwołują"""
+    return AUTO_REPLY_START in turn.user or PY_OUTPUT_MARK in turn.assistant
+
+
+def build_context(session, message, system_prompt):
+    """Wiadomości do zapytania, mieszczące się w CONTEXT_BUDGET_TOKENS.
+
+    Tokeny są szacowane raz na turę (sumy prefiksowe), więc w typowym
+    przypadku sprawdzenie budżetu to O(1). Po przekroczeniu budżetu
+    początek okna przesuwa się od razu do CONTEXT_TRIM_TARGET, żeby
+    kolejne tury miały ten sam prefiks (trafienia w prompt cache).
+    """
+    completed = sync_turn_tokens(session)
+    prefix = session.api_token_prefix
+    turns = session.api_turns
+    scale = session.context_scale
+    fixed = estimate_tokens(system_prompt) + estimate_tokens(message)
+    pinned = session.context_pinned
+    start = session.context_start = min(session.context_start, turns)
+
+    def pinned_tokens():
+        return sum(prefix[i + 1] - prefix[i] for i in pinned) * scale
+
+    def window_tokens():
+        return (fixed + prefix[turns] - prefix[start]) * scale + pinned_tokens()
+
+    if window_tokens() > CONTEXT_BUDGET_TOKENS:
+        target = CONTEXT_BUDGET_TOKENS * CONTEXT_TRIM_TARGET
+        while start < turns - 1 and window_tokens() > target:
+            if is_pinned_turn(completed[start]):
+                pinned.append(start)
+                # przypięte tury nie mogą wypychać z okna najnowszych
+                while pinned_tokens() > CONTEXT_BUDGET_TOKENS * CONTEXT_PINNED_SHARE:
+                    pinned.pop(0)
+            start += 1
+        # same przypięte tury też muszą się zmieścić - najstarsze wypadają pierwsze
+        while pinned and window_tokens() > target:
+            pinned.pop(0)
+        session.context_start = start
+
+    session.context_estimate = int(window_tokens() / scale)
+    session.context_trimmed = start - len(pinned)
+    messages = []
+    for turn in pinned:
+        messages.extend(completed[turn].messages())
+    for turn in completed[start:turns]:
+        messages.extend(turn.messages())
+    if start == 0:
+        return messages
+
+    messages[0] = {
+        "role": "user",
+        "content": CONTEXT_TRIMMED_NOTE.format(session.context_trimmed) + messages[0]["content"]
+    }
+    return messages
+
+
+def reopen_last_turn(session):
+    """Ostatnia tura została podmieniona (np. dopisany output) - wyrenderuj i zapisz ją jeszcze raz"""
+    turns = len(session.turns)
+    if session.stored_turns:
+        session.stored_turns = min(session.stored_turns, turns - 1)
+
+    # zwykle tury odpowiedzi nie ma jeszcze w sumach tokenów (build_context liczy je przed zapytaniem) -
+    # wtedy okno kontekstu i przypięte tury zostają bez zmian, a prefiks zapytań (prompt cache) ten sam
+    if session.api_turns == turns > 0:
+        session.api_token_prefix.pop()
+        session.api_turns -= 1
+        if session.context_pinned and session.context_pinned[-1] >= session.api_turns:
+            session.context_pinned.pop()
+    elif session.api_turns > turns:
+        reset_context(session)
+
+    history = session.history
+    if session.history_live:
+        history.pop()
+        session.history_live = False
+
+    if (session.history_turns == turns > 0 and session.history_users == turns
+            and history and history[-1]["role"] == "assistant"):
+        history.pop()
+        session.history_turns -= 1
+    else:
+        reset_history(session)
+
+
+def common_prefix(turns, other):
+    """Ile pierwszych tur mają wspólnych dwie gałęzie - prefiks to te same obiekty Turn"""
+    shared = 0
+    for turn, other_turn in zip(turns, other):
+        if turn is not other_turn:
+            break
+        shared += 1
+    return shared
+
+
+def branch_forks(session):
+    """Dla każdej odłożonej gałęzi: ile tur dzieli z aktywną (None w miejscu aktywnej)"""
+    return tuple(None if branch is None else common_prefix(session.turns, branch) for branch in session.branches)
+
+
+def fork_branch(session, turns):
+    """Nowa aktywna gałąź z pierwszych `turns` tur. Tury nie są kopiowane - nowa lista trzyma
+    referencje do tych samych (niezmiennych) obiektów Turn, dotychczasowa gałąź zostaje odłożona."""
+    if not session.branches:
+        session.branches = [None]
+    session.branches[session.branch] = session.turns
+    session.branches.append(None)
+    session.branch = len(session.branches) - 1
+    session.turns = session.turns[:turns]
+    # w magazynie od tego miejsca są tury odłożonej gałęzi - następny zapis nadpisze je od fork
+    session.stored_turns = min(session.stored_turns or 0, turns)
+    truncate_context(session, turns)
+    reset_history(session)
+
+
+def switch_branch(session, branch):
+    turns = session.branches[branch]
+    shared = common_prefix(session.turns, turns)
+    session.branches[session.branch] = session.turns
+    session.branches[branch] = None
+    session.branch = branch
+    session.turns = turns
+    session.stored_turns = min(session.stored_turns or 0, shared)
+    truncate_context(session, shared)
+    session.history_from = max(0, len(turns) - HISTORY_VIEW_TURNS)
+    reset_history(session)
+
+
+def view_turn(session, index):
+    """Numer tury dla indeksu wiadomości w gr.Chatbot (widok zaczyna się od history_from,
+    pytania auto-reply nie są pokazywane)"""
+    entry = 0
+    for i in range(session.history_from, len(session.turns)):
+        if AUTO_REPLY_START not in session.turns[i].user:
+            if entry == index:
+                return i
+            entry += 1
+        if entry == index:
+            return i
+        entry += 1
+    return None
+
+
+def branch_labels(session):
+    """(opis, numer) gałęzi do przełącznika"""
+    labels = []
+    for branch, turns in enumerate(session.branches):
+        if turns is None:
+            labels.append((f"{branch + 1}: current", branch))
+            continue
+        fork = common_prefix(session.turns, turns)
+        question = turns[fork].user.strip().split("\n")[0][:BRANCH_LABEL_CHARS] if len(turns) > fork else ""
+        labels.append((f"{branch + 1}: {len(turns)} turn(s), from turn {fork + 1}: {question}", branch))
+    return labels
+
+
+async def format_history(session, current_message=None, plot_blocks=None):
+    """Przyrostowy widok historii.
+
+    Zakończone tury są renderowane raz i zostają w session.history bez zmian,
+    per chunk podmieniany jest tylko ostatni (streamowany) wpis. Wpisy bez
+    wykresów to te same dicty, które idą do API (Turn.messages) - bez kopii.
+    """
+    turns = session.turns
+    if session.history_users > len(turns) + (session.pending is not None):
+        reset_history(session)  # pytanie przerwane przed odpowiedzią zniknęło z historii
+
+    first = session.history_turns
+    rendered = await asyncio.gather(*(render_plots_in_message(turn.assistant) for turn in turns[first:]))
+    if session.history_turns != first or session.turns is not turns:
+        # w trakcie renderowania ktoś zmienił historię (delete/clear/import) - zacznij od nowa
+        return await format_history(session, current_message, plot_blocks)
+
+    # od tego miejsca bez await, więc widok zmienia się atomowo
+    history = session.history
+    if session.history_live:
+        history.pop()
+        session.history_live = False
+
+    for i, content in enumerate(rendered, first):
+        user, assistant = turns[i].messages()
+        if session.history_users <= i:
+            append_user_entry(session, user)
+        elif history and history[-1]["role"] == "user" and history[-1]["content"] is user["content"]:
+            history[-1] = user  # pytanie pokazane w trakcie odpowiedzi - odtąd wspólny dict tury
+        history.append(assistant if content is turns[i].assistant and content is assistant["content"]
+                       else {"role": "assistant", "content": content})
+        session.history_turns += 1
+
+    if session.pending is not None and session.history_users == len(turns):
+        append_user_entry(session, {"role": "user", "content": session.pending})
 
     if current_message:
-        history.append({"role": "assistant", "content": current_message})
+        # gotowe wykresy z cache, brakujące renderują się w tle, reszta ogona to surowy tekst
+        history.append({"role": "assistant", "content": render_plots_available(current_message, plot_blocks)})
+        session.history_live = True
 
     return history
 
-def format_history_with_rendering(session):
-    """Format history i renderuj wykresy (ta sama logika co w respond)"""
-    history = format_history(session)
 
-    for i, msg in enumerate(history):
-        if msg.get("role") == "assistant":
-            content = msg["content"]
+def append_user_entry(session, entry):
+    # auto-reply to output kodu dla modelu, nie pokazujemy go w GUI
+    if AUTO_REPLY_START not in entry["content"]:
+        session.history.append(entry)
+    session.history_users += 1
 
-            if content not in session["rendered_messages"]:
-                session["rendered_messages"][content] = render_plots_in_message(content)
-            history[i]["content"] = session["rendered_messages"][content]
 
-    history = [msg for msg in history if not (msg.get("role") == "user" and AUTO_REPLY_START in msg.get("content", ""))]
-
-    return history
+async def format_history_with_rendering(session):
+    """Pełna odbudowa widoku historii (np. po imporcie)"""
+    reset_history(session)
+    return await format_history(session)
 
 css = """
     .chat-message { padding: 10px; margin-bottom: 10px; border-radius: 15px; }
@@ -295,385 +2009,1345 @@ css = """
 """
 
 
-def export_history_yaml(session):
-    import yaml
-    import sys
-
+def export_history_yaml(session, export_format="YAML"):
     logging.debug(f"DEBUG export: type={type(session)}")
 
 
-    if not session or not isinstance(session, dict):
+    if not isinstance(session, Session):
         logging.debug(f"ERROR: Invalid session type")
         return None
 
-    if "id" not in session:
-        logging.debug(f"ERROR: Session missing 'id' key")
-        return None
-
-    data = {
-        "session_id": session["id"],
-        "conversation": []
-    }
-
-    for user_msg, asst_msg in zip(session["user_messages"], session["assistant_messages"]):
-        data["conversation"].append({"role": "user", "content": user_msg})
-        data["conversation"].append({"role": "assistant", "content": asst_msg})
+    touch_session(session)
+    started = time.monotonic()
 
     current_time = datetime.now()
-    filename = f"chat_history_{current_time.strftime('%Y_%m_%d_%H_%M')}.yaml"
+    extension = "jsonl" if export_format == "JSONL" else "yaml"
+    filename = f"chat_history_{current_time.strftime('%Y_%m_%d_%H_%M')}.{extension}"
     temp_dir = tempfile.gettempdir()
     temp_path = os.path.join(temp_dir, filename)
 
-    with open(temp_path, 'w') as temp_file:
-        yaml.dump(data, temp_file, default_flow_style=False, sort_keys=False, allow_unicode=True)
+    # zapis tura po turze - cała historia nie jest budowana drugi raz w pamięci
+    with open(temp_path, 'w', encoding='utf-8') as temp_file:
+        if export_format == "JSONL":
+            temp_file.write(json.dumps({"session_id": session.id}, ensure_ascii=False) + "\n")
+        else:
+            yaml.dump({"session_id": session.id}, temp_file, Dumper=YamlDumper, allow_unicode=True)
+            # pusty klucz YAML to None - pusta rozmowa musi być zapisana jako lista
+            temp_file.write("conversation:\n" if session.turns else "conversation: []\n")
+
+        for turn in session.turns:
+            entries = [{"role": "user", "content": turn.user}, {"role": "assistant", "content": turn.assistant}]
+            if export_format == "JSONL":
+                for entry in entries:
+                    temp_file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            else:
+                yaml.dump(entries, temp_file, Dumper=YamlDumper, default_flow_style=False, sort_keys=False, allow_unicode=True)
 
+    observe("history_export_seconds", time.monotonic() - started)
+    increment("history_exports_total")
     return temp_path
 
-def render_plots_in_message(message):
-    """Renderuje wykresy w wiadomości zawierającej kod Python z matplotlib"""
+plot_store_files = OrderedDict()  # nazwa pliku -> rozmiar, od najdawniej używanego
+plot_store_bytes = 0
+plot_store_lock = threading.Lock()  # plot_store_put chodzi w wątkach (asyncio.to_thread)
+
+
+def init_plot_store():
+    """Wczytuje pliki zostawione przez poprzednie uruchomienie (kolejność wg mtime)"""
+    global plot_store_bytes
+    os.makedirs(PLOT_STORE_DIR, exist_ok=True)
+    entries = [entry for entry in os.scandir(PLOT_STORE_DIR) if entry.name.endswith('.png')]
+    for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime):
+        size = entry.stat().st_size
+        plot_store_files[entry.name] = size
+        plot_store_bytes += size
+    evict_plot_store()
+
+
+def evict_plot_store():
+    global plot_store_bytes
+    while plot_store_bytes > PLOT_STORE_MAX_BYTES and plot_store_files:
+        name, size = plot_store_files.popitem(last=False)
+        plot_store_bytes -= size
+        try:
+            os.remove(os.path.join(PLOT_STORE_DIR, name))
+        except FileNotFoundError:
+            pass
+
+
+def plot_store_put(png):
+    """Zapisuje PNG raz pod nazwą z hasha zawartości i zwraca ścieżkę pliku"""
+    global plot_store_bytes
+    name = hashlib.sha256(png).hexdigest() + '.png'
+    path = os.path.join(PLOT_STORE_DIR, name)
+
+    if name in plot_store_files and os.path.exists(path):
+        with plot_store_lock:
+            plot_store_files.move_to_end(name)
+        os.utime(path)
+        return path
+
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, 'wb') as file:
+        file.write(png)
+    os.replace(tmp_path, path)
+
+    with plot_store_lock:
+        plot_store_bytes -= plot_store_files.pop(name, 0)
+        plot_store_files[name] = len(png)
+        plot_store_bytes += len(png)
+        evict_plot_store()
+    return path
+
+
+def plot_url(path):
+    return f"/gradio_api/file={path}"
+
+
+# sha256 bloku kodu -> (fragment wstawiany za blokiem: img albo błąd, ścieżka PNG albo None)
+render_cache = OrderedDict()
+render_cache_bytes = 0
+render_cache_stats = {"hits": 0, "misses": 0, "evictions": 0}
+render_failures = {}  # klucz -> (fragment z błędem, do kiedy pokazywać) - błędy przejściowe, poza LRU
+
+
+def code_block_key(code):
+    return hashlib.sha256(code.encode('utf-8')).hexdigest()
+
+
+def render_cache_get(key):
+    value = render_cache.get(key)
+    if value is not None and value[1] is not None and not os.path.exists(value[1]):
+        # plik wykresu usunięty z magazynu - wyrenderuj jeszcze raz
+        render_cache_discard(key)
+        value = None
+    if value is None:
+        failure = render_failures.get(key)
+        if failure is not None and failure[1] > time.monotonic():
+            return failure[0]
+        render_failures.pop(key, None)
+        render_cache_stats["misses"] += 1
+        return None
+    render_cache.move_to_end(key)
+    render_cache_stats["hits"] += 1
+    return value[0]
+
+
+def render_cache_discard(key):
+    global render_cache_bytes
+    if key in render_cache:
+        render_cache_bytes -= len(render_cache.pop(key)[0].encode('utf-8'))
+
+
+def render_cache_put(key, fragment, path=None):
+    global render_cache_bytes
+    size = len(fragment.encode('utf-8'))
+    if size > RENDER_CACHE_MAX_BYTES:
+        return
+
+    render_cache_discard(key)
+    render_cache[key] = (fragment, path)
+    render_cache_bytes += size
+
+    while render_cache_bytes > RENDER_CACHE_MAX_BYTES:
+        _, (evicted, _) = render_cache.popitem(last=False)
+        render_cache_bytes -= len(evicted.encode('utf-8'))
+        render_cache_stats["evictions"] += 1
 
-    modified_message = message
+
+def render_cache_info():
+    return {**render_cache_stats, "entries": len(render_cache), "bytes": render_cache_bytes}
+
+
+SANDBOX_WORKER_SOURCE = r"""
+import sys, os, io, json, base64, resource, contextlib, warnings, signal
+
+# SIGINT (Stop, timeout kernela) przerywa tylko wykonywany kod - nie import ani czekanie na zadanie
+signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+memory_limit = int(sys.argv[1])
+if memory_limit > 0:
+    resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+# wyniki idą prywatnym deskryptorem, a stdout procesu (także z C) do /dev/null
+results = os.fdopen(os.dup(1), 'w')
+os.dup2(os.open(os.devnull, os.O_WRONLY), 1)
+sys.stdout = open(os.devnull, 'w')
+
+warnings.filterwarnings('ignore', message='Glyph.*missing from font')
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy
+try:
+    import seaborn
+except ImportError:
+    pass
+
+namespace = {}  # zmienne kernela sesji - tylko dla zadań z "keep"
+
+for line in sys.stdin:
+    job = json.loads(line)
+    soft, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu_limit = int(usage.ru_utime + usage.ru_stime) + job["cpu"]
+    if hard != resource.RLIM_INFINITY:
+        cpu_limit = min(cpu_limit, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (cpu_limit, hard))
+
+    result = {}
+    # stdout od razu do pliku rodzica - po zabiciu procesu (timeout, limit CPU/pamięci) zostaje to, co już wypisał
+    captured = io.TextIOWrapper(open(job["stdout"], 'wb', buffering=0), encoding='utf-8', write_through=True)
+    try:
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        with contextlib.redirect_stdout(captured):
+            if job["kind"] == "plot":
+                plt.close('all')
+                plt.style.use('default')
+                exec(job["code"], {})
+                buf = io.BytesIO()
+                plt.savefig(buf, format='png', dpi=120, bbox_inches='tight')
+                result["png"] = base64.b64encode(buf.getvalue()).decode()
+                plt.close('all')
+            else:
+                exec(job["code"], namespace if job.get("keep") else {})
+    except KeyboardInterrupt:
+        result["error"] = "Execution interrupted"
+    except BaseException as e:
+        # MemoryError z RLIMIT_AS nie ma treści - wtedy sama nazwa wyjątku
+        result["error"] = f"{type(e).__name__}: {e}" if str(e) else type(e).__name__
+    finally:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        captured.close()
+    results.write(json.dumps(result) + "\n")
+    results.flush()
+"""
+
+sandbox_warm = []    # workery uruchomione zaraz po otwarciu portu (warm_up), zanim ktoś o nie poprosi
+sandbox_idle = None  # asyncio.Queue z wolnymi workerami
+sandbox_warm_lock = threading.Lock()  # warm_up działa w osobnym wątku
+
+
+def spawn_sandbox_worker(memory_limit=SANDBOX_MEMORY_BYTES):
+    worker_env = dict(os.environ, OPENBLAS_NUM_THREADS='1', MPLBACKEND='Agg')
+    return subprocess.Popen(
+        [sys.executable, '-c', SANDBOX_WORKER_SOURCE, str(memory_limit)],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=worker_env, text=True
+    )
+
+
+def start_sandbox_pool():
+    """Rozgrzana pula: matplotlib/numpy/seaborn są już zaimportowane, zanim przyjdzie pierwszy wykres"""
+    with sandbox_warm_lock:
+        while len(sandbox_warm) < SANDBOX_WORKERS:
+            sandbox_warm.append(spawn_sandbox_worker())
+
+
+def sandbox_stdout():
+    """Plik na stdout wykonywanego kodu - worker pisze do niego bez buforowania"""
+    return tempfile.NamedTemporaryFile('r', encoding='utf-8', errors='replace', prefix='claude-chat-stdout-')
+
+
+def sandbox_call(worker, job):
+    worker.stdin.write(json.dumps(job) + "\n")
+    worker.stdin.flush()
+    line = worker.stdout.readline()
+    if not line:
+        raise EOFError("Sandbox worker exited")
+    return json.loads(line)
+
+
+async def run_in_sandbox(kind, code):
+    """Wykonuje kod w wolnym workerze z puli; zwraca dict z 'stdout' i 'png' albo 'error'"""
+    global sandbox_idle
+    if sandbox_idle is None:
+        start_sandbox_pool()
+        sandbox_idle = asyncio.Queue()
+        for worker in sandbox_warm:
+            sandbox_idle.put_nowait(worker)
+
+    waiting = time.monotonic()
+    worker = await sandbox_idle.get()
+    observe("sandbox_queue_wait_seconds", time.monotonic() - waiting)
+    with sandbox_stdout() as stdout:
+        job = {"kind": kind, "code": code, "cpu": SANDBOX_CPU_SECONDS, "stdout": stdout.name}
+        healthy = False
+        try:
+            result = await asyncio.wait_for(asyncio.to_thread(sandbox_call, worker, job), SANDBOX_WALL_SECONDS)
+            healthy = True
+        except asyncio.TimeoutError:
+            result = {"error": f"Execution timed out after {SANDBOX_WALL_SECONDS} s", "aborted": True}
+        except (EOFError, OSError, ValueError):
+            # przekroczony limit CPU albo pamięci zabija proces workera
+            result = {"error": "Execution aborted: CPU or memory limit exceeded", "aborted": True}
+        finally:
+            if not healthy:
+                worker.kill()
+                worker = spawn_sandbox_worker()
+            sandbox_idle.put_nowait(worker)
+        result["stdout"] = stdout.read()
+
+    return result
+
+
+kernels = {}  # id sesji -> {"process", "lock", "call", "last_used"} - kernel z trwałym namespace
+_kernel_reaper = None
+
+
+def kernel_running(kernel):
+    return kernel["call"] is not None and not kernel["call"].done()
+
+
+def kernel_kill(session_id, kernel):
+    kernel["process"].kill()
+    if kernels.get(session_id) is kernel:
+        del kernels[session_id]
+
+
+def shutdown_kernel(session_id):
+    kernel = kernels.get(session_id)
+    if kernel is not None:
+        kernel_kill(session_id, kernel)
+        logging.debug(f"Kernel of session {session_id} shut down")
+
+
+def get_kernel(session_id):
+    """Kernel sesji - nowy, jeśli go nie było albo proces nie żyje. None, gdy wszystkie miejsca
+    zajmują kernele wykonujące właśnie kod"""
+    kernel = kernels.get(session_id)
+    if kernel is not None and kernel["process"].poll() is None:
+        return kernel
+    shutdown_kernel(session_id)
+    while len(kernels) >= KERNEL_MAX_PROCESSES:
+        idle = [(kernel["last_used"], session_id) for session_id, kernel in kernels.items()
+                if not kernel_running(kernel) and not kernel["lock"].locked()]
+        if not idle:
+            return None
+        shutdown_kernel(min(idle)[1])
+    kernel = {"process": spawn_sandbox_worker(KERNEL_MEMORY_BYTES), "lock": asyncio.Lock(), "call": None,
+              "last_used": time.monotonic()}
+    kernels[session_id] = kernel
+    increment("kernel_starts_total")
+    ensure_kernel_reaper()
+    return kernel
+
+
+def interrupt_kernel(session_id, kernel=None):
+    """SIGINT do komórki wykonywanej w kernelu (Stop, timeout); zmienne zostają. Komórka, która
+    nie wróci w KERNEL_INTERRUPT_SECONDS (np. długie wywołanie w C), traci proces razem ze zmiennymi"""
+    kernel = kernel or kernels.get(session_id)
+    if kernel is None or not kernel_running(kernel):
+        return False
+    call = kernel["call"]
+    kernel["process"].send_signal(signal.SIGINT)
+    increment("kernel_interrupts_total")
+    asyncio.get_running_loop().call_later(
+        KERNEL_INTERRUPT_SECONDS, lambda: call.done() or kernel_kill(session_id, kernel))
+    return True
+
+
+async def kernel_call(session_id, kernel, code):
+    with sandbox_stdout() as stdout:
+        job = {"kind": "py", "code": code, "cpu": SANDBOX_CPU_SECONDS, "keep": True, "stdout": stdout.name}
+        result = await kernel_wait(session_id, kernel, job)
+        result["stdout"] = stdout.read()
+    return result
+
+
+async def kernel_wait(session_id, kernel, job):
+    call = asyncio.ensure_future(asyncio.to_thread(sandbox_call, kernel["process"], job))
+    call.add_done_callback(lambda call: call.cancelled() or call.exception())
+    kernel["call"] = call
+    timed_out = False
+    try:
+        await asyncio.wait_for(asyncio.shield(call), SANDBOX_WALL_SECONDS)
+    except asyncio.TimeoutError:
+        timed_out = interrupt_kernel(session_id, kernel)
+    except asyncio.CancelledError:
+        # odrzucone wykonanie wczesne albo przerwana odpowiedź - kolejna komórka czeka, aż ta wróci
+        interrupt_kernel(session_id, kernel)
+        await asyncio.wait([call])
+        raise
+    except (EOFError, OSError, ValueError):
+        pass
+    await asyncio.wait([call])
+    kernel["last_used"] = time.monotonic()
+
+    if call.exception() is not None:
+        # limit CPU/pamięci, komórka głucha na Stop albo Restart kernel - proces nie żyje
+        kernel_kill(session_id, kernel)
+        return {"error": "Kernel stopped (CPU or memory limit exceeded, or not responding to Stop); "
+                         "variables were lost, the next block starts a new kernel"}
+    result = call.result()
+    if timed_out:
+        result["error"] = f"Execution timed out after {SANDBOX_WALL_SECONDS} s"
+    return result
+
+
+async def run_in_kernel(session_id, code):
+    """Wykonuje %py inline w kernelu sesji: zmienne i importy zostają na kolejne bloki"""
+    while True:
+        kernel = get_kernel(session_id)
+        if kernel is None:
+            return await run_in_sandbox("py", code)  # limit kerneli - blok idzie do puli jak bez kernela
+        async with kernel["lock"]:
+            if kernel["call"] is not None:
+                await asyncio.wait([kernel["call"]])  # przerwana komórka poprzedniego wywołania
+            if kernels.get(session_id) is kernel:
+                return await kernel_call(session_id, kernel, code)
+
+
+async def reap_idle_kernels():
+    while True:
+        await asyncio.sleep(KERNEL_CHECK_SECONDS)
+        now = time.monotonic()
+        for session_id, kernel in list(kernels.items()):
+            if (not kernel_running(kernel) and not kernel["lock"].locked()
+                    and now - kernel["last_used"] > KERNEL_IDLE_SECONDS):
+                kernel_kill(session_id, kernel)
+                logging.debug(f"Idle kernel of session {session_id} shut down")
+
+
+def ensure_kernel_reaper():
+    global _kernel_reaper
+    if _kernel_reaper is None:
+        _kernel_reaper = asyncio.get_running_loop().create_task(reap_idle_kernels())
+
+
+async def restart_kernel(session):
+    """Przycisk Restart kernel: kolejny blok %py inline startuje z pustym namespace"""
+    shutdown_kernel(session.id)
+
+
+render_pending = {}  # klucz bloku -> Task, żeby ten sam wykres nie renderował się równolegle dwa razy
+
+
+async def _render_plot_block(key, code):
+    code_lines = [line for line in code.split('\n')
+                  if not line.strip() == MATPLOT_START
+                  and not 'plt.show()' in line]
+
+    started = time.monotonic()
+    result = await run_in_sandbox("plot", '\n'.join(code_lines))
+    observe("plot_render_seconds", time.monotonic() - started)
+    increment("plot_renders_total")
+    path = None
+    if "error" not in result:
+        path = await asyncio.to_thread(plot_store_put, base64.b64decode(result["png"]))
+        rendered = "\n" + f'<img src="{plot_url(path)}">'
+    else:
+        error_lines = [f"{i+1}: {line}" for i, line in enumerate(code_lines)]
+        error_code = '\n'.join(error_lines)
+        rendered = f"\nError generating plot: '{result['error']}'\nProblematic code:\n{error_code}"
+        increment("plot_render_errors_total")
+        print(rendered)
+
+    if result.get("aborted"):
+        # wynik zależy od obciążenia, nie od kodu - do cache idą tylko wykresy i błędy samego kodu
+        now = time.monotonic()
+        for stale in [stale for stale, (_, until) in render_failures.items() if until <= now]:
+            del render_failures[stale]
+        render_failures[key] = (rendered, now + RENDER_RETRY_SECONDS)
+    else:
+        render_cache_put(key, rendered, path)
+    return rendered
+
+
+def schedule_plot_render(key, code):
+    task = render_pending.get(key)
+    if task is None:
+        task = asyncio.get_running_loop().create_task(_render_plot_block(key, code))
+        render_pending[key] = task
+        task.add_done_callback(lambda _: render_pending.pop(key, None))
+    return task
+
+
+async def render_plot_block(code):
+    """Zwraca fragment do wstawienia za blokiem z wykresem.
+
+    Klucz to hash samego bloku, więc ten sam wykres w kolejnych wersjach
+    wiadomości (i w innych sesjach) renderuje się tylko raz.
+    """
+    key = code_block_key(code)
+    rendered = render_cache_get(key)
+    if rendered is not None:
+        return rendered
+    # shield: anulowanie jednego czekającego nie przerywa renderu współdzielonego z innymi
+    return await asyncio.shield(schedule_plot_render(key, code))
+
+
+def find_plot_blocks(message):
+    """Zamknięte bloki kodu z wykresami jako lista (pozycja za blokiem, kod)"""
+    blocks = []
     start_idx = 0
 
     while True:
-        python_start = modified_message.find(PYTHON_START, start_idx)
+        python_start = message.find(PYTHON_START, start_idx)
         if python_start == -1:
             break
 
         code_start = python_start + PYTHON_START_LEN
-        code_end = modified_message.find(PYTHON_END, code_start)
+        code_end = message.find(PYTHON_END, code_start)
         if code_end == -1:
             break
 
-        code = modified_message[code_start:code_end].strip()
-        should_render_plot = MATPLOT_START in code and 'matplotlib' in code
+        code = message[code_start:code_end].strip()
+        if MATPLOT_START in code and 'matplotlib' in code:
+            blocks.append((code_end + PYTHON_END_LEN, code))
 
-        if should_render_plot:
-            try:
-                plt.close('all')
-                plt.style.use('default')
+        start_idx = code_end + PYTHON_END_LEN
 
-                namespace = {}
-                code_lines = [line for line in code.split('\n')
-                            if not line.strip() == MATPLOT_START
-                            and not 'plt.show()' in line]
+    return blocks
+
+
+def insert_rendered_plots(message, blocks, rendered):
+    parts = []
+    last = 0
+    for (position, _), fragment in zip(blocks, rendered):
+        if fragment is None:
+            continue
+        parts.append(message[last:position])
+        parts.append(fragment)
+        last = position
+    parts.append(message[last:])
+    return ''.join(parts)
+
+
+async def render_plots_in_message(message):
+    """Renderuje wykresy w wiadomości zawierającej kod Python z matplotlib.
+
+    Renderowane są tylko zamknięte bloki, a sama wiadomość nie trafia do cache.
+    """
+    blocks = find_plot_blocks(message)
+    if not blocks:
+        return message
+    rendered = await asyncio.gather(*(render_plot_block(code) for _, code in blocks))
+    return insert_rendered_plots(message, blocks, rendered)
+
+
+def render_plots_available(message, blocks=None):
+    """Jak render_plots_in_message, ale bez czekania - dla streamowanej odpowiedzi.
+
+    Wstawia wykresy już obecne w cache, brakujące zleca puli w tle,
+    więc streaming idzie dalej, a wykres pojawia się przy kolejnym chunku.
+    blocks: bloki znalezione już przez scan_fences (bez ponownego skanowania całej wiadomości).
+    """
+    if blocks is None:
+        blocks = find_plot_blocks(message)
+    if not blocks:
+        return message
+
+    rendered = []
+    for _, code in blocks:
+        key = code_block_key(code)
+        fragment = render_cache_get(key)
+        if fragment is None:
+            schedule_plot_render(key, code)
+        rendered.append(fragment)
+    return insert_rendered_plots(message, blocks, rendered)
+
+
+def new_fence_scan():
+    return {
+        "pos": 0,             # do tego miejsca tekst jest przejrzany
+        "floor": 0,           # koniec ostatniego zamkniętego bloku - przed nim nic już nie szukamy
+        "code_start": None,   # początek kodu otwartego bloku
+        "blocks": [],         # zamknięte bloki ```python jako (pozycja za blokiem, kod)
+        "plots": []           # te z nich, które są wykresami (jak find_plot_blocks)
+    }
 
-                exec('\n'.join(code_lines), namespace)
 
-                buf = io.BytesIO()
-                plt.savefig(buf, format='png', dpi=120, bbox_inches='tight')
-                buf.seek(0)
-                img_html = f'<img src="data:image/png;base64,{base64.b64encode(buf.getvalue()).decode()}">'
-                modified_message = (modified_message[:code_end + PYTHON_END_LEN] +
-                                  "\n" + img_html +
-                                  modified_message[code_end + PYTHON_END_LEN:])
-                plt.close('all')
+def scan_fences(scan, message):
+    """Przyrostowy odpowiednik find_plot_blocks dla streamowanej odpowiedzi.
 
-            except Exception as e:
-                error_lines = [f"{i+1}: {line}" for i, line in enumerate(code_lines)]
-                error_code = '\n'.join(error_lines)
-                error_message = f"\nError generating plot: '{str(e)}'\nProblematic code:\n{error_code}"
-                modified_message = modified_message[:code_end + PYTHON_END_LEN] + error_message + modified_message[code_end + PYTHON_END_LEN:]
-                print(error_message)
+    Przegląda tylko tekst dopisany od poprzedniego wywołania (z zakładką na płot
+    przecięty między chunkami) i zwraca bloki zamknięte w tym kawałku.
+    """
+    if len(message) < scan["pos"]:
+        scan.update(new_fence_scan())  # tekst się skrócił (rstrip przed ponowieniem) - od nowa
+    closed = []
+    while True:
+        if scan["code_start"] is None:
+            start = message.find(PYTHON_START, max(scan["floor"], scan["pos"] - PYTHON_START_LEN + 1))
+            if start == -1:
+                scan["pos"] = len(message)
+                return closed
+            scan["code_start"] = scan["floor"] = scan["pos"] = start + PYTHON_START_LEN
+        end = message.find(PYTHON_END, max(scan["floor"], scan["pos"] - PYTHON_END_LEN + 1))
+        if end == -1:
+            scan["pos"] = len(message)
+            return closed
+        code = message[scan["code_start"]:end].strip()
+        block = (end + PYTHON_END_LEN, code)
+        scan["blocks"].append(block)
+        if MATPLOT_START in code and 'matplotlib' in code:
+            scan["plots"].append(block)
+        closed.append(block)
+        scan["floor"] = scan["pos"] = end + PYTHON_END_LEN
+        scan["code_start"] = None
+
+
+def py_block_code(code):
+    return '\n'.join(line for line in code.split('\n') if line.strip() != PY_COMP_START)
+
+
+def first_py_block(message):
+    """Kod pierwszego bloku ```python bez linii %py inline - to wykonuje respond"""
+    if PY_COMP_START not in message:
+        return None
+    start = message.find(PYTHON_START)
+    if start == -1:
+        return None
+    code_start = start + PYTHON_START_LEN
+    code_end = message.find(PYTHON_END, code_start)
+    if code_end == -1:
+        return None
+    return py_block_code(message[code_start:code_end].strip())
+
+
+async def run_py_block(code, kernel_id=None):
+    started = time.monotonic()
+    result = await (run_in_kernel(kernel_id, code) if kernel_id else run_in_sandbox("py", code))
+    observe("py_exec_seconds", time.monotonic() - started)
+    increment("py_exec_total")
+    if "error" in result:
+        increment("py_exec_errors_total")
+    return result
+
+
+def start_py_early(session, code):
+    """Blok %py inline zamknięty w trakcie streamingu: wykonanie rusza od razu, równolegle z resztą
+    odpowiedzi. respond użyje wyniku, jeśli gotowa odpowiedź ma w pierwszym bloku ten sam kod."""
+    early = session.py_early
+    if early is not None and early["code"] == code:
+        return  # ten sam blok znaleziony drugi raz po wznowieniu zerwanej odpowiedzi
+    discard_py_early(session)
+    # w kernelu sesji skutki komórki zostają, nawet jeśli gotowa odpowiedź będzie miała inny kod (rzadkie)
+    task = asyncio.get_running_loop().create_task(run_py_block(code, session.py_kernel))
+    session.py_early = {"code": code, "task": task}
+    increment("py_exec_early_total")
 
-        start_idx = code_end + PYTHON_END_LEN
 
-    return modified_message
+def discard_py_early(session):
+    early = session.py_early
+    session.py_early = None
+    if early is not None and not early["task"].done():
+        early["task"].cancel()  # run_in_sandbox zabija wtedy workera i uruchamia nowy, kernel dostaje SIGINT
 
 
-async def respond(message, temp, tokens, prefill_text, system_prompt, history, session):
+async def respond(message, temp, tokens, prefill_text, system_prompt, history, session, use_cache=False,
+                  use_kernel=False):
 
     if not message.strip():
         yield message, history
         return
 
+    log_session_id.set(session.id)
+    touch_session(session)
+    if session.sizeof() > SESSION_MAX_BYTES:
+        note = SESSION_FULL_NOTE.format(session.sizeof() / 1024 / 1024, SESSION_MAX_BYTES / 1024 / 1024)
+        yield message, history + [{"role": "assistant", "content": note}]
+        return
+    session.busy = True
+    # Stop z poprzedniej odpowiedzi (np. przerwana komórka bez outputu, po której nie było auto-reply)
+    # albo wciśnięty bez generowania nie może przerwać tej
+    session.stop_generation = False
+    session.py_kernel = session.id if use_kernel else None
+    turns_before = len(session.turns)
     try:
-        async for history in chat_with_claude(message, temp, tokens, session, prefill_text, system_prompt):
-            for i, msg in enumerate(history):
-                if msg.get("role") == "assistant":
-                    content = msg["content"]
-
-                    if content not in session["rendered_messages"]:
-                        session["rendered_messages"][content] = render_plots_in_message(content)
-                    history[i]["content"] = session["rendered_messages"][content]
-
+        async for history in chat_with_claude(message, temp, tokens, session, prefill_text, system_prompt, use_cache,
+                                              run_code_early=True):
             yield "", history
 
-        if session["assistant_messages"] and PY_COMP_START in session["assistant_messages"][-1]:
-            last_msg = session["assistant_messages"][-1]
-            # Znajdź blok kodu
-            start = last_msg.find(PYTHON_START)
-            if start != -1:
-                code_start = start + PYTHON_START_LEN
-                code_end = last_msg.find(PYTHON_END, code_start)
-                if code_end != -1:
-                    code = last_msg[code_start:code_end].strip()
-                    code_lines = [line for line in code.split('\n') if line.strip() != PY_COMP_START]
-                    clean_code = '\n'.join(code_lines)
-
-                    # Wykonaj kod
-                    from io import StringIO
-                    import sys
-                    old_stdout = sys.stdout
-                    sys.stdout = captured = StringIO()
-                    try:
-                        exec(clean_code, {})
-                        output = captured.getvalue()
-                        if output and output != "(no output)":
-                            session["assistant_messages"][-1] += f"\n\n**Python Output:**\n```\n{output}\n```"
-                    finally:
-                        sys.stdout = old_stdout
-
-                    # Przerenderuj GUI
-                    history = format_history(session)
-                    for i, msg in enumerate(history):
-                        if msg.get("role") == "assistant":
-                            content = msg["content"]
-                            if content not in session["rendered_messages"]:
-                                session["rendered_messages"][content] = render_plots_in_message(content)
-                            history[i]["content"] = session["rendered_messages"][content]
-                    yield "", history
-
-                    if output and output.strip():
-                        session["rendered_messages"].clear()
-                        await asyncio.sleep(0.1)
-                        auto_msg = f"{AUTO_REPLY_START}\nOutput from code execution:\n```\n{output.strip()}\n```\n{AUTO_REPLY_END}"
-
-                        async for new_history in chat_with_claude(auto_msg, temp, tokens, session, prefill_text, system_prompt):
-                            for i, msg in enumerate(new_history):
-                                if msg.get("role") == "assistant":
-                                    content = msg["content"]
-                                    if content not in session["rendered_messages"]:
-                                        session["rendered_messages"][content] = render_plots_in_message(content)
-                                    new_history[i]["content"] = session["rendered_messages"][content]
-
-                            new_history = [msg for msg in new_history if not (msg.get("role") == "user" and AUTO_REPLY_START in msg.get("content", ""))]
-
-                            yield "", new_history
+        # Stop przed pierwszym tokenem - nie ma nowej tury, więc nie ma czego wykonać
+        turn = session.turns[-1] if len(session.turns) > turns_before else None
+        clean_code = first_py_block(turn.assistant) if turn is not None else None
+        early = session.py_early
+        if clean_code is not None:
+            if early is not None and early["code"] == clean_code:
+                # wykonanie ruszyło, gdy blok się zamknął - zwykle już jest gotowe
+                session.py_early = None
+                result = await early["task"]
+            else:
+                # Wykonaj kod w sandboxie, streaming innych sesji idzie dalej
+                discard_py_early(session)
+                result = await run_py_block(clean_code, session.py_kernel)
+            output = result["stdout"]
+            if "error" in result:
+                # wyjątek w kodzie albo przerwane wykonanie (timeout, limit CPU/pamięci) - to, co kod
+                # zdążył wypisać, plus powód; auto-reply przekaże to Claude'owi
+                output = "\n".join(filter(None, [output.rstrip("\n"), f"⚠️ {result['error']}"]))
+            if output and output != "(no output)":
+                session.turns[-1] = Turn(turn.user, f"{turn.assistant}\n\n{PY_OUTPUT_MARK}\n```\n{output}\n```")
+
+            # Przerenderuj GUI - tylko ostatnia tura
+            reopen_last_turn(session)
+            yield "", await format_history(session)
+
+            if output and output.strip():
+                await asyncio.sleep(0.1)
+                auto_msg = f"{AUTO_REPLY_START}\nOutput from code execution:\n```\n{output.strip()}\n```\n{AUTO_REPLY_END}"
+
+                async for new_history in chat_with_claude(auto_msg, temp, tokens, session, prefill_text, system_prompt, use_cache):
+                    yield "", new_history
+
+        logging.debug(f"Render cache: {render_cache_info()}")
 
     except Exception as e:
             error_msg = f"⚠️ Connection error: {str(e)}\n\nYou can try sending the message again."
-            session["assistant_messages"].append(error_msg)
-            yield "", format_history(session)
+            if session.pending is not None:
+                # odpowiedź nie powstała - błąd zostaje odpowiedzią na to pytanie
+                session.turns.append(Turn(session.pending, error_msg))
+                session.pending = None
+            elif len(session.turns) > turns_before:
+                turn = session.turns[-1]
+                session.turns[-1] = Turn(turn.user, f"{turn.assistant}\n\n{error_msg}")
+                reopen_last_turn(session)
+            yield "", await format_history(session)
+
+    finally:
+        discard_py_early(session)
+        session.busy = False
+        persist_session(session)
 
 
 def clear_history(session):
     if DEBUG:
-        print(f"Clearing history for session: {session['id']}")
-    session["user_messages"] = []
-    session["assistant_messages"] = []
+        print(f"Clearing history for session: {session.id}")
+    touch_session(session)
+    session.turns = []
+    session.branches = []
+    session.branch = 0
+    session.pending = None
+    session.history_from = 0
+    reset_history(session)
+    reset_context(session)
+    persist_session(session)
     return [], ""
 
 
+IMG_TAG_RE = re.compile(r'<img[^>]*>')
+
+
 def strip_base64_images(content):
     """Usuwa tagi <img> z base64 - dla starych, zepsutych wielkich yaml"""
-    import re
-    return re.sub(r'<img[^>]*>', '', content)
+    return IMG_TAG_RE.sub('', content)
+
+
+def is_jsonl_file(file):
+    """JSONL zaczyna się od nagłówka {"session_id": ...}, YAML od klucza"""
+    start = file.read(64).lstrip()
+    file.seek(0)
+    return start.startswith('{')
+
+
+def read_history_file(file_path):
+    """Eksport YAML albo JSONL (format wykrywany automatycznie): (session_id, pary (user, assistant))"""
+    with open(file_path, 'r', encoding='utf-8') as file:
+        if is_jsonl_file(file):
+            # czytane linia po linii, bez wczytywania całego pliku
+            header = json.loads(file.readline())
+            session_id = header.get("session_id")
+            conversation = (json.loads(line) for line in file if line.strip())
+        else:
+            data = yaml.load(file, Loader=YamlLoader)
+            session_id = data.get("session_id")
+            conversation = data.get("conversation") or []
+
+        entries = iter(conversation)
+        turns = [(user_entry["content"], strip_base64_images(assistant_entry["content"]))
+                 for user_entry, assistant_entry in zip(entries, entries)
+                 if user_entry["role"] == "user" and assistant_entry["role"] == "assistant"]
+    return session_id, turns
 
 
 def import_history_yaml(file_path):
-    import yaml
+    """Import historii z YAML albo JSONL.
 
+    Sesja dostaje id z pliku tylko wtedy, gdy takiej nie ma w magazynie ani w pamięci -
+    eksport trwającej rozmowy (albo cudzy z tym samym id) staje się kopią, a nie ją nadpisuje.
+    """
     if file_path is None:
         return create_session()
 
-    with open(file_path, 'r') as file:
-        data = yaml.safe_load(file)
-
-    session = {
-        "id": data.get("session_id", str(uuid.uuid4())),
-        "user_messages": [],
-        "assistant_messages": [],
-        "rendered_messages": {},
-        "stop_generation": False
-    }
+    started = time.monotonic()
+    session = create_session()
 
-    conversation = data.get("conversation", [])
+    session_id, turns = read_history_file(file_path)
+    if session_id and session_id not in resident_sessions and not store_has_session(session_id):
+        session.id = session_id
+    session.turns = [Turn(user, assistant) for user, assistant in turns]
 
-    for i in range(0, len(conversation), 2):
-        if i+1 < len(conversation):
-            if conversation[i]["role"] == "user" and conversation[i+1]["role"] == "assistant":
-                session["user_messages"].append(conversation[i]["content"])
-                session["assistant_messages"].append(conversation[i+1]["content"])
+    session.history_from = max(0, len(session.turns) - HISTORY_VIEW_TURNS)
+    reset_history(session)
+    reset_context(session)
+    persist_session(session)
 
-    for i in range(len(session["assistant_messages"])):
-        session["assistant_messages"][i] = strip_base64_images(session["assistant_messages"][i])
+    observe("history_import_seconds", time.monotonic() - started)
+    increment("history_imports_total")
+    return session
 
-    session["rendered_messages"] = {}  # wyczyść cache, żeby wymusić re-rendering
 
-    return session
+def parse_history_file(path):
+    """Uruchamiane w procesie z puli (--index-dir); błąd jako tekst - wyjątki YAML nie zawsze dają się przesłać"""
+    try:
+        return read_history_file(path)
+    except Exception as e:
+        return f"{type(e).__name__}: {e}"
+
+
+def index_history_dirs(directories, jobs=None):
+    """--index-dir: pliki eksportu z katalogów (rekurencyjnie) do indeksu wyszukiwania.
+
+    Pliki są parsowane równolegle w procesach, zapis idzie z jednego procesu.
+    Niezmienione pliki (mtime i rozmiar) są pomijane, usunięte znikają z indeksu.
+    """
+    started = time.monotonic()
+    stamps = {}
+    for directory in directories:
+        for root, _, files in os.walk(directory):
+            for name in files:
+                if name.endswith(SEARCH_FILE_SUFFIXES):
+                    path = os.path.abspath(os.path.join(root, name))
+                    stat = os.stat(path)
+                    stamps[path] = (stat.st_mtime, stat.st_size)
+
+    with _db_lock:
+        db = get_db()
+        indexed = {source: (mtime, size) for source, mtime, size in
+                   db.execute("SELECT source, mtime, size FROM search_sources WHERE source NOT LIKE ?",
+                              (SEARCH_STORE_SOURCE + "%",))}
+    todo = [path for path, stamp in stamps.items() if indexed.get(path) != stamp]
+    roots = tuple(os.path.join(os.path.abspath(directory), "") for directory in directories)
+    removed = [source for source in indexed if source.startswith(roots) and source not in stamps]
+
+    turns = failed = 0
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        for path, parsed in zip(todo, pool.map(parse_history_file, todo, chunksize=4)):
+            if isinstance(parsed, str):
+                # nie-eksport albo uszkodzony plik - zapisany bez tur, żeby nie parsować go przy każdym indeksowaniu
+                print(f"{path}: {parsed}", file=sys.stderr)
+                failed += 1
+                session_id, parsed = None, (None, [])
+            session_id, file_turns = parsed
+            turns += len(file_turns)
+            with _db_lock, db:
+                search_index_turns(db, path, session_id, file_turns, 0, *stamps[path])
+    for source in removed:
+        search_remove_source(source)
+    if (todo or removed) and search_available:
+        with _db_lock, db:
+            db.execute("INSERT INTO search_index (search_index) VALUES ('optimize')")
+
+    print(f"Indexed {len(todo) - failed} file(s) with {turns} turn(s) in {time.monotonic() - started:.1f} s; "
+          f"{len(stamps) - len(todo)} unchanged, {len(removed)} removed, {failed} failed")
+    return 0
 
 
 def conditional_import(file_path, confirm, session):
     if file_path is None:
         return session
-    if not session["user_messages"] or confirm:
-        return import_history_yaml(file_path)
+    touch_session(session)
+    if not session.turns or confirm:
+        forget_session(session)
+        return touch_session(import_history_yaml(file_path))
     return session
 
 
+async def search_conversations(query):
+    """Pole wyszukiwania: (wyniki, wiersze tabeli, status)"""
+    started = time.monotonic()
+    results = await asyncio.to_thread(search_history, query)
+    elapsed = time.monotonic() - started
+    observe("search_seconds", elapsed)
+    if not query.strip():
+        return [], [], ""
+    if not search_available:
+        return [], [], "Search is not available (SQLite without FTS5)"
+    rows = [[result["snippet"].replace("\n", " "),
+             result["title"] if result["source"].startswith(SEARCH_STORE_SOURCE)
+             else f"{os.path.basename(result['source'])}: {result['title']}",
+             result["idx"] + 1]
+            for result in results]
+    return results, rows, f"{len(results)} result(s) in {elapsed * 1000:.1f} ms"
+
+
+def open_stored_session(session, session_id):
+    """Karta przechodzi do sesji z magazynu (albo już w pamięci) - tury wczytają się przy pierwszym użyciu"""
+    if session_id != session.id:
+        forget_session(session)
+        session = resident_sessions.get(session_id)
+        if session is None:
+            session = create_session()
+            session.id = session_id
+            session.loaded = False
+    touch_session(session)
+    return session
+
+
+async def open_search_result(result, session):
+    """Klik w wynik: sesja z magazynu (jak po powrocie do karty) albo plik eksportu (jak import),
+    widok historii ustawiony na znalezioną turę"""
+    source = result["source"]
+    if source.startswith(SEARCH_STORE_SOURCE):
+        session = open_stored_session(session, result["session_id"])
+    else:
+        try:
+            stat = os.stat(source)
+        except OSError:
+            # eksport usunięty albo przeniesiony po indeksowaniu - wynik znika z indeksu, karta zostaje przy swojej sesji
+            await asyncio.to_thread(search_remove_source, source)
+            touch_session(session)
+            note = {"role": "assistant", "content": SEARCH_MISSING_NOTE.format(source)}
+            return session, session.id, await format_history(session) + [note], format_usage(session)
+        session_id = imported_session_id(source, stat.st_mtime, stat.st_size)
+        if session_id is not None:
+            # plik był już otwarty - ta sama sesja, a nie kolejna kopia w magazynie i w indeksie
+            session = open_stored_session(session, session_id)
+        else:
+            forget_session(session)
+            session = await asyncio.to_thread(import_history_yaml, source)
+            remember_import(source, session.id, stat.st_mtime, stat.st_size)
+            touch_session(session)
+    session.history_from = min(result["idx"], max(0, len(session.turns) - HISTORY_VIEW_TURNS))
+    reset_history(session)
+    return session, session.id, await format_history_with_rendering(session), format_usage(session)
+
+
 def auto_download():
+    import gradio as gr
     return gr.update(visible=True)
 
 
-def delete_last_message(session):
-    if session["user_messages"]:
-        session["user_messages"].pop()
-    if session["assistant_messages"]:
-        session["assistant_messages"].pop()
-    return format_history(session)
-
-
-with gr.Blocks(css=css, title="ClaudeChat") as iface:
-    session = gr.State(create_session())
-
-    gr.Markdown("## <center>ClaudeChat</center>")
-    gr.Markdown("### <center>Python + Gradio + Anthropic API</center>")
-    gr.Markdown("---")
-    gr.Markdown(f"<p style='text-align: center; font-size: 0.8em;'>{MODEL_TITLE} + M. Krej</p>")
-
-    chatbot = gr.Chatbot(
-        type='messages',
-        elem_classes="chat-container",
-        show_copy_button=True,
-        render_markdown=True,
-        # bubble_full_width=False,
-        latex_delimiters=[
-            {"left": "$$", "right": "$$", "display": True},      # display mode z $$
-            {"left": "\\$", "right": "\\$", "display": False},   # inline mode z \$
-            {"left": "\\[", "right": "\\]", "display": True},    # LaTeX display mode
-            {"left": "\\(", "right": "\\)", "display": False}    # LaTeX inline mode
-        ]
-    )
+async def delete_last_message(session):
+    touch_session(session)
+    if session.turns:
+        session.turns.pop()
+    reset_history(session)
+    reset_context(session)
+    persist_session(session)
+    return await format_history(session)
+
+
+def branch_selector(session):
+    """Przełącznik gałęzi - widoczny, gdy rozmowa ma więcej niż jedną"""
+    import gradio as gr
+    return gr.update(choices=branch_labels(session), value=session.branch, visible=len(session.branches) > 1)
+
+
+async def fork_at_message(index, message, session):
+    """Edycja (albo ponowne wygenerowanie) pytania z historii: nowa gałąź z tur sprzed niego.
+    Zwraca pytanie do wysłania przez respond - pusty tekst, gdy gałęzi nie da się teraz utworzyć."""
+    touch_session(session)
+    turn = view_turn(session, index)
+    if session.busy or turn is None:
+        return "", await format_history(session), branch_selector(session)
+    message = message or session.turns[turn].user
+    fork_branch(session, turn)
+    persist_session(session)
+    return message, await format_history(session), branch_selector(session)
+
+
+async def select_branch(branch, session):
+    touch_session(session)
+    if not session.busy and branch is not None and branch != session.branch and 0 <= branch < len(session.branches):
+        switch_branch(session, branch)
+        persist_session(session)
+    return await format_history(session), format_usage(session), branch_selector(session)
+
+
+async def confirm_clear(confirm, session):
+    if confirm:
+        shutdown_kernel(session.id)
+        return clear_history(session)
+    return await format_history(session), ""
+
+
+async def show_imported(session):
+    return await format_history_with_rendering(session), ""
+
+
+init_plot_store()
+
 
+def build_ui():
+    """Drzewo gr.Blocks - budowane w main, więc sam import modułu nie ładuje Gradio"""
+    import gradio as gr
 
-    with gr.Row():
-        msg = gr.Textbox(placeholder="👉  Type your message here and press ENTER", show_label=False)
-        send = gr.Button("Send", elem_classes=["orange-button", "custom-button"], elem_id="send-button", variant="primary", scale=0)
-
-    with gr.Row():
-        reactions = ["👍", "👎", "👏", "🙏", "🙂", "😀", "😊", "😂", "🤣", "😅", "😮", "😢", "😙", "😜", "😟", "🙁", "🤔", "🤨", "😱", "🚀", "🎯", "🎉", '✨', '🔥', "⚠️", "💡"]
-
-        for emoji in reactions:
-            btn = gr.Button(emoji, size="sm", min_width=30, scale=0)
-            btn.click(lambda emoji, current_msg: current_msg + " " + emoji,
-                    [gr.State(emoji), msg], msg)
-
-    with gr.Row():
-        delete_last = gr.Button("⬅️ Delete Last")
-        clear = gr.Button("🗑️  Clear")
-        export = gr.Button("Export history")
-        import_btn = gr.Button("Import history")
-        stop = gr.Button("Stop Generation")
-
-    clear_confirm = gr.Checkbox(label="I confirm deletion of the entire conversation", visible=False)
-    import_confirm = gr.Checkbox(label="I confirm overwriting the current conversation", visible=False)
-    file_output = gr.File(label="Exported Chat History", visible=False)
-    file_input = gr.File(label="Import Chat History", visible=False, file_types=[".yaml"])
-
-    with gr.Accordion("Parameters", open=False):
-        system_prompt = gr.Textbox(
-            label="System Prompt",
-            placeholder="Enter system prompt to define Claude's role",
-            value=
-                "Always wrap all code in a fenced code block that starts with exactly '```python' "\
-                "on its own line, immediately followed by '%matplotlib inline' or '%py inline' as the very next line. "\
-                "The chat environment supports the '%matplotlib inline' directive for plots "\
-                "and '%py inline' for Python computations with output display. "\
-                "Generate code or plots only when explicitly requested. "\
-                "When you do generate plots, always start with '%matplotlib inline' by default. "\
-                "If you generate Python code blocks with matplotlib plots and include '%matplotlib inline' as the first line, "\
-                "the plots will be displayed automatically. Each such piece of code must be complete and working. "\
-                "Use sns.set_theme() instead of plt.style.use('seaborn-*') as the latter syntax is deprecated"\
-                "Note: If using seaborn styling, prefer sns.set_theme() over plt.style.use('seaborn-*') "\
-                "as the latter syntax is deprecated. However, you're free to use any matplotlib styles or custom styling approaches."\
-                "\n\nFor computations (not plots), use '%py inline' as the first line. "\
-                "The output will be captured and displayed automatically.\n\n"\
-                "IMPORTANT for '%py inline' blocks:\n"\
-                "- Code executes automatically AFTER you finish your response\n"\
-                "- NEVER predict, simulate, or write the output yourself\n"\
-                "- STOP after the code block - don't add predicted results\n"\
-                "- Wait for actual execution results to appear in the interface\n"\
-                "- You can analyze/comment on real output in your NEXT response (when user asks)\n"\
-                "- Auto-reply loops are PROHIBITED - single code block then WAIT for user\n\n"\
-                "IMPORTANT:  Always use exactly this syntax for math:\n"\
-                "- inline: \\$formula\\$\n"\
-                "- display: $$formula$$\n"\
-                "Never use single $ for inline math!\n"\
-                "Do not interpret these markers - show them exactly as written. Use the standard LaTeX syntax inside the delimiters.\n\n"\
-                "Always follow these rules:\n"\
-                "1. Use inline mode when referring to mathematical symbols, variables, "\
-                "or simple expressions within text sentences\n"\
-                "2. Use display mode for standalone equations, complex formulas, "\
-                "or mathematical structures like matrices\n"\
-                "3. When explaining mathematical components, always use inline mode for each symbol\n\n"\
-                "Check your statements mentally but try to keep it short.",
-            lines=12
+    gr.set_static_paths(paths=[PLOT_STORE_DIR])
+
+    with gr.Blocks(css=css, title="ClaudeChat") as iface:
+        session = gr.State(create_session(), delete_callback=forget_session)
+        browser_session_id = gr.BrowserState("", storage_key="claude_chat_session_id")
+
+        gr.Markdown("## <center>ClaudeChat</center>")
+        gr.Markdown("### <center>Python + Gradio + Anthropic API</center>")
+        gr.Markdown("---")
+        gr.Markdown(f"<p style='text-align: center; font-size: 0.8em;'>{MODEL_TITLE} + M. Krej</p>")
+
+        chatbot = gr.Chatbot(
+            type='messages',
+            elem_classes="chat-container",
+            editable="user",  # edycja pytania = nowa gałąź od tego miejsca
+            show_copy_button=True,
+            render_markdown=True,
+            # bubble_full_width=False,
+            latex_delimiters=[
+                {"left": "$$", "right": "$$", "display": True},      # display mode z $$
+                {"left": "\\$", "right": "\\$", "display": False},   # inline mode z \$
+                {"left": "\\[", "right": "\\]", "display": True},    # LaTeX display mode
+                {"left": "\\(", "right": "\\)", "display": False}    # LaTeX inline mode
+            ]
+        )
+        usage_info = gr.Markdown()
+        branch = gr.Dropdown(label="Branch", choices=[], visible=False, interactive=True)
+        earlier = gr.Button("⬆️ Show earlier messages", size="sm")
+
+
+        with gr.Row():
+            msg = gr.Textbox(placeholder="👉  Type your message here and press ENTER", show_label=False)
+            send = gr.Button("Send", elem_classes=["orange-button", "custom-button"], elem_id="send-button", variant="primary", scale=0)
+
+        with gr.Row():
+            reactions = ["👍", "👎", "👏", "🙏", "🙂", "😀", "😊", "😂", "🤣", "😅", "😮", "😢", "😙", "😜", "😟", "🙁", "🤔", "🤨", "😱", "🚀", "🎯", "🎉", '✨', '🔥', "⚠️", "💡"]
+
+            for emoji in reactions:
+                btn = gr.Button(emoji, size="sm", min_width=30, scale=0)
+                btn.click(lambda emoji, current_msg: current_msg + " " + emoji,
+                        [gr.State(emoji), msg], msg)
+
+        with gr.Row():
+            delete_last = gr.Button("⬅️ Delete Last")
+            clear = gr.Button("🗑️  Clear")
+            export = gr.Button("Export history")
+            import_btn = gr.Button("Import history")
+            stop = gr.Button("Stop Generation")
+
+        clear_confirm = gr.Checkbox(label="I confirm deletion of the entire conversation", visible=False)
+        import_confirm = gr.Checkbox(label="I confirm overwriting the current conversation", visible=False)
+        file_output = gr.File(label="Exported Chat History", visible=False)
+        file_input = gr.File(label="Import Chat History", visible=False, file_types=[".yaml", ".jsonl"])
+
+        with gr.Accordion("Parameters", open=False):
+            system_prompt = gr.Textbox(
+                label="System Prompt",
+                placeholder="Enter system prompt to define Claude's role",
+                value=DEFAULT_SYSTEM_PROMPT,
+                lines=12
+            )
+            prefill = gr.Textbox(label="Prefill Text", placeholder="Enter text to prefill Claude's response", lines=2)
+            temperature = gr.Slider(minimum=0, maximum=1, value=0, step=0.1, label="Temperature")
+            max_tokens = gr.Slider(minimum=1000, maximum=8000, value=4000, step=500, label="Maximum number of tokens")
+            export_format = gr.Radio(["YAML", "JSONL"], value="YAML", label="Export format")
+            response_cache = gr.Checkbox(label="Reuse cached replies for identical requests (same prompt, history and settings)",
+                                         value=False)
+            with gr.Row():
+                python_kernel = gr.Checkbox(label="Persistent Python kernel: %py inline blocks share variables and imports",
+                                            value=False)
+                restart = gr.Button("🔄 Restart kernel", size="sm", scale=0)
+
+        with gr.Accordion("Search conversations", open=False):
+            with gr.Row():
+                search_query = gr.Textbox(placeholder="🔎  Words to find in saved conversations and indexed exports",
+                                          show_label=False)
+                search = gr.Button("Search", scale=0)
+            search_status = gr.Markdown()
+            search_results = gr.State([])
+            search_table = gr.Dataframe(headers=["Match", "Conversation", "Turn"], datatype=["markdown", "str", "number"],
+                                        type="array", interactive=False, wrap=True, column_widths=["70%", "24%", "6%"])
+
+        with gr.Accordion("Stats", open=False):
+            stats_info = gr.Markdown()
+            refresh_stats = gr.Button("Refresh", size="sm")
+
+        msg.submit(respond, [msg, temperature, max_tokens, prefill, system_prompt, chatbot, session, response_cache, python_kernel], [msg, chatbot]).then(
+            format_usage, [session], [usage_info])
+        # .then( update_button_state, [chatbot], [clear, export] )
+        send.click(respond, [msg, temperature, max_tokens, prefill, system_prompt, chatbot, session, response_cache, python_kernel], [msg, chatbot]).then(
+            format_usage, [session], [usage_info])
+
+        delete_last.click(delete_last_message, [session], [chatbot]).then(branch_selector, [session], [branch])
+
+        # clear.click(clear_history, [session], [chatbot, msg], queue=False)
+        clear.click(
+            lambda session: gr.update(visible=True) if touch_session(session, tail=True).turns else gr.update(visible=False),
+            inputs=[session],
+            outputs=[clear_confirm]
         )
-        prefill = gr.Textbox(label="Prefill Text", placeholder="Enter text to prefill Claude's response", lines=2)
-        temperature = gr.Slider(minimum=0, maximum=1, value=0, step=0.1, label="Temperature")
-        max_tokens = gr.Slider(minimum=1000, maximum=8000, value=4000, step=500, label="Maximum number of tokens")
 
-    msg.submit(respond, [msg, temperature, max_tokens, prefill, system_prompt, chatbot, session], [msg, chatbot])
-    # .then( update_button_state, [chatbot], [clear, export] )
-    send.click(respond, [msg, temperature, max_tokens, prefill, system_prompt, chatbot, session], [msg, chatbot])
+        clear_confirm.change(
+            confirm_clear,
+            inputs=[clear_confirm, session],
+            outputs=[chatbot, msg]
+        ).then(
+            lambda: gr.update(visible=False, value=False),
+            inputs=None,
+            outputs=[clear_confirm]
+        ).then(branch_selector, [session], [branch])
+
+        stop.click(stop_generation_func, [session], None)
+        restart.click(restart_kernel, [session], None)
+
+        export.click(export_history_yaml, inputs=[session, export_format], outputs=[file_output]).then(auto_download, inputs=None, outputs=[file_output])
+
+        import_btn.click(
+            lambda session: (gr.update(visible=True), gr.update(visible=False)) if touch_session(session, tail=True).turns else (gr.update(visible=False), gr.update(visible=True)),
+            inputs=[session],
+            outputs=[import_confirm, file_input]
+        )
 
-    delete_last.click(delete_last_message, [session], [chatbot])
+        import_confirm.change(
+            lambda confirm: gr.update(visible=True if confirm else False),
+            inputs=[import_confirm],
+            outputs=[file_input]
+        )
 
-    # clear.click(clear_history, [session], [chatbot, msg], queue=False)
-    clear.click(
-        lambda session: gr.update(visible=True) if session["user_messages"] else gr.update(visible=False),
-        inputs=[session],
-        outputs=[clear_confirm]
-    )
+        file_input.change(
+            conditional_import,
+            inputs=[file_input, import_confirm, session],
+            outputs=[session]
+        ).then(
+            show_imported,
+            inputs=[session],
+            outputs=[chatbot, msg]
+        ).then(
+            lambda session: session.id,
+            inputs=[session],
+            outputs=[browser_session_id]
+        ).then(
+            branch_selector,
+            inputs=[session],
+            outputs=[branch]
+        ).then(
+            lambda: (gr.update(visible=False), gr.update(visible=False, value=False)),
+            inputs=None,
+            outputs=[file_input, import_confirm]
+        )
 
-    clear_confirm.change(
-        lambda confirm, session: clear_history(session) if confirm else (format_history(session), ""),
-        inputs=[clear_confirm, session],
-        outputs=[chatbot, msg]
-    ).then(
-        lambda: gr.update(visible=False, value=False),
-        inputs=None,
-        outputs=[clear_confirm]
-    )
+        search_query.submit(search_conversations, [search_query], [search_results, search_table, search_status])
+        search.click(search_conversations, [search_query], [search_results, search_table, search_status])
 
-    stop.click(stop_generation_func, [session], None)
+        async def open_selected(results, session, event: gr.SelectData):
+            # adnotacja gr.SelectData wskazuje Gradio, gdzie podać zdarzenie - stąd funkcja w build_ui
+            return await open_search_result(results[event.index[0]], session)
 
-    export.click(export_history_yaml, inputs=[session], outputs=[file_output]).then(auto_download, inputs=None, outputs=[file_output])
+        search_table.select(open_selected, [search_results, session], [session, browser_session_id, chatbot, usage_info]).then(
+            branch_selector, [session], [branch])
 
-    import_btn.click(
-        lambda session: (gr.update(visible=True), gr.update(visible=False)) if session["user_messages"] else (gr.update(visible=False), gr.update(visible=True)),
-        inputs=[session],
-        outputs=[import_confirm, file_input]
-    )
+        # edycja pytania albo Retry: nowa gałąź, pytanie idzie przez pole wiadomości do respond;
+        # bez cache odpowiedzi - to samo pytanie w tym samym kontekście ma dać nową odpowiedź
+        async def edit_message(session, event: gr.EditData):
+            return await fork_at_message(event.index, event.value, session)
 
-    import_confirm.change(
-        lambda confirm: gr.update(visible=True if confirm else False),
-        inputs=[import_confirm],
-        outputs=[file_input]
-    )
+        async def retry_message(session, event: gr.RetryData):
+            return await fork_at_message(event.index, None, session)
 
-    file_input.change(
-        conditional_import,
-        inputs=[file_input, import_confirm, session],
-        outputs=[session]
-    ).then(
-        lambda session: (format_history_with_rendering(session), ""),
-        inputs=[session],
-        outputs=[chatbot, msg]
-    ).then(
-        lambda: (gr.update(visible=False), gr.update(visible=False, value=False)),
-        inputs=None,
-        outputs=[file_input, import_confirm]
-    )
+        for fork_event, fork_handler in ((chatbot.edit, edit_message), (chatbot.retry, retry_message)):
+            fork_event(fork_handler, [session], [msg, chatbot, branch]).then(
+                respond, [msg, temperature, max_tokens, prefill, system_prompt, chatbot, session, gr.State(False),
+                          python_kernel], [msg, chatbot]).then(
+                format_usage, [session], [usage_info])
 
+        branch.input(select_branch, [branch, session], [chatbot, usage_info, branch])
 
-if __name__ == "__main__":
-    warnings.filterwarnings('ignore', message='Glyph.*missing from font')
+        earlier.click(show_earlier, [session], [chatbot])
+        refresh_stats.click(format_stats, None, [stats_info], queue=False)
+
+        iface.load(restore_session, [browser_session_id, session], [session, browser_session_id, chatbot, usage_info]).then(
+            branch_selector, [session], [branch])
 
+    return iface
+
+
+HOP_HEADERS = {"connection", "keep-alive", "transfer-encoding", "te", "trailer", "upgrade",
+               "proxy-authorization", "proxy-authenticate"}
+HEARTBEAT_RE = re.compile(r"/heartbeat/([^/?]+)")
+
+
+def request_session_hash(request, body):
+    """session_hash Gradio z query stringu (queue/data), ścieżki (heartbeat) albo JSON (queue/join, cancel)"""
+    # upload_progress musi trafić do workera, który przyjmuje dany upload
+    session_hash = request.query_params.get("session_hash") or request.query_params.get("upload_id")
+    if session_hash:
+        return session_hash
+    match = HEARTBEAT_RE.search(request.url.path)
+    if match:
+        return match.group(1)
+    if body:
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return None
+        if isinstance(data, dict):
+            return data.get("session_hash")
+    return None
+
+
+def spawn_worker(index, args):
+    command = [sys.executable, os.path.abspath(__file__), "--port", str(args.port + 1 + index),
+               "--worker", str(index), "--context-budget", str(args.context_budget),
+               "--flush-interval", str(args.flush_interval),
+               # limit zapytań do API jest wspólny dla całej usługi - każdy worker dostaje swoją część
+               "--max-in-flight", str(max(1, args.max_in_flight // args.workers)),
+               "--request-rate", str(args.request_rate / args.workers)]
+    if args.debug:
+        command.append("--debug")
+    if args.log_requests:
+        command.append("--log-requests")
+    return subprocess.Popen(command)
+
+
+def label_metrics(text, index, seen):
+    """Dokleja worker="i" do próbek; HELP/TYPE tylko raz na metrykę"""
+    lines = []
+    for line in text.splitlines():
+        if line.startswith("#"):
+            if line not in seen:
+                seen.add(line)
+                lines.append(line)
+        elif line:
+            name, _, value = line.partition(" ")
+            if "{" in name:
+                name = name.replace("{", f'{{worker="{index}",', 1)
+            else:
+                name += f'{{worker="{index}"}}'
+            lines.append(f"{name} {value}")
+    return lines
+
+
+def run_router(args):
+    """Jeden port dla przeglądarki, sticky routing po session_hash do procesów workerów"""
+    # SIGTERM (systemctl stop/restart) ma przejść przez finally i zamknąć workery - także przed startem
+    # uvicorn i po nim, bo uvicorn po zamknięciu ponawia przechwycony sygnał
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    import httpx
+    import uvicorn
+    from fastapi import FastAPI
+    from fastapi.responses import PlainTextResponse, StreamingResponse
+    from starlette.background import BackgroundTask
+
+    workers = [spawn_worker(index, args) for index in range(args.workers)]
+    upstreams = [f"http://127.0.0.1:{args.port + 1 + index}" for index in range(args.workers)]
+    round_robin = itertools.count()
+    proxy_client = httpx.AsyncClient(timeout=None, limits=httpx.Limits(
+        max_connections=None, max_keepalive_connections=HTTP_MAX_KEEPALIVE * args.workers))
+
+    async def watch_workers():
+        while True:
+            await asyncio.sleep(WORKER_CHECK_SECONDS)
+            for index, worker in enumerate(workers):
+                if worker.poll() is not None:
+                    logging.warning(f"Worker {index} exited with code {worker.returncode}, restarting")
+                    workers[index] = spawn_worker(index, args)
+
+    @contextlib.asynccontextmanager
+    async def lifespan(app):
+        watcher = asyncio.get_running_loop().create_task(watch_workers())
+        yield
+        watcher.cancel()
+        await proxy_client.aclose()
+
+    app = FastAPI(lifespan=lifespan)
+
+    async def metrics():
+        seen = set()
+        lines = []
+        for index, upstream in enumerate(upstreams):
+            try:
+                response = await proxy_client.get(upstream + "/metrics")
+            except httpx.HTTPError:
+                continue
+            lines.extend(label_metrics(response.text, index, seen))
+        return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+    async def proxy(request):
+        # body czytany tylko dla JSON (tam jest session_hash), upload idzie strumieniem
+        is_json = request.headers.get("content-type", "").startswith("application/json")
+        body = await request.body() if is_json else None
+        session_hash = request_session_hash(request, body)
+        index = zlib.crc32(session_hash.encode()) if session_hash else next(round_robin)
+
+        headers = [(name, value) for name, value in request.headers.items() if name.lower() not in HOP_HEADERS]
+        upstream_request = proxy_client.build_request(
+            request.method, upstreams[index % len(upstreams)] + request.url.path,
+            params=request.url.query, headers=headers,
+            content=body if is_json else request.stream())
+        try:
+            upstream = await proxy_client.send(upstream_request, stream=True)
+        except httpx.ConnectError:
+            return PlainTextResponse("Worker unavailable, try again in a moment", status_code=503)
+        response_headers = {name: value for name, value in upstream.headers.items() if name.lower() not in HOP_HEADERS}
+        return StreamingResponse(upstream.aiter_raw(), status_code=upstream.status_code,
+                                 headers=response_headers, background=BackgroundTask(upstream.aclose))
+
+    app.add_api_route("/metrics", metrics)
+    app.add_route("/{path:path}", proxy, methods=["GET", "POST", "PUT", "PATCH", "DELETE", "HEAD", "OPTIONS"])
+
+    try:
+        uvicorn.run(app, host="0.0.0.0", port=args.port, timeout_graceful_shutdown=SHUTDOWN_GRACE_SECONDS)
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.wait(10)
+
+
+def warm_up(server):
+    """Po otwarciu portu: pula sandboxa (matplotlib) i SDK ładują się w tle, zanim przyjdzie pierwsze pytanie"""
+    while not server.started:
+        if server.should_exit:
+            return
+        time.sleep(0.05)
+    start_sandbox_pool()
+    import anthropic  # noqa: F401 - get_client() dostanie moduł z sys.modules
+
+
+def run_server(args):
+    import gradio as gr
+    import uvicorn
+    from fastapi import FastAPI
+    from fastapi.responses import PlainTextResponse
+
+    iface = build_ui()
+    # współbieżność ogranicza admission controller, a nie domyślny limit 1 zdarzenia naraz w Gradio
+    iface.queue(default_concurrency_limit=None)
+    # /metrics obok aplikacji Gradio, na tym samym porcie
+    app = FastAPI()
+    app.add_api_route("/metrics", lambda: PlainTextResponse(format_metrics(), media_type="text/plain; version=0.0.4"))
+    app = gr.mount_gradio_app(app, iface, path="/", show_error=True)
+    # workery słuchają tylko lokalnie, z zewnątrz ruch idzie przez router
+    server = uvicorn.Server(uvicorn.Config(app, host="0.0.0.0" if WORKER_INDEX is None else "127.0.0.1",
+                                           port=args.port, timeout_graceful_shutdown=SHUTDOWN_GRACE_SECONDS))
+    threading.Thread(target=warm_up, args=(server,), daemon=True).start()
+    server.run()
+
+
+if __name__ == "__main__":
     args = parse_arguments()
     DEBUG = args.debug
+    CONTEXT_BUDGET_TOKENS = args.context_budget
+    STREAM_FLUSH_INTERVAL = args.flush_interval
+    ADMISSION_MAX_IN_FLIGHT = args.max_in_flight
+    ADMISSION_RATE = args.request_rate
+    WORKER_INDEX = args.worker
+    if WORKER_INDEX is not None:
+        # każdy worker rotuje własny plik - restore-history.py przyjmuje kilka plików
+        LOG_FILE = f"{os.path.splitext(LOG_FILE)[0]}.{WORKER_INDEX}.log"
+    setup_logging(DEBUG, args.log_requests)
     if DEBUG:
         print("Debug mode enabled")
-    iface.queue()
-    iface.launch(server_port=args.port, server_name="0.0.0.0", show_error=True)
+    if args.index_dir:
+        sys.exit(index_history_dirs(args.index_dir, args.index_jobs))
+    if args.batch or args.workers <= 1 or WORKER_INDEX is not None:
+        env = load_env()  # brak .env - błąd od razu, a nie przy pierwszym zapytaniu
+    if args.batch:
+        sys.exit(1 if asyncio.run(run_batch(args)) else 0)
+    if args.workers > 1 and WORKER_INDEX is None:
+        store_purge_expired()
+        search_sync_store()
+        run_router(args)
+        sys.exit(0)
+    if WORKER_INDEX is None:
+        store_purge_expired()
+        search_sync_store()
+    run_server(args)
@@ -1,71 +1,193 @@
 #!/usr/bin/python3
 
 import re
-import yaml
-import uuid
+import os
 import ast
 import sys
+import json
+import mmap
+import uuid
+import yaml
 import argparse
-
-def parse_conversation_log(log_text):
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from yaml import CSafeDumper as YamlDumper
+except ImportError:
+    from yaml import SafeDumper as YamlDumper
+
+# Linia logu z zapytaniem do API (repr opcji SDK jest w jednej linii), logowana tylko gdy
+# claude-chat.py działa z --debug albo --log-requests,
+# stary format "czas - POZIOM - ..." albo JSON lines {"ts": "czas", ...}
+RECORD_RE = re.compile(rb"^(?:\{\"ts\": \")?(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3})[^\n]*?'messages':\s*\[", re.MULTILINE)
+MESSAGES_RE = re.compile(r"'messages':\s*(\[.*?\])\s*,\s*'model':")
+BATCH_SIZE = 64  # tyle rekordów dostaje naraz jeden proces
+
+
+def in_range(timestamp, since, until):
+    # --until jest prefiksem, więc "2026-02-19 11:12" obejmuje całą minutę
+    if since and timestamp < since:
+        return False
+    if until and timestamp[:len(until)] > until:
+        return False
+    return True
+
+
+def find_records(path, since=None, until=None):
+    """Skanuje zmapowany plik i zwraca (timestamp, początek, koniec) każdej linii z zapytaniem"""
+    spans = []
+    with open(path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return spans
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as log:
+            for match in RECORD_RE.finditer(log):
+                timestamp = match.group(1).decode()
+                if not in_range(timestamp, since, until):
+                    continue
+                end = log.find(b"\n", match.end())
+                spans.append((timestamp, match.start(), end if end != -1 else len(log)))
+    return spans
+
+
+def parse_messages(record):
     # Znajdź sekcję 'messages': [...]
-    messages_match = re.search(r"'messages':\s*(\[.*?\])\s*,\s*'model':", log_text, re.DOTALL)
-
+    messages_match = MESSAGES_RE.search(record)
     if not messages_match:
-        return {"error": "Nie znaleziono sekcji 'messages' w logu"}
-
-    messages_str = messages_match.group(1)
+        return None
 
     # Parsuj jako Python literal
     try:
-        messages_list = ast.literal_eval(messages_str)
-    except:
-        return {"error": "Błąd parsowania listy wiadomości"}
+        messages_list = ast.literal_eval(messages_match.group(1))
+    except (ValueError, SyntaxError, MemoryError, RecursionError):
+        return None
 
     # Przetwórz wiadomości
     messages = []
     for msg in messages_list:
         if isinstance(msg, dict) and 'role' in msg and 'content' in msg:
+            content = msg['content']
+            # wiadomości z cache_control są listą bloków tekstowych
+            if isinstance(content, list):
+                content = ''.join(block.get('text', '') for block in content if isinstance(block, dict))
             messages.append({
                 "role": msg['role'],
-                "content": msg['content']
+                "content": content
             })
+    return messages
+
+
+def parse_records(path, spans):
+    """Uruchamiane w procesie z puli - każdy proces mapuje plik sam, przez pipe idą tylko offsety"""
+    records = []
+    with open(path, 'rb') as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as log:
+            for timestamp, start, end in spans:
+                line = log[start:end].decode('utf-8', errors='replace')
+                session_id = None
+                if line.startswith('{'):
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    line = entry.get("msg", "")
+                    session_id = entry.get("session_id")
+                messages = parse_messages(line)
+                if messages:
+                    records.append((timestamp, session_id, messages))
+    return records
+
+
+def message_key(messages):
+    return tuple((msg["role"], msg["content"]) for msg in messages)
+
+
+def group_conversations(records):
+    """Łączy zapytania w rozmowy.
+
+    Każde zapytanie zawiera całą dotychczasową rozmowę, więc zapytanie
+    przedłuża rozmowę, jeśli bez ostatniej odpowiedzi i nowego pytania
+    jest równe poprzedniemu zapytaniu z tej rozmowy.
+    """
+    conversations = []  # (id sesji z logu albo None, wiadomości)
+    tips = {}  # (id sesji, klucz ostatniego zapytania) -> indeks rozmowy
+
+    for _, session_id, messages in sorted(records, key=lambda record: record[0]):
+        if messages and messages[-1]["role"] == "assistant":
+            messages = messages[:-1]  # prefill
+        index = tips.pop((session_id, message_key(messages[:-2])), None) if len(messages) > 2 else None
+        if index is None:
+            index = len(conversations)
+            conversations.append((session_id, messages))
+        else:
+            conversations[index] = (session_id, messages)
+        tips[(session_id, message_key(messages))] = index
+
+    return conversations
+
+
+def write_conversation(session_id, messages, out_file, output_format):
+    session_id = session_id or str(uuid.uuid4())
+    with open(out_file, 'w', encoding='utf-8') as file:
+        if output_format == "jsonl":
+            file.write(json.dumps({"session_id": session_id}, ensure_ascii=False) + "\n")
+            for msg in messages:
+                file.write(json.dumps(msg, ensure_ascii=False) + "\n")
+        else:
+            yaml_data = {
+                "session_id": session_id,
+                "conversation": messages
+            }
+            yaml.dump(yaml_data, file, Dumper=YamlDumper, allow_unicode=True, sort_keys=False)
+
+
+def scan_logs(input_files, since=None, until=None, jobs=None):
+    records = []
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = []
+        for path in input_files:
+            spans = find_records(path, since, until)
+            for i in range(0, len(spans), BATCH_SIZE):
+                futures.append(pool.submit(parse_records, path, spans[i:i + BATCH_SIZE]))
+        for future in futures:
+            records.extend(future.result())
+    return records
 
-    yaml_data = {
-        "session_id": str(uuid.uuid4()),
-        "conversation": messages
-    }
-
-    return yaml_data
-
-def log_to_yaml(log_text, output_file=None):
-    yaml_data = parse_conversation_log(log_text)
-    yaml_output = yaml.dump(yaml_data, allow_unicode=True, sort_keys=False)
-    return yaml_output
 
 def main():
-    parser = argparse.ArgumentParser(description='Converts the conversation log to YAML format')
-    parser.add_argument('input_file', help='Path to the input log file')
-    #parser.add_argument('-o', '--output', default='output.yaml',
-    #                   help='Path to output file (default: output.yaml)')
+    parser = argparse.ArgumentParser(
+        description='Converts conversation logs to YAML/JSONL, one file per conversation',
+        epilog='Requests are only logged when claude-chat.py runs with --debug or --log-requests')
+    parser.add_argument('input_files', nargs='+', help='Path to the input log file(s), e.g. rotated logs')
+    parser.add_argument('--since', help='Only records at or after this timestamp, e.g. "2026-02-19 11:12"')
+    parser.add_argument('--until', help='Only records up to this timestamp (prefix match), e.g. "2026-02-19 11:12:51,335"')
+    parser.add_argument('--format', choices=['yaml', 'jsonl'], default='yaml', help='Output format (default: yaml)')
+    parser.add_argument('-o', '--output-dir', help='Directory for output files (default: next to the first input file)')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='Number of parser processes (default: CPU count)')
 
     args = parser.parse_args()
 
     try:
-        with open(args.input_file, 'r', encoding='utf-8') as file:
-            log_text = file.read()
+        records = scan_logs(args.input_files, args.since, args.until, args.jobs)
+        conversations = group_conversations(records)
 
-        yaml_output = log_to_yaml(log_text)
+        if not conversations:
+            print("Error: No conversation records found in the log", file=sys.stderr)
+            sys.exit(1)
 
-        out_file = args.input_file + ".yaml"
+        base = args.input_files[0]
+        if args.output_dir:
+            os.makedirs(args.output_dir, exist_ok=True)
+            base = os.path.join(args.output_dir, os.path.basename(base))
 
-        with open(out_file, 'w', encoding='utf-8') as file:
-            file.write(yaml_output)
+        for i, (session_id, messages) in enumerate(conversations):
+            suffix = f".{args.format}" if len(conversations) == 1 else f".{i + 1}.{args.format}"
+            write_conversation(session_id, messages, base + suffix, args.format)
 
-        print(f"Conversion completed successfully. Result saved in: {out_file}")
+        print(f"Conversion completed successfully. {len(conversations)} conversation(s) "
+              f"from {len(records)} request(s) saved as: {base}.*{args.format}")
 
-    except FileNotFoundError:
-        print(f"Error: Cannot find file '{args.input_file}'", file=sys.stderr)
+    except FileNotFoundError as e:
+        print(f"Error: Cannot find file '{e.filename}'", file=sys.stderr)
         sys.exit(1)
     except Exception as e:
         print(f"Error while processing: {e}", file=sys.stderr)
@@ -73,4 +195,3 @@ def main():
 
 if __name__ == "__main__":
     main()
-